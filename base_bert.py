@@ -171,7 +171,9 @@ class BertPreTrainedModel(nn.Module):
     if metadata is not None:
       state_dict._metadata = metadata
 
-    your_bert_params = [f"bert.{x[0]}" for x in model.named_parameters()]
+    # state_dict keys rather than parameter names, so that layouts that differ from the
+    # checkpoint internally (e.g. fused_qkv) but save the same keys are accepted.
+    your_bert_params = [f"bert.{x}" for x in model.state_dict().keys()]
     for k in state_dict:
       if k not in your_bert_params and not k.startswith("cls."):
         possible_rename = [x for x in k.split(".")[1:-1] if x in m.values()]
@@ -0,0 +1,515 @@
+'''
+Micro-benchmarks for the performance-sensitive parts of the codebase.
+
+Each benchmark is a subcommand, e.g.
+
+    python benchmark.py wordpiece
+
+Benchmarks that need the tokenizer download the `bert-base-uncased` vocab unless
+`--vocab_file` points to a local copy.
+'''
+
+import argparse
+import contextlib
+import copy
+import csv
+import gc
+import glob
+import io
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from bert import BertModel, BertSelfAttention, quantize_dynamic_int8
+from config import BertConfig
+from datasets import (BucketBatchSampler, SentenceClassificationDataset, SentencePairDataset, load_multitask_data,
+                      load_multitask_splits)
+from duplicate_search import IVFIndex, embed_questions, exact_search, read_questions
+from evaluation import model_eval_multitask
+from multitask_classifier import MultitaskBERT, TaskStream, build_dataloader, load_test_model, saved_model_state
+from optimizer import AdamW
+from sentence_cache import SentenceEmbeddingIndex
+from tokenizer import BertTokenizer
+
+
+def get_tokenizer(args):
+    if args.vocab_file is not None:
+        return BertTokenizer(vocab_file=args.vocab_file, model_max_length=512)
+    return BertTokenizer.from_pretrained('bert-base-uncased')
+
+
+def read_sentences(filename):
+    sents = []
+    with open(filename, 'r') as fp:
+        for record in csv.DictReader(fp, delimiter='\t'):
+            for key in ('sentence', 'sentence1', 'sentence2'):
+                if record.get(key):
+                    sents.append(record[key])
+    return sents
+
+
+def timed(fn, repeats):
+    '''Best wall-clock time of `repeats` calls, with the garbage collector paused as in timeit.'''
+    best = float('inf')
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+
+def wordpiece_reference(wordpiece, text):
+    '''The original WordpieceTokenizer.tokenize, which probes the vocab with every candidate substring.'''
+    output_tokens = []
+    for token in text.split():
+        chars = list(token)
+        if len(chars) > wordpiece.max_input_chars_per_word:
+            output_tokens.append(wordpiece.unk_token)
+            continue
+
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in wordpiece.vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+
+        if is_bad:
+            output_tokens.append(wordpiece.unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+def bench_wordpiece(args):
+    tokenizer = get_tokenizer(args)
+    wordpiece = tokenizer.wordpiece_tokenizer
+
+    # Basic tokenization is the same for both implementations, so it is done up front
+    # and only the WordPiece step is timed.
+    words = {}
+    for filename in sorted(glob.glob('data/*.csv')):
+        words[filename] = [tokenizer.basic_tokenizer.tokenize(s) for s in read_sentences(filename)]
+
+    for filename, sents in words.items():
+        for sent in sents:
+            for word in sent:
+                assert wordpiece.tokenize(word) == wordpiece_reference(wordpiece, word), word
+    print(f"Trie output identical to the reference on {len(words)} files")
+
+    for filename in ('data/ids-sst-train.csv', 'data/quora-train.csv'):
+        flat = [word for sent in words[filename] for word in sent]
+        t_ref = timed(lambda: [wordpiece_reference(wordpiece, w) for w in flat], args.repeats)
+        t_trie = timed(lambda: [wordpiece.tokenize(w) for w in flat], args.repeats)
+        print(f"{filename}: {len(flat)} words, reference {t_ref:.3f}s, trie {t_trie:.3f}s, "
+              f"speedup {t_ref / t_trie:.2f}x")
+
+
+def bench_qkv(args):
+    torch.manual_seed(0)
+    unfused = BertSelfAttention(BertConfig()).eval()
+    fused = BertSelfAttention(BertConfig(fused_qkv=True)).eval()
+    fused.load_state_dict(unfused.state_dict())
+
+    print(f"threads: {torch.get_num_threads()}")
+    with torch.no_grad():
+        for bs, seq_len in ((8, 32), (8, 64), (32, 64), (64, 128)):
+            hidden_states = torch.randn(bs, seq_len, 768)
+            attention_mask = torch.zeros(bs, 1, 1, seq_len)
+            assert torch.allclose(unfused(hidden_states, attention_mask), fused(hidden_states, attention_mask),
+                                  atol=1e-5)
+            t_unfused = timed(lambda: [unfused(hidden_states, attention_mask) for _ in range(10)], args.repeats)
+            t_fused = timed(lambda: [fused(hidden_states, attention_mask) for _ in range(10)], args.repeats)
+            print(f"batch {bs} x {seq_len}: unfused {t_unfused * 100:.2f}ms, fused {t_fused * 100:.2f}ms, "
+                  f"speedup {t_unfused / t_fused:.2f}x")
+
+
+def bench_adamw(args):
+    torch.manual_seed(0)
+    config = BertConfig(num_hidden_layers=args.num_layers)
+    config.name_or_path = 'random-init'  # BertPreTrainedModel expects the from_pretrained attribute
+    model = BertModel(config)
+    params = list(model.parameters())
+    grads = [torch.randn_like(p) for p in params]
+    print(f"{len(params)} parameter tensors, {sum(p.numel() for p in params) / 1e6:.1f}M parameters, "
+          f"threads: {torch.get_num_threads()}")
+
+    times = {}
+    for mode in ('loop', 'foreach', 'flat'):
+        optimizer = AdamW(params, lr=1e-5, weight_decay=0.01, **({mode: True} if mode != 'loop' else {}))
+
+        def step():
+            for p, g in zip(params, grads):
+                if p.grad is None:
+                    p.grad = g.clone()
+                else:
+                    p.grad.copy_(g)
+            optimizer.step()
+
+        step()  # allocate the state (and the flat buffers) outside the timed region
+        times[mode] = timed(lambda: [step() for _ in range(5)], args.repeats) / 5
+        print(f"{mode}: {times[mode] * 1000:.1f}ms per step, speedup {times['loop'] / times[mode]:.2f}x")
+        del optimizer
+        for p in params:
+            p.grad = None
+
+
+def bench_frozen(args):
+    class UnfilteredAdamW(AdamW):
+        # AdamW as before it dropped parameters with requires_grad=False.
+        add_param_group = torch.optim.Optimizer.add_param_group
+
+    torch.manual_seed(0)
+    config = SimpleNamespace(hidden_dropout_prob=0.0, num_labels=5, hidden_size=768,
+                             fine_tune_mode='last-linear-layer', siamese=False)
+    model = MultitaskBERT(config)
+    trained = [p for p in model.parameters() if p.requires_grad]
+    grads = [torch.randn_like(p) for p in trained]
+
+    def saved_size(state):
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        size = buffer.tell()
+        return f"{size / 2**20:.1f}MB" if size >= 2**20 else f"{size / 2**10:.1f}KB"
+
+    print(f"last-linear-layer MultitaskBERT: {len(list(model.parameters()))} parameter tensors, {len(trained)} trained, "
+          f"threads: {torch.get_num_threads()}")
+    times = {}
+    for name, optimizer_class, model_state in (('all parameters', UnfilteredAdamW, model.state_dict()),
+                                               ('trained only', AdamW, saved_model_state(model, config))):
+        optimizer = optimizer_class(model.parameters(), lr=1e-5, weight_decay=0.01)
+
+        def step():
+            for p, g in zip(trained, grads):
+                p.grad = g.clone()
+            optimizer.step()
+            optimizer.zero_grad()
+
+        step()  # allocate the state outside the timed region
+        times[name] = timed(lambda: [step() for _ in range(100)], args.repeats) / 100
+        print(f"{name}: {sum(len(group['params']) for group in optimizer.param_groups)} optimizer params, "
+              f"step + zero_grad {times[name] * 1e6:.0f}us (speedup {times['all parameters'] / times[name]:.2f}x), "
+              f"checkpoint model state {saved_size(model_state)}, optimizer state {saved_size(optimizer.state_dict())}")
+
+
+def bench_precision(args):
+    torch.manual_seed(0)
+    config = BertConfig(num_hidden_layers=args.num_layers)
+    config.name_or_path = 'random-init'  # BertPreTrainedModel expects the from_pretrained attribute
+    model = BertModel(config)
+    input_ids = torch.randint(0, config.vocab_size, (16, 64))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[8:, 32:] = 0
+
+    def train_step(precision):
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            pooled = model(input_ids, attention_mask)['pooler_output']
+        pooled.float().sum().backward()
+        model.zero_grad()
+
+    print(f"threads: {torch.get_num_threads()}, batch 16 x 64, {args.num_layers} layers")
+    model.eval()  # no dropout, so both precisions compute the same function
+    with torch.no_grad():
+        reference = model(input_ids, attention_mask)['pooler_output']
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            pooled = model(input_ids, attention_mask)['pooler_output'].float()
+    print(f"bf16 pooler_output max abs difference to fp32: {(pooled - reference).abs().max():.4f}")
+    model.train()
+    times = {}
+    for precision in ('fp32', 'bf16'):
+        train_step(precision)
+        times[precision] = timed(lambda: train_step(precision), args.repeats)
+        print(f"{precision}: forward + backward {times[precision] * 1000:.0f}ms, "
+              f"{16 / times[precision]:.1f} examples/s, speedup {times['fp32'] / times[precision]:.2f}x")
+
+    # Dev metrics of a trained model evaluated in each precision.
+    trained, trained_config = load_test_model(argparse.Namespace(filepath=args.filepath, int8=False),
+                                              torch.device('cpu'))
+    loaders = dev_loaders(args, trained_config)
+    metrics, eval_times = {}, {}
+    for precision in ('fp32', 'bf16'):
+        eval_times[precision], metrics[precision] = dev_metrics(loaders, trained, precision)
+        print(f"{precision}: dev evaluation {eval_times[precision]:.1f}s, "
+              f"{metric_deltas(metrics[precision], metrics['fp32'])}")
+
+
+def dev_loaders(args, config):
+    '''Sequential loaders of the SST, Quora and STS dev sets (their first args.max_examples examples).'''
+    sst, _, para, sts = load_multitask_data('data/ids-sst-dev.csv', 'data/quora-dev.csv', 'data/sts-dev.csv', split='dev')
+    loader_args = argparse.Namespace(siamese=config.siamese, token_cache_dir='.token_cache', batch_size=args.batch_size,
+                                     bucket_multiplier=1, max_tokens=None, use_gpu=False, prefetch_factor=2, seed=0)
+    datasets = [SentenceClassificationDataset(sst[:args.max_examples], loader_args),
+                SentencePairDataset(para[:args.max_examples], loader_args),
+                SentencePairDataset(sts[:args.max_examples], loader_args, isRegression=True)]
+    print(f"{args.filepath}: {len(datasets[0])} SST, {len(datasets[1])} Quora and {len(datasets[2])} STS dev "
+          f"examples, batch size {args.batch_size}")
+    return [build_dataloader(dataset, loader_args, shuffle=False) for dataset in datasets]
+
+
+def dev_metrics(loaders, model, precision='fp32'):
+    '''(seconds, [sst accuracy, para accuracy, sts correlation]) of evaluating model on the dev loaders.'''
+    start = time.perf_counter()
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        results = model_eval_multitask(*loaders, model, torch.device('cpu'))
+    return time.perf_counter() - start, np.array([results[0], results[3], results[6]])
+
+
+def metric_deltas(metrics, reference):
+    sst_acc, para_acc, sts_corr = metrics - reference
+    return (f"sst acc {metrics[0]:.3f} ({sst_acc:+.3f}), para acc {metrics[1]:.3f} ({para_acc:+.3f}), "
+            f"sts corr {metrics[2]:.3f} ({sts_corr:+.3f})")
+
+
+def bench_int8(args):
+    model, config = load_test_model(argparse.Namespace(filepath=args.filepath, int8=False), torch.device('cpu'))
+    model.eval()
+    quantized = quantize_dynamic_int8(copy.deepcopy(model))
+    print(f"threads: {torch.get_num_threads()}")
+    loaders = dev_loaders(args, config)
+    n = sum(len(loader.dataset) for loader in loaders)
+
+    def saved_size(m):
+        buffer = io.BytesIO()
+        torch.save(m.state_dict(), buffer)
+        return buffer.tell() / 2**20
+
+    metrics, times = {}, {}
+    for name, m in (('fp32', model), ('int8', quantized)):
+        times[name], metrics[name] = dev_metrics(loaders, m)
+        print(f"{name}: dev evaluation {times[name]:.1f}s, {times[name] / n * 1000:.2f}ms per example, "
+              f"speedup {times['fp32'] / times[name]:.2f}x, state_dict {saved_size(m):.0f}MB; "
+              f"{metric_deltas(metrics[name], metrics['fp32'])}")
+
+
+def bench_sentence_cache(args):
+    torch.manual_seed(0)
+    config = BertConfig(num_hidden_layers=args.num_layers)
+    config.name_or_path = 'random-init'  # BertPreTrainedModel expects the from_pretrained attribute
+    model = BertModel(config).eval()
+    _, _, para, sts = load_multitask_data('data/ids-sst-dev.csv', 'data/quora-dev.csv', 'data/sts-dev.csv', split='dev')
+    dataset_args = argparse.Namespace(siamese=True, token_cache_dir='.token_cache')
+    datasets = [SentencePairDataset(para[:args.max_pairs], dataset_args),
+                SentencePairDataset(sts[:args.max_pairs], dataset_args, isRegression=True)]
+
+    def per_pair():
+        # What evaluation did before: both sentences of every pair, in length-sorted batches
+        # (siamese batches hold the first sentences and then the second ones in token_ids_1).
+        for dataset in datasets:
+            for batch in BucketBatchSampler(dataset.lengths, args.batch_size, shuffle=False):
+                data = dataset.collate_fn([dataset[i] for i in batch])
+                model(data['token_ids_1'], data['attention_mask_1'])
+
+    def deduplicated():
+        index = SentenceEmbeddingIndex(datasets)
+        index.encode(model, 2 * args.batch_size, torch.device('cpu'))
+
+    print(f"threads: {torch.get_num_threads()}, {args.num_layers} layers, "
+          f"{sum(len(dataset) for dataset in datasets)} Quora and STS dev pairs")
+    with torch.no_grad():
+        t_pairs = timed(per_pair, args.repeats)
+        t_dedup = timed(deduplicated, args.repeats)
+    print(f"per pair {t_pairs:.1f}s, deduplicated {t_dedup:.1f}s, speedup {t_pairs / t_dedup:.2f}x")
+
+
+def bench_prefetch(args):
+    torch.manual_seed(0)
+    config = BertConfig(num_hidden_layers=args.num_layers)
+    config.name_or_path = 'random-init'  # BertPreTrainedModel expects the from_pretrained attribute
+    model = BertModel(config).train()
+    _, _, para, _ = load_multitask_data('data/ids-sst-train.csv', 'data/quora-train.csv', 'data/sts-train.csv',
+                                        split='train')
+    loader_args = argparse.Namespace(siamese=False, token_cache_dir='.token_cache', batch_size=args.batch_size,
+                                     bucket_multiplier=100, max_tokens=None, use_gpu=False,
+                                     prefetch_factor=args.prefetch_factor, seed=0)
+    dataset = SentencePairDataset(para[:args.max_pairs], loader_args)
+
+    def run(num_workers):
+        '''(seconds waiting for batches, total seconds) of args.steps training steps.'''
+        generator = torch.Generator()
+        stream = TaskStream(build_dataloader(dataset, loader_args, shuffle=True, generator=generator,
+                                             num_workers=num_workers), generator, (0, 0))
+        next(stream)  # start the workers outside the measurement
+        stream.wait = 0.0
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            batch = next(stream)
+            model(batch['token_ids_1'], batch['attention_mask_1'])['pooler_output'].sum().backward()
+            model.zero_grad()
+        return stream.wait, time.perf_counter() - start
+
+    # Workers need CPUs of their own; with fewer cores than workers + 1 they compete with training.
+    print(f"CPUs: {os.cpu_count()}, threads: {torch.get_num_threads()}, {args.num_layers} layers, {args.steps} Quora batches of "
+          f"{args.batch_size}, prefetch_factor {args.prefetch_factor}")
+    waits = {}
+    for num_workers in args.num_workers:
+        waits[num_workers], elapsed = run(num_workers)
+        # Workers pay off when they hide more input time than their transfers cost.
+        overlap = ''
+        if num_workers > 0 and waits.get(0):
+            hidden = 1 - waits[num_workers] / waits[0]
+            overlap = (f", {hidden:.0%} of the num_workers 0 wait hidden" if hidden >= 0 else
+                       f", {waits[num_workers] / waits[0]:.1f}x the num_workers 0 wait")
+        print(f"num_workers {num_workers}: {elapsed:.1f}s, waited {waits[num_workers]:.2f}s for batches "
+              f"({waits[num_workers] / elapsed:.1%}){overlap}")
+
+
+def bench_ingest(args):
+    splits = {split: (f'data/ids-sst-{suffix}.csv', f'data/quora-{suffix}.csv', f'data/sts-{suffix}.csv')
+              for split, suffix in (('train', 'train'), ('dev', 'dev'), ('test', 'test-student'))}
+
+    def load(cache_dir, num_procs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return load_multitask_splits(splits, cache_dir, num_procs)
+
+    n_examples = sum(len(d) for data in load(None, 1).values() for d in (data[0], data[2], data[3]))
+    print(f"{len(splits) * 3} files, {n_examples} examples, {os.cpu_count()} CPUs")
+    serial = timed(lambda: load(None, 1), args.repeats)
+    parallel = timed(lambda: load(None, args.procs), args.repeats)
+    print(f"parse serially {serial:.2f}s, in a pool of {args.procs or 'one per file'} {parallel:.2f}s "
+          f"({serial / parallel:.2f}x)")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        load(cache_dir, args.procs)
+        cold = time.perf_counter() - start
+        cached = timed(lambda: load(cache_dir, args.procs), args.repeats)
+    print(f"cold cache (parse + write) {cold:.2f}s, warm cache {cached * 1000:.1f}ms ({serial / cached:.0f}x vs. serial)")
+
+
+def bench_duplicate_search(args):
+    device = torch.device('cpu')
+    if args.filepath is not None:
+        model, _ = load_test_model(argparse.Namespace(filepath=args.filepath, int8=False), device)
+    else:
+        # Pretrained BERT without fine-tuning: IVF is still compared with exact search under
+        # the same embeddings, but the labelled recall means little.
+        torch.manual_seed(0)
+        model = MultitaskBERT(SimpleNamespace(hidden_dropout_prob=0.0, num_labels=5, hidden_size=768,
+                                              fine_tune_mode='last-linear-layer', siamese=True))
+    model.eval()
+
+    filename = 'data/quora-dev.csv'
+    questions = read_questions(filename)[:args.max_questions]
+    position = {q: i for i, q in enumerate(questions)}
+    duplicates = {}
+    with open(filename, 'r') as fp:
+        for record in csv.DictReader(fp, delimiter='\t'):
+            a, b = position.get(record['sentence1']), position.get(record['sentence2'])
+            if a is not None and b is not None and a != b and record['is_duplicate'] == '1.0':
+                duplicates.setdefault(a, set()).add(b)
+                duplicates.setdefault(b, set()).add(a)
+    queries = np.random.default_rng(0).choice(sorted(duplicates), min(args.queries, len(duplicates)), replace=False)
+    k = args.k
+
+    def top_k(ids):
+        # Drop each query itself from its results.
+        return np.stack([row[row != query][:k] for row, query in zip(ids, queries)])
+
+    def recall(found, reference):
+        return np.mean([len(set(f) & set(r)) / k for f, r in zip(found, reference)])
+
+    def labelled_recall(found):
+        return np.mean([bool(duplicates[query] & set(f)) for f, query in zip(found, queries)])
+
+    start = time.perf_counter()
+    embeddings = embed_questions(model, questions, args.batch_size, device).numpy()
+    print(f"{len(questions)} questions, {len(queries)} queries with a labelled duplicate, "
+          f"threads: {torch.get_num_threads()}; embedded in {time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    index = IVFIndex.build(embeddings)
+    print(f"IVF index with {len(index.centroids)} lists built in {time.perf_counter() - start:.1f}s")
+    query_embeddings = embeddings[queries]
+
+    start = time.perf_counter()
+    exact = top_k(exact_search(embeddings, query_embeddings, k + 1)[0])
+    t_exact = (time.perf_counter() - start) / len(queries)
+    print(f"exact cosine search: {t_exact * 1000:.2f}ms per query, labelled recall@{k} {labelled_recall(exact):.3f}")
+
+    for n_probe in args.n_probe:
+        start = time.perf_counter()
+        retrieved = top_k(index.search(query_embeddings, k + 1, n_probe)[0])
+        t_search = (time.perf_counter() - start) / len(queries)
+        print(f"IVF n_probe {n_probe}: search {t_search * 1000:.2f}ms per query; "
+              f"recall@{k} vs exact cosine {recall(retrieved, exact):.3f}, labelled recall@{k} {labelled_recall(retrieved):.3f}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", type=str, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_layers", type=int, default=12, help='BERT layers for the adamw, precision, sentence_cache and prefetch benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    subparsers.add_parser('wordpiece', help='trie WordPiece vs. substring probing on SST and Quora')
+    subparsers.add_parser('qkv', help='fused vs. separate query/key/value projections in BertSelfAttention')
+    subparsers.add_parser('adamw', help='per-parameter loop vs. foreach vs. flat-buffer AdamW steps on BERT-base')
+    subparsers.add_parser('frozen', help='AdamW steps and checkpoint size in last-linear-layer mode, with and without the frozen BERT parameters')
+    precision = subparsers.add_parser('precision', help='fp32 vs. bf16 autocast training steps of BERT-base, and dev metrics of a trained model')
+    precision.add_argument('--filepath', type=str, required=True, help='multitask_classifier.py checkpoint to evaluate')
+    precision.add_argument('--batch_size', type=int, default=8)
+    precision.add_argument('--max_examples', type=int, default=None, help='use only the first examples of each dev file')
+    int8 = subparsers.add_parser('int8', help='dev metrics and evaluation time of a trained model in fp32 vs. dynamically quantized int8')
+    int8.add_argument('--filepath', type=str, required=True, help='multitask_classifier.py checkpoint')
+    int8.add_argument('--batch_size', type=int, default=8)
+    int8.add_argument('--max_examples', type=int, default=None, help='use only the first examples of each dev file')
+    sentence_cache = subparsers.add_parser('sentence_cache',
+                                           help='per-pair vs. deduplicated siamese encoding of Quora and STS dev')
+    sentence_cache.add_argument('--batch_size', type=int, default=8)
+    sentence_cache.add_argument('--max_pairs', type=int, default=None, help='use only the first pairs of each file')
+    prefetch = subparsers.add_parser('prefetch',
+                                     help='time spent waiting for batches with and without DataLoader workers')
+    prefetch.add_argument('--batch_size', type=int, default=32)
+    prefetch.add_argument('--steps', type=int, default=50)
+    prefetch.add_argument('--max_pairs', type=int, default=20000, help='use only the first Quora training pairs')
+    prefetch.add_argument('--num_workers', type=int, nargs='+', default=[0, 1, 2])
+    prefetch.add_argument('--prefetch_factor', type=int, default=2)
+    ingest = subparsers.add_parser('ingest', help='serial vs. pooled parsing of the nine data files, and loading them from the cache')
+    ingest.add_argument('--procs', type=int, default=None, help='pool size; default one per file')
+    duplicate_search = subparsers.add_parser('duplicate_search',
+                                             help='IVF vs. exact cosine search of Quora dev questions')
+    duplicate_search.add_argument('--filepath', type=str, default=None,
+                                  help='--siamese multitask checkpoint; by default pretrained BERT with untrained heads')
+    duplicate_search.add_argument('--batch_size', type=int, default=64)
+    duplicate_search.add_argument('--max_questions', type=int, default=None)
+    duplicate_search.add_argument('--queries', type=int, default=200)
+    duplicate_search.add_argument('--k', type=int, default=10)
+    duplicate_search.add_argument('--n_probe', type=int, nargs='+', default=[1, 4, 16])
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = get_args()
+    {
+        'wordpiece': bench_wordpiece,
+        'qkv': bench_qkv,
+        'adamw': bench_adamw,
+        'frozen': bench_frozen,
+        'precision': bench_precision,
+        'int8': bench_int8,
+        'sentence_cache': bench_sentence_cache,
+        'prefetch': bench_prefetch,
+        'ingest': bench_ingest,
+        'duplicate_search': bench_duplicate_search,
+    }[args.benchmark](args)
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,6 +7,28 @@ from base_bert import BertPreTrainedModel
 from utils import *
 
 
+def unpad_hidden(hidden_states, indices):
+  # [bs, seq_len, hidden] -> [total_tokens, hidden], keeping the rows listed in indices.
+  return hidden_states.reshape(-1, hidden_states.shape[-1]).index_select(0, indices)
+
+
+def pad_hidden(hidden_states, indices, bs, seq_len):
+  # Inverse of unpad_hidden: [total_tokens, hidden] -> [bs, seq_len, hidden], with zeros at padding positions.
+  out = hidden_states.new_zeros(bs * seq_len, hidden_states.shape[-1])
+  return out.index_copy(0, indices, hidden_states).view(bs, seq_len, -1)
+
+
+def autocast_dtype(device_type):
+  # The dtype autocast runs in on device_type, or None if autocast is off there. The per-device
+  # torch.get_autocast_dtype / is_autocast_enabled(device_type) only exist from torch 2.4 on;
+  # older versions have separate CPU and GPU functions.
+  if hasattr(torch, 'get_autocast_dtype'):
+    return torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+  if device_type == 'cpu':
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+  return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+
+
 class BertSelfAttention(nn.Module):
   def __init__(self, config):
     super().__init__()
@@ -14,18 +38,40 @@ class BertSelfAttention(nn.Module):
     self.all_head_size = self.num_attention_heads * self.attention_head_size
 
     # Initialize the linear transformation layers for key, value, query.
-    self.query = nn.Linear(config.hidden_size, self.all_head_size)
-    self.key = nn.Linear(config.hidden_size, self.all_head_size)
-    self.value = nn.Linear(config.hidden_size, self.all_head_size)
+    self.fused_qkv = config.fused_qkv
+    if self.fused_qkv:
+      # One [hidden_size, 3 * all_head_size] projection whose output rows are query, key, value.
+      # State dicts still use separate query/key/value entries (see the hooks below), so
+      # checkpoints load and save the same way in both modes.
+      self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
+      self._register_load_state_dict_pre_hook(self._fuse_qkv_state_dict)
+      self._register_state_dict_hook(self._unfuse_qkv_state_dict)
+    else:
+      self.query = nn.Linear(config.hidden_size, self.all_head_size)
+      self.key = nn.Linear(config.hidden_size, self.all_head_size)
+      self.value = nn.Linear(config.hidden_size, self.all_head_size)
     # This dropout is applied to normalized attention scores following the original
     # implementation of transformer. Although it is a bit unusual, we empirically
     # observe that it yields better performance.
     self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
-  def transform(self, x, linear_layer):
+    # Which implementation of self.attention to use: "eager" (the reference below), "sdpa"
+    # (torch's scaled_dot_product_attention) or "chunked" (blocks of queries, for long inputs on CPU).
+    if config.attention_backend not in ("eager", "sdpa", "chunked"):
+      raise ValueError(f"Unknown attention_backend '{config.attention_backend}', should be one of eager, sdpa, chunked")
+    self.attention_backend = config.attention_backend
+    self.attention_chunk_size = config.attention_chunk_size
+
+  def transform(self, x, linear_layer, unpadded=None):
     # The corresponding linear_layer of k, v, q are used to project the hidden_state (x).
-    bs, seq_len = x.shape[:2]
-    proj = linear_layer(x)
+    if unpadded is None:
+      bs, seq_len = x.shape[:2]
+      proj = linear_layer(x)
+    else:
+      # x only holds the non-padding tokens [total_tokens, hidden_size]; the projection is
+      # scattered back into a padded [bs, seq_len, hidden_size] tensor for attention.
+      indices, bs, seq_len = unpadded
+      proj = pad_hidden(linear_layer(x), indices, bs, seq_len)
     # Next, we need to produce multiple heads for the proj. This is done by spliting the
     # hidden state to self.num_attention_heads, each of size self.attention_head_size.
     proj = proj.view(bs, seq_len, self.num_attention_heads, self.attention_head_size)
@@ -33,6 +79,39 @@ class BertSelfAttention(nn.Module):
     proj = proj.transpose(1, 2)
     return proj
 
+  def transform_qkv(self, x, unpadded=None):
+    # Fused counterpart of transform: a single GEMM projects x to query, key and value at once.
+    if unpadded is None:
+      bs, seq_len = x.shape[:2]
+      proj = self.qkv(x)
+    else:
+      indices, bs, seq_len = unpadded
+      proj = pad_hidden(self.qkv(x), indices, bs, seq_len)
+    # [bs, seq_len, 3, heads, head_size] -> 3 x [bs, heads, seq_len, head_size].
+    proj = proj.view(bs, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+    query, key, value = proj.permute(2, 0, 3, 1, 4).unbind(0)
+    return query, key, value
+
+  @staticmethod
+  def _fuse_qkv_state_dict(state_dict, prefix, *args):
+    # Load hook: concatenate query/key/value entries of a checkpoint into qkv.
+    for name in ("weight", "bias"):
+      keys = [f"{prefix}{layer}.{name}" for layer in ("query", "key", "value")]
+      if all(key in state_dict for key in keys):
+        state_dict[f"{prefix}qkv.{name}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+  @staticmethod
+  def _unfuse_qkv_state_dict(module, state_dict, prefix, local_metadata):
+    # Save hook: split qkv back into the query/key/value entries of the unfused layout.
+    # A quantized qkv (see quantize_dynamic_int8) has no plain weight and bias and is saved as is.
+    for name in ("weight", "bias"):
+      if f"{prefix}qkv.{name}" not in state_dict:
+        continue
+      fused = state_dict.pop(f"{prefix}qkv.{name}")
+      for layer, tensor in zip(("query", "key", "value"), fused.chunk(3, dim=0)):
+        state_dict[f"{prefix}{layer}.{name}"] = tensor
+    return state_dict
+
   def attention(self, key, query, value, attention_mask):
     # Each attention is calculated following eq. (1) of https://arxiv.org/pdf/1706.03762.pdf.
     # Attention scores are calculated by multiplying the key and query to obtain
@@ -53,26 +132,62 @@ class BertSelfAttention(nn.Module):
     S = torch.matmul(query, torch.transpose(key, -1, -2)) / self.attention_head_size ** 0.5
     S += attention_mask
     alpha = torch.nn.functional.softmax(S, -1)  # [bs, n_head, len, len]
+    alpha = self.dropout(alpha)
     # (bs, n_head, len, len) (bs, n_head, len, d/n_head) = (bs, n_head, len, d/n_head)
     head_attention = torch.matmul(alpha, value)
     attention_raw = head_attention.transpose(1,2) # (bs, len, n_head, d/n_head)
     attention = torch.flatten(attention_raw, -2)  # (bs, len, d)
     return attention
 
-  def forward(self, hidden_states, attention_mask):
+  def attention_sdpa(self, key, query, value, attention_mask):
+    # Same computation as self.attention through PyTorch's fused kernel, which can avoid
+    # materializing the score matrix. The additive mask is applied the same way.
+    head_attention = F.scaled_dot_product_attention(
+      query, key, value, attn_mask=attention_mask.to(query.dtype),
+      dropout_p=self.dropout.p if self.training else 0.0,
+    )
+    return torch.flatten(head_attention.transpose(1, 2), -2)
+
+  def attention_chunked(self, key, query, value, attention_mask):
+    # Same computation as self.attention, one block of attention_chunk_size queries at a time,
+    # so at most [bs, n_head, chunk, len] scores exist at once instead of [bs, n_head, len, len].
+    # Softmax is over keys, so each block of query rows is normalized independently.
+    key_t = torch.transpose(key, -1, -2)
+    chunks = []
+    for start in range(0, query.shape[2], self.attention_chunk_size):
+      q = query[:, :, start:start + self.attention_chunk_size]
+      S = torch.matmul(q, key_t) / self.attention_head_size ** 0.5
+      S += attention_mask
+      alpha = self.dropout(torch.nn.functional.softmax(S, -1))
+      chunks.append(torch.matmul(alpha, value))
+    head_attention = torch.cat(chunks, dim=2)
+    return torch.flatten(head_attention.transpose(1, 2), -2)
+
+  def forward(self, hidden_states, attention_mask, unpadded=None):
     """
     hidden_states: [bs, seq_len, hidden_state]
     attention_mask: [bs, 1, 1, seq_len]
-    output: [bs, seq_len, hidden_state]
+    unpadded: None, or (indices, bs, seq_len) when hidden_states is packed as [total_tokens, hidden_state]
+    output: [bs, seq_len, hidden_state] (or [total_tokens, hidden_state] if unpadded)
     """
     # First, we have to generate the key, value, query for each token for multi-head attention
     # using self.transform (more details inside the function).
     # Size of *_layer is [bs, num_attention_heads, seq_len, attention_head_size].
-    key_layer = self.transform(hidden_states, self.key)
-    value_layer = self.transform(hidden_states, self.value)
-    query_layer = self.transform(hidden_states, self.query)
+    if self.fused_qkv:
+      query_layer, key_layer, value_layer = self.transform_qkv(hidden_states, unpadded)
+    else:
+      key_layer = self.transform(hidden_states, self.key, unpadded)
+      value_layer = self.transform(hidden_states, self.value, unpadded)
+      query_layer = self.transform(hidden_states, self.query, unpadded)
     # Calculate the multi-head attention.
-    attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
+    if self.attention_backend == "sdpa":
+      attn_value = self.attention_sdpa(key_layer, query_layer, value_layer, attention_mask)
+    elif self.attention_backend == "chunked":
+      attn_value = self.attention_chunked(key_layer, query_layer, value_layer, attention_mask)
+    else:
+      attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
+    if unpadded is not None:
+      attn_value = unpad_hidden(attn_value, unpadded[0])
     return attn_value
 
 
@@ -108,10 +223,12 @@ class BertLayer(nn.Module):
     return ln_layer(input + dropout(dense_layer(output)))
 
 
-  def forward(self, hidden_states, attention_mask):
+  def forward(self, hidden_states, attention_mask, unpadded=None):
     """
     hidden_states: either from the embedding layer (first BERT layer) or from the previous BERT layer
     as shown in the left of Figure 1 of https://arxiv.org/pdf/1706.03762.pdf.
+    If unpadded is given, hidden_states holds only the non-padding tokens (see BertModel.encode);
+    every step except attention works token by token, so only attention needs to know.
     Each block consists of:
     1. A multi-head attention layer (BertSelfAttention).
     2. An add-norm operation that takes the input and output of the multi-head attention layer.
@@ -119,7 +236,7 @@ class BertLayer(nn.Module):
     4. An add-norm operation that takes the input and output of the feed forward layer.
     """
     ### TODO
-    mh = self.self_attention(hidden_states, attention_mask)
+    mh = self.self_attention(hidden_states, attention_mask, unpadded)
     h_prime = self.add_norm(hidden_states, mh, self.attention_dense, self.attention_dropout, self.attention_layer_norm)
     out_raw = self.interm_af(self.interm_dense(h_prime))
     out = self.add_norm(h_prime, out_raw, self.out_dense, self.out_dropout, self.out_layer_norm)
@@ -195,13 +312,28 @@ class BertModel(BertPreTrainedModel):
     # Returns extended_attention_mask of size [batch_size, 1, 1, seq_len].
     # Distinguishes between non-padding tokens (with a value of 0) and padding tokens
     # (with a value of a large negative number).
-    extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, self.dtype)
+    # Under autocast the scores are computed in the autocast dtype (e.g. bf16), so build the mask in it.
+    device_type = hidden_states.device.type
+    dtype = autocast_dtype(device_type) or self.dtype
+    extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, dtype)
+
+    # In unpadded mode the non-padding tokens of the whole batch are packed into one
+    # [total_tokens, hidden_size] tensor, so the dense and LayerNorm layers skip the padding;
+    # attention re-pads per layer. Padding positions of the output are zero.
+    unpadded = None
+    if self.config.unpadded_encoder and not bool(attention_mask.all()):
+      bs, seq_len = attention_mask.shape
+      indices = attention_mask.flatten().nonzero().squeeze(-1)
+      unpadded = (indices, bs, seq_len)
+      hidden_states = unpad_hidden(hidden_states, indices)
 
     # Pass the hidden states through the encoder layers.
     for i, layer_module in enumerate(self.bert_layers):
       # Feed the encoding from the last bert_layer to the next.
-      hidden_states = layer_module(hidden_states, extended_attention_mask)
+      hidden_states = layer_module(hidden_states, extended_attention_mask, unpadded)
 
+    if unpadded is not None:
+      hidden_states = pad_hidden(hidden_states, *unpadded)
     return hidden_states
 
   def forward(self, input_ids, attention_mask):
@@ -221,3 +353,43 @@ class BertModel(BertPreTrainedModel):
     first_tk = self.pooler_af(first_tk)
 
     return {'last_hidden_state': sequence_output, 'pooler_output': first_tk}
+
+
+def quantize_dynamic_int8(model):
+  """
+  Inference-only copy of model in which every nn.Linear (query/key/value or the fused qkv,
+  attention_dense, interm_dense, out_dense, pooler_dense and any task heads on top) stores
+  int8 weights and quantizes its input on the fly; embeddings and LayerNorms stay fp32.
+  Uses PyTorch dynamic quantization, so the result runs on CPU only.
+  """
+  return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+  h = hashlib.sha256()
+  with open(filepath, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def load_int8_model(filepath, load_model):
+  """
+  (model, config) of the int8 copy of the checkpoint at filepath, quantized with
+  quantize_dynamic_int8. The quantized module is saved as a whole next to the checkpoint,
+  together with a SHA-256 of the checkpoint file, and reused only while the checkpoint
+  still has that content; timestamps are not trusted, since copies and restores keep them.
+  load_model() loads the fp32 (model, config) when the copy has to be (re)built.
+  """
+  int8_path = os.path.splitext(filepath)[0] + '-int8.pt'
+  digest = file_digest(filepath)
+  if os.path.exists(int8_path):
+    saved = torch.load(int8_path, weights_only=False)
+    if saved.get('checkpoint_sha256') == digest:
+      print(f"Loaded int8 model from {int8_path}")
+      return saved['model'], saved['model_config']
+  model, config = load_model()
+  model = quantize_dynamic_int8(model.eval())
+  torch.save({'model': model, 'model_config': config, 'checkpoint_sha256': digest}, int8_path)
+  print(f"save the int8 model to {int8_path}")
+  return model, config
@@ -1,15 +1,19 @@
 import random, numpy as np, argparse
 from types import SimpleNamespace
 import csv
+import os
+import time
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from sklearn.metrics import f1_score, accuracy_score
 
-from tokenizer import BertTokenizer
-from bert import BertModel
+from datasets import SharedTokenizerDataset
+from tokenizer import get_shared_tokenizer
+from bert import BertModel, load_int8_model
 from optimizer import AdamW
+from feature_cache import CachedFeatureDataset, checkpoint_hash, encode_features
 from tqdm import tqdm
 
 
@@ -60,15 +64,33 @@ class BertSentimentClassifier(torch.nn.Module):
         # the training loop currently uses F.cross_entropy as the loss function.
         ### TODO
         pooler_output = self.bert(input_ids, attention_mask)['pooler_output']
+        return self.head(pooler_output)
+
+
+    def head(self, pooler_output):
+        '''The classification head alone, also used on cached BERT features (see feature_cache.py).'''
         return self.dense(self.dropout(pooler_output))
 
 
+def predict(model, batch, device):
+    '''fp32 logits for a batch of token ids or of cached BERT features, also under bf16 autocast.'''
+    if 'features' in batch:
+        return model.head(batch['features'][0].to(device, non_blocking=True)).float()
+    return model(batch['token_ids'].to(device, non_blocking=True),
+                 batch['attention_mask'].to(device, non_blocking=True)).float()
+
+
+def autocast(args, device):
+    '''bf16 autocast for precision bf16; weights, gradients and AdamW state stay fp32.'''
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
 
-class SentimentDataset(Dataset):
+
+
+class SentimentDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
 
     def __len__(self):
         return len(self.dataset)
@@ -102,11 +124,11 @@ class SentimentDataset(Dataset):
         return batched_data
 
 
-class SentimentTestDataset(Dataset):
+class SentimentTestDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
 
     def __len__(self):
         return len(self.dataset)
@@ -164,6 +186,17 @@ def load_data(filename, flag='train'):
         return data
 
 
+def build_dataloader(dataset, args, shuffle):
+    '''
+    DataLoader that tokenizes batches in args.num_workers background processes, each keeping
+    up to args.prefetch_factor batches ready, so tokenization overlaps the model's steps.
+    Batches are pinned for asynchronous copies to the GPU.
+    '''
+    return DataLoader(dataset, shuffle=shuffle, batch_size=args.batch_size, collate_fn=dataset.collate_fn,
+                      num_workers=args.num_workers, pin_memory=args.use_gpu,
+                      prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None)
+
+
 # Evaluate the model on dev examples.
 def model_eval(dataloader, model, device):
     model.eval() # Switch to eval model, will turn off randomness like dropout.
@@ -172,13 +205,9 @@ def model_eval(dataloader, model, device):
     sents = []
     sent_ids = []
     for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        b_ids, b_mask, b_labels, b_sents, b_sent_ids = batch['token_ids'],batch['attention_mask'],  \
-                                                        batch['labels'], batch['sents'], batch['sent_ids']
+        b_labels, b_sents, b_sent_ids = batch['labels'], batch['sents'], batch['sent_ids']
 
-        b_ids = b_ids.to(device)
-        b_mask = b_mask.to(device)
-
-        logits = model(b_ids, b_mask)
+        logits = predict(model, batch, device)
         logits = logits.detach().cpu().numpy()
         preds = np.argmax(logits, axis=1).flatten()
 
@@ -201,13 +230,9 @@ def model_test_eval(dataloader, model, device):
     sents = []
     sent_ids = []
     for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        b_ids, b_mask, b_sents, b_sent_ids = batch['token_ids'],batch['attention_mask'],  \
-                                                         batch['sents'], batch['sent_ids']
-
-        b_ids = b_ids.to(device)
-        b_mask = b_mask.to(device)
+        b_sents, b_sent_ids = batch['sents'], batch['sent_ids']
 
-        logits = model(b_ids, b_mask)
+        logits = predict(model, batch, device)
         logits = logits.detach().cpu().numpy()
         preds = np.argmax(logits, axis=1).flatten()
 
@@ -218,9 +243,30 @@ def model_test_eval(dataloader, model, device):
     return y_pred, sents, sent_ids
 
 
+def build_feature_loader(model, dataset, args, device, model_hash, shuffle):
+    '''
+    Run the frozen BERT of `model` once over `dataset` (or load the result from
+    args.feature_cache_dir) and return a loader over the cached pooler outputs instead.
+    '''
+    loader = build_dataloader(dataset, args, shuffle=False)
+    features = encode_features(model.bert, loader, [('token_ids', 'attention_mask')], args.feature_cache_dir,
+                               model_hash, device)
+    labeled = isinstance(dataset, SentimentDataset)
+    feature_dataset = CachedFeatureDataset(features,
+                                           [x[1] for x in dataset.dataset] if labeled else None,
+                                           [x[-1] for x in dataset.dataset],
+                                           sents=[x[0] for x in dataset.dataset])
+    return DataLoader(feature_dataset, shuffle=shuffle, batch_size=args.batch_size,
+                      collate_fn=feature_dataset.collate_fn)
+
+
 def save_model(model, optimizer, args, config, filepath):
+    model_state = model.state_dict()
+    if config.fine_tune_mode == 'last-linear-layer':
+        # BERT is frozen at its pretrained weights, which from_pretrained restores when loading.
+        model_state = {k: v for k, v in model_state.items() if not k.startswith('bert.')}
     save_info = {
-        'model': model.state_dict(),
+        'model': model_state,
         'optim': optimizer.state_dict(),
         'args': args,
         'model_config': config,
@@ -242,10 +288,8 @@ def train(args):
     train_dataset = SentimentDataset(train_data, args)
     dev_dataset = SentimentDataset(dev_data, args)
 
-    train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=args.batch_size,
-                                  collate_fn=train_dataset.collate_fn)
-    dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size,
-                                collate_fn=dev_dataset.collate_fn)
+    train_dataloader = build_dataloader(train_dataset, args, shuffle=True)
+    dev_dataloader = build_dataloader(dev_dataset, args, shuffle=False)
 
     # Init model.
     config = {'hidden_dropout_prob': args.hidden_dropout_prob,
@@ -259,8 +303,15 @@ def train(args):
     model = BertSentimentClassifier(config)
     model = model.to(device)
 
+    if args.cache_features:
+        # BERT is frozen, so its outputs are computed once and only the head sees each batch.
+        model_hash = checkpoint_hash(model.bert)
+        train_dataloader = build_feature_loader(model, train_dataset, args, device, model_hash, shuffle=True)
+        dev_dataloader = build_feature_loader(model, dev_dataset, args, device, model_hash, shuffle=False)
+
     lr = args.lr
-    optimizer = AdamW(model.parameters(), lr=lr)
+    optimizer = AdamW(model.parameters(), lr=lr, foreach=args.optimizer_impl == 'foreach',
+                      flat=args.optimizer_impl == 'flat')
     best_dev_acc = 0
 
     # Run for the specified number of epochs.
@@ -269,15 +320,11 @@ def train(args):
         train_loss = 0
         num_batches = 0
         for batch in tqdm(train_dataloader, desc=f'train-{epoch}', disable=TQDM_DISABLE):
-            b_ids, b_mask, b_labels = (batch['token_ids'], # (batch_size, seq_len)
-                                       batch['attention_mask'], batch['labels']) # (batch_size,)
-
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
-            b_labels = b_labels.to(device)
+            b_labels = batch['labels'].to(device, non_blocking=True) # (batch_size,)
 
             optimizer.zero_grad()
-            logits = model(b_ids, b_mask) # (batch_size, num_labels)
+            with autocast(args, device):
+                logits = predict(model, batch, device) # (batch_size, num_labels)
             loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
 
             loss.backward()
@@ -288,8 +335,9 @@ def train(args):
 
         train_loss = train_loss / (num_batches)
 
-        train_acc, train_f1, *_  = model_eval(train_dataloader, model, device)
-        dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device)
+        with autocast(args, device):
+            train_acc, train_f1, *_  = model_eval(train_dataloader, model, device)
+            dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device)
 
         if dev_acc > best_dev_acc:
             best_dev_acc = dev_acc
@@ -298,28 +346,51 @@ def train(args):
         print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}")
 
 
-def test(args):
-    with torch.no_grad():
-        device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+def load_test_model(args, device):
+    '''
+    The trained model at args.filepath. With --int8 it is the dynamically quantized copy
+    (see bert.load_int8_model), cached next to the checkpoint.
+    '''
+    def load_model():
         saved = torch.load(args.filepath, map_location=device, weights_only=False)
         config = saved['model_config']
         model = BertSentimentClassifier(config)
-        model.load_state_dict(saved['model'])
-        model = model.to(device)
+        # Checkpoints of last-linear-layer runs leave out the frozen, pretrained BERT weights.
+        model_state = model.state_dict()
+        model_state.update(saved['model'])
+        model.load_state_dict(model_state)
         print(f"load model from {args.filepath}")
+        return model, config
+
+    if args.int8:
+        return load_int8_model(args.filepath, load_model)[0]
+    return load_model()[0].to(device)
+
+
+def test(args):
+    with torch.no_grad():
+        device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+        model = load_test_model(args, device)
         
         dev_data = load_data(args.dev, 'valid')
         dev_dataset = SentimentDataset(dev_data, args)
-        dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=dev_dataset.collate_fn)
+        dev_dataloader = build_dataloader(dev_dataset, args, shuffle=False)
 
         test_data = load_data(args.test, 'test')
         test_dataset = SentimentTestDataset(test_data, args)
-        test_dataloader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=test_dataset.collate_fn)
-        
-        dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device)
-        print('DONE DEV')
-        test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device)
-        print('DONE Test')
+        test_dataloader = build_dataloader(test_dataset, args, shuffle=False)
+
+        if args.cache_features:
+            model_hash = checkpoint_hash(model.bert)
+            dev_dataloader = build_feature_loader(model, dev_dataset, args, device, model_hash, shuffle=False)
+            test_dataloader = build_feature_loader(model, test_dataset, args, device, model_hash, shuffle=False)
+
+        start = time.perf_counter()
+        with autocast(args, device):
+            dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device)
+            print(f'DONE DEV in {time.perf_counter() - start :.1f}s')
+            test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device)
+            print('DONE Test')
         with open(args.dev_out, "w+") as f:
             print(f"dev acc :: {dev_acc :.3f}")
             f.write(f"id \t Predicted_Sentiment \n")
@@ -340,13 +411,32 @@ def get_args():
                         help='last-linear-layer: the BERT parameters are frozen and the task specific head parameters are updated; full-model: BERT parameters are updated as well',
                         choices=('last-linear-layer', 'full-model'), default="last-linear-layer")
     parser.add_argument("--use_gpu", action='store_true')
+    parser.add_argument("--precision", type=str, choices=('fp32', 'bf16'), default='fp32',
+                        help='bf16: run forward passes under bf16 autocast, keeping fp32 weights and optimizer state')
 
     parser.add_argument("--batch_size", help='sst: 64, cfimdb: 8 can fit a 12GB GPU', type=int, default=8)
     parser.add_argument("--hidden_dropout_prob", type=float, default=0.3)
+    parser.add_argument("--optimizer_impl", type=str, choices=('loop', 'foreach', 'flat'), default='loop',
+                        help='loop: per-parameter AdamW updates; foreach: multi-tensor torch._foreach_* ops; flat: one contiguous buffer per dtype updated chunk by chunk (all three give the same results)')
     parser.add_argument("--lr", type=float, help="learning rate, default lr for 'pretrain': 1e-3, 'finetune': 1e-5",
                         default=1e-3)
+    parser.add_argument('--cache_features', action='store_true',
+                        help='with --fine-tune-mode last-linear-layer, run BERT once per split and train the head on cached pooler outputs')
+    parser.add_argument('--feature_cache_dir', type=str, default='.feature_cache')
+    parser.add_argument('--int8', action='store_true',
+                        help='test with dynamically quantized int8 linear layers (CPU only); the quantized model is saved next to the checkpoint')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='DataLoader worker processes that tokenize batches in the background; 0 tokenizes in the training loop')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches each worker keeps ready, bounding the prefetch queue')
 
     args = parser.parse_args()
+    if args.int8 and (args.use_gpu or args.precision != 'fp32' or args.cache_features):
+        parser.error('--int8 runs on CPU in fp32 and cannot be combined with --use_gpu, --precision bf16 or --cache_features')
+    if args.cache_features and args.fine_tune_mode != 'last-linear-layer':
+        parser.error('--cache_features requires --fine-tune-mode last-linear-layer')
+    if args.num_workers < 0 or args.prefetch_factor < 1:
+        parser.error('--num_workers must not be negative and --prefetch_factor must be at least 1')
     return args
 
 
@@ -359,6 +449,8 @@ if __name__ == "__main__":
         filepath='sst-classifier.pt',
         lr=args.lr,
         use_gpu=args.use_gpu,
+        precision=args.precision,
+        optimizer_impl=args.optimizer_impl,
         epochs=args.epochs,
         batch_size=args.batch_size,
         hidden_dropout_prob=args.hidden_dropout_prob,
@@ -366,6 +458,11 @@ if __name__ == "__main__":
         dev='data/ids-sst-dev.csv',
         test='data/ids-sst-test-student.csv',
         fine_tune_mode=args.fine_tune_mode,
+        cache_features=args.cache_features,
+        feature_cache_dir=args.feature_cache_dir,
+        int8=args.int8,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
         dev_out = 'predictions/' + args.fine_tune_mode + '-sst-dev-out.csv',
         test_out = 'predictions/' + args.fine_tune_mode + '-sst-test-out.csv'
     )
@@ -380,6 +477,8 @@ if __name__ == "__main__":
         filepath='cfimdb-classifier.pt',
         lr=args.lr,
         use_gpu=args.use_gpu,
+        precision=args.precision,
+        optimizer_impl=args.optimizer_impl,
         epochs=args.epochs,
         batch_size=8,
         hidden_dropout_prob=args.hidden_dropout_prob,
@@ -387,6 +486,11 @@ if __name__ == "__main__":
         dev='data/ids-cfimdb-dev.csv',
         test='data/ids-cfimdb-test-student.csv',
         fine_tune_mode=args.fine_tune_mode,
+        cache_features=args.cache_features,
+        feature_cache_dir=args.feature_cache_dir,
+        int8=args.int8,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
         dev_out = 'predictions/' + args.fine_tune_mode + '-cfimdb-dev-out.csv',
         test_out = 'predictions/' + args.fine_tune_mode + '-cfimdb-test-out.csv'
     )
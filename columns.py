@@ -0,0 +1,168 @@
+'''
+Compact columnar storage for the multitask datasets.
+
+The Quora training split alone has hundreds of thousands of pairs, and keeping them as
+Python tuples of str costs several objects per example. load_multitask_data in
+datasets.py streams each TSV file in chunks into the columns defined here instead:
+
+* StringColumn: UTF-8 text in one byte buffer plus an int64 offsets array, as
+  datasets.TokenCache stores token ids.
+* CategoricalColumn: int32 codes into a StringColumn of the distinct values, for the
+  example ids.
+* TaskData: the columns of one task split, plus a numpy array of labels.
+
+Integer indexing decodes a single value; indexing with a list or array of indices decodes
+a batch, and slicing returns a view over the same buffers. Since every column is a few
+flat arrays, a TaskData is cheap to pickle and can be saved as .npy files and
+memory-mapped back (see datasets.load_task_files).
+'''
+
+import numpy as np
+
+
+class StringColumn:
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        builder = StringColumnBuilder()
+        builder.extend(strings)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                # Sentence i still spans data[offsets[i]:offsets[i + 1]], so the buffer is shared.
+                return StringColumn(self.data, self.offsets[start:max(start, stop) + 1])
+            return StringColumn.from_strings(self[list(range(start, stop, step))])
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+        return [self[int(i)] for i in idx]
+
+    def __iter__(self):
+        data, offsets = self.data, self.offsets
+        for i in range(len(self)):
+            yield data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+
+class StringColumnBuilder:
+    '''Collects strings chunk by chunk and joins them into a StringColumn once at the end.'''
+    def __init__(self):
+        self.parts = []
+        self.lengths = []
+
+    def extend(self, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.parts.append(b''.join(encoded))
+        self.lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+
+    def build(self):
+        offsets = np.zeros(sum(len(lengths) for lengths in self.lengths) + 1, dtype=np.int64)
+        if self.lengths:
+            np.cumsum(np.concatenate(self.lengths), out=offsets[1:])
+        return StringColumn(np.frombuffer(b''.join(self.parts), dtype=np.uint8), offsets)
+
+
+class CategoricalColumn:
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return CategoricalColumn(self.codes[idx], self.categories)
+        if isinstance(idx, (int, np.integer)):
+            return self.categories[int(self.codes[idx])]
+        return [self.categories[int(code)] for code in self.codes[np.asarray(idx, dtype=np.int64)]]
+
+    def __iter__(self):
+        for code in self.codes:
+            yield self.categories[int(code)]
+
+
+class CategoricalColumnBuilder:
+    '''Assigns each distinct value a code as chunks of values come in.'''
+    def __init__(self):
+        self.code_of = {}
+        self.codes = []
+
+    def extend(self, values):
+        code_of = self.code_of
+        self.codes.append(np.fromiter((code_of.setdefault(v, len(code_of)) for v in values),
+                                      dtype=np.int32, count=len(values)))
+
+    def build(self):
+        codes = np.concatenate(self.codes) if self.codes else np.zeros(0, dtype=np.int32)
+        # Dicts keep insertion order, which is the order of the codes.
+        return CategoricalColumn(codes, StringColumn.from_strings(list(self.code_of)))
+
+
+class TaskData:
+    '''
+    The examples of one task split: `sents`, a list with one StringColumn per sentence of
+    an example (one for SST, two for Quora and STS), `labels`, a numpy array (None for test
+    splits), and `ids`, a CategoricalColumn.
+
+    data[i] is the example tuple (sentence, [sentence2,] [label,] id) that the splits used
+    to be lists of, so code written for those lists keeps working; the Dataset classes in
+    datasets.py read the columns directly. data[a:b] is a TaskData view of those examples.
+    '''
+    def __init__(self, sents, labels, ids):
+        self.sents = sents
+        self.labels = labels
+        self.ids = ids
+
+    @classmethod
+    def from_examples(cls, examples, num_sents, labeled):
+        '''TaskData of a list of example tuples in the layout described above.'''
+        examples = list(examples)
+        sents = [StringColumn.from_strings([x[i] for x in examples]) for i in range(num_sents)]
+        labels = np.array([x[num_sents] for x in examples]) if labeled else None
+        ids = CategoricalColumnBuilder()
+        ids.extend([x[-1] for x in examples])
+        return cls(sents, labels, ids.build())
+
+    def arrays(self):
+        '''The numpy arrays holding the columns, by name, for writing them to disk.'''
+        arrays = {'ids.codes': self.ids.codes, 'ids.data': self.ids.categories.data,
+                  'ids.offsets': self.ids.categories.offsets}
+        for i, column in enumerate(self.sents):
+            # A sliced column starts partway into its buffer; store just its own strings.
+            start, stop = column.offsets[0], column.offsets[-1]
+            arrays[f'sents{i}.data'] = column.data[start:stop]
+            arrays[f'sents{i}.offsets'] = column.offsets - start
+        if self.labels is not None:
+            arrays['labels'] = self.labels
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, num_sents):
+        '''TaskData of arrays as returned by arrays(), e.g. memory-mapped from disk.'''
+        sents = [StringColumn(arrays[f'sents{i}.data'], arrays[f'sents{i}.offsets']) for i in range(num_sents)]
+        ids = CategoricalColumn(arrays['ids.codes'], StringColumn(arrays['ids.data'], arrays['ids.offsets']))
+        return cls(sents, arrays.get('labels'), ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return TaskData([column[idx] for column in self.sents],
+                            None if self.labels is None else self.labels[idx], self.ids[idx])
+        label = () if self.labels is None else (self.labels[idx].item(),)
+        return tuple(column[idx] for column in self.sents) + label + (self.ids[idx],)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -201,6 +201,10 @@ class BertConfig(PretrainedConfig):
     gradient_checkpointing=False,
     position_embedding_type="absolute",
     use_cache=True,
+    unpadded_encoder=False,
+    fused_qkv=False,
+    attention_backend="eager",
+    attention_chunk_size=64,
     **kwargs
   ):
     super().__init__(pad_token_id=pad_token_id, **kwargs)
@@ -220,3 +224,10 @@ class BertConfig(PretrainedConfig):
     self.gradient_checkpointing = gradient_checkpointing
     self.position_embedding_type = position_embedding_type
     self.use_cache = use_cache
+    # Run the encoder's dense and LayerNorm layers on the non-padding tokens only (see BertModel.encode).
+    self.unpadded_encoder = unpadded_encoder
+    # Compute query, key and value with a single fused projection (see BertSelfAttention).
+    self.fused_qkv = fused_qkv
+    # Attention implementation ("eager", "sdpa" or "chunked") and the query block size of "chunked".
+    self.attention_backend = attention_backend
+    self.attention_chunk_size = attention_chunk_size
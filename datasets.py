@@ -9,43 +9,327 @@ examples are preprocessed.
 '''
 
 import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
-from tokenizer import BertTokenizer
+from torch.utils.data import Dataset, Sampler
+
+from columns import CategoricalColumnBuilder, StringColumnBuilder, TaskData
+from tokenizer import get_shared_tokenizer
+
+
+PUNCTUATION_SPACING = str.maketrans({'.': ' .', '?': ' ?', ',': ' ,', '\'': ' \''})
 
 
 def preprocess_string(s):
-    return ' '.join(s.lower()
-                    .replace('.', ' .')
-                    .replace('?', ' ?')
-                    .replace(',', ' ,')
-                    .replace('\'', ' \'')
-                    .split())
+    # One translate pass does what chained replace('.', ' .') etc. calls did.
+    return ' '.join(s.lower().translate(PUNCTUATION_SPACING).split())
+
+
+def preprocess_sentiment(s):
+    return s.lower().strip()
+
+
+def parse_duplicate_label(value):
+    return int(float(value))
+
+
+class TokenCache:
+    '''
+    Pre-tokenized sentences stored as one flat int32 array of WordPiece ids plus an
+    int64 offsets array, so sentence i is ids[offsets[i]:offsets[i + 1]]. Ids do not
+    include [CLS]/[SEP]; those are added when a batch is padded.
+
+    When a cache directory is given, the arrays are written there once and memory-mapped
+    on later runs. The file name is a hash of the vocabulary, the lowercasing and
+    truncation settings and the sentences themselves, so changing any of them builds a
+    fresh cache. A cache backed by such files pickles as its path, so DataLoader workers
+    map the files again instead of receiving a copy of the arrays.
+    '''
+    def __init__(self, ids, offsets, path=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.path = path
 
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        if 'ids' in state:
+            self.__dict__.update(state)
+        else:
+            self.__init__(*self.load(state['path']), state['path'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def cache_key(sents, tokenizer, max_length):
+        h = hashlib.sha256()
+        h.update('\n'.join(tokenizer.vocab).encode('utf-8'))
+        h.update(f'lower={tokenizer.do_lower_case};max_length={max_length}'.encode('utf-8'))
+        for sent in sents:
+            h.update(sent.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()[:32]
+
+    @staticmethod
+    def load(path):
+        return np.load(path + '.ids.npy', mmap_mode='r'), np.load(path + '.offsets.npy', mmap_mode='r')
+
+    @staticmethod
+    def encode(sents, tokenizer, num_procs=1):
+        '''
+        WordPiece ids of each sentence. With num_procs > 1, large inputs are tokenized by the
+        tokenizer's process pool (see PreTrainedTokenizer._batch_encode_plus), which is shut
+        down again afterwards.
+        '''
+        if num_procs <= 1:
+            return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(sent)) for sent in sents]
+        try:
+            return tokenizer.batch_encode_plus(list(sents), add_special_tokens=False, return_token_type_ids=False,
+                                               return_attention_mask=False, verbose=False,
+                                               num_workers=num_procs)['input_ids']
+        finally:
+            tokenizer.close_encode_pool()
+
+    @classmethod
+    def build(cls, sents, tokenizer, cache_dir=None, num_procs=1):
+        # Leave room for [CLS] and [SEP]; pairs are truncated further in pad_pair.
+        max_length = tokenizer.model_max_length - tokenizer.num_special_tokens_to_add(pair=False)
+
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, cls.cache_key(sents, tokenizer, max_length))
+            if os.path.exists(path + '.offsets.npy'):
+                return cls(*cls.load(path), path)
+
+        offsets = np.zeros(len(sents) + 1, dtype=np.int64)
+        chunks = []
+        for i, ids in enumerate(cls.encode(sents, tokenizer, num_procs)):
+            ids = ids[:max_length]
+            chunks.append(ids)
+            offsets[i + 1] = offsets[i] + len(ids)
+        ids = np.fromiter((t for chunk in chunks for t in chunk), dtype=np.int32, count=offsets[-1])
+
+        if cache_dir is None:
+            return cls(ids, offsets)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to temporary names first so a crashed run never leaves a partial cache;
+        # the offsets file is moved last because its presence marks the cache complete.
+        pid = os.getpid()
+        np.save(f'{path}.ids.{pid}.npy', ids)
+        np.save(f'{path}.offsets.{pid}.npy', offsets)
+        os.replace(f'{path}.ids.{pid}.npy', path + '.ids.npy')
+        os.replace(f'{path}.offsets.{pid}.npy', path + '.offsets.npy')
+        return cls(*cls.load(path), path)
+
+
+class SharedTokenizerDataset(Dataset):
+    '''
+    Base class for datasets holding a get_shared_tokenizer('bert-base-uncased') instance in
+    self.tokenizer. The tokenizer is left out when the dataset is pickled, e.g. into spawned
+    DataLoader workers together with its bound collate_fn, and the copy fetches the shared
+    instance of its own process instead.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('tokenizer', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
+
+
+def pad_single(tokenizer, seqs):
+    '''Add [CLS]/[SEP] to each id sequence and pad the batch to its longest sequence.'''
+    max_len = max(len(ids) for ids in seqs) + 2
+    token_ids = np.full((len(seqs), max_len), tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(seqs), max_len), dtype=np.int64)
+    for i, ids in enumerate(seqs):
+        n = len(ids)
+        token_ids[i, 0] = tokenizer.cls_token_id
+        token_ids[i, 1:n + 1] = ids
+        token_ids[i, n + 1] = tokenizer.sep_token_id
+        attention_mask[i, :n + 2] = 1
+    token_type_ids = np.zeros_like(token_ids)
+    return torch.from_numpy(token_ids), torch.from_numpy(attention_mask), torch.from_numpy(token_type_ids)
+
+
+def pad_pair(tokenizer, seqs1, seqs2):
+    '''
+    Build "[CLS] a [SEP] b [SEP]" for each pair and pad the batch to its longest pair.
+    Over-long pairs are truncated longest-first, matching BertTokenizer(truncation=True).
+    '''
+    max_pair_len = tokenizer.model_max_length - tokenizer.num_special_tokens_to_add(pair=True)
+    pairs = []
+    for a, b in zip(seqs1, seqs2):
+        n_a, n_b = len(a), len(b)
+        for _ in range(n_a + n_b - max_pair_len):
+            if n_a > n_b:
+                n_a -= 1
+            else:
+                n_b -= 1
+        pairs.append((a[:n_a], b[:n_b]))
+
+    max_len = max(len(a) + len(b) for a, b in pairs) + 3
+    token_ids = np.full((len(pairs), max_len), tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(pairs), max_len), dtype=np.int64)
+    token_type_ids = np.zeros((len(pairs), max_len), dtype=np.int64)
+    for i, (a, b) in enumerate(pairs):
+        n_a, n_b = len(a), len(b)
+        token_ids[i, 0] = tokenizer.cls_token_id
+        token_ids[i, 1:n_a + 1] = a
+        token_ids[i, n_a + 1] = tokenizer.sep_token_id
+        token_ids[i, n_a + 2:n_a + n_b + 2] = b
+        token_ids[i, n_a + n_b + 2] = tokenizer.sep_token_id
+        attention_mask[i, :n_a + n_b + 3] = 1
+        token_type_ids[i, n_a + 2:n_a + n_b + 3] = 1
+    return torch.from_numpy(token_ids), torch.from_numpy(attention_mask), torch.from_numpy(token_type_ids)
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Yields batches of dataset indices grouped by similar token length, so that little of
+    each batch is padding.
+
+    With shuffle=True (training), the indices are shuffled, cut into pools of
+    batch_size * bucket_multiplier examples, each pool is sorted by length and cut into
+    batches, and the batches of all pools are shuffled again. Batches therefore mix
+    examples from anywhere in the dataset and come in random length order. With
+    shuffle=False (evaluation), the whole dataset is sorted by length; the 'indices' of
+    each batch map predictions back to the original order.
+
+    If max_tokens is given, batches are not cut at batch_size examples but filled until
+    another example would make (examples x longest length) exceed max_tokens, so batches
+    of short sentences hold more examples than batches of long ones.
+
+    Shuffling draws from `generator` if given, otherwise from the global torch RNG.
+
+    For data-parallel training, every one of num_replicas processes draws the same batches
+    (their generators are seeded alike) and keeps every num_replicas-th of them, starting at
+    its rank, like DistributedSampler does with examples. The last few batches are dropped
+    so that all ranks get as many.
+    '''
+    def __init__(self, lengths, batch_size, bucket_multiplier=100, shuffle=True, max_tokens=None, generator=None,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * bucket_multiplier
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def split(self, pool):
+        '''Cut a length-sorted array of indices into batches.'''
+        if self.max_tokens is None:
+            return [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        batches = []
+        start = 0
+        for end in range(1, len(pool) + 1):
+            # The pool is sorted, so the last example is the longest of the candidate batch.
+            if end - start > 1 and (end - start) * self.lengths[pool[end - 1]] > self.max_tokens:
+                batches.append(pool[start:end - 1])
+                start = end - 1
+        batches.append(pool[start:])
+        return batches
+
+    def batches(self):
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            return [batch.tolist() for batch in self.split(order)]
+
+        order = torch.randperm(len(self.lengths), generator=self.generator).numpy()
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            batches.extend(self.split(pool[np.argsort(self.lengths[pool], kind='stable')]))
+        return [batches[i].tolist() for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.num_replicas > 1:
+            batches = batches[self.rank:len(batches) - len(batches) % self.num_replicas:self.num_replicas]
+        return iter(batches)
+
+    def __len__(self):
+        if self.max_tokens is not None:
+            # Shuffled pools give a slightly different count every epoch; the sorted split is
+            # a close estimate.
+            n_batches = len(self.split(np.argsort(self.lengths, kind='stable')))
+        else:
+            # Pools are batched separately, so each pool may end with a short batch.
+            n_full_pools, rest = divmod(len(self.lengths), self.pool_size) if self.shuffle else (0, len(self.lengths))
+            per_pool = (self.pool_size + self.batch_size - 1) // self.batch_size
+            n_batches = n_full_pools * per_pool + (rest + self.batch_size - 1) // self.batch_size
+        return n_batches // self.num_replicas
+
+
+class CachedBatches:
+    '''
+    The batches of a loader, collated once and kept in memory (pinned if the loader pins
+    them). Iterating again costs no tokenization or padding, so evaluation sets scored
+    every epoch only pay for the model.
+    '''
+    def __init__(self, loader):
+        self.dataset = loader.dataset
+        self.batches = list(loader)
+
+    def __iter__(self):
+        return iter(self.batches)
 
-class SentenceClassificationDataset(Dataset):
+    def __len__(self):
+        return len(self.batches)
+
+
+def padding_ratio(lengths, batches):
+    '''Fraction of the padded [batch, max_len] token grid that is padding.'''
+    lengths = np.asarray(lengths)
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    return 1 - real / padded
+
+
+class SentenceClassificationDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args):
-        self.dataset = dataset
+        self.dataset = as_task_data(dataset, num_sents=1, labeled=True)
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
+        self.tokens = TokenCache.build(self.dataset.sents[0], self.tokenizer,
+                                       getattr(args, 'token_cache_dir', None), getattr(args, 'tokenize_procs', 1))
+        # Padded length of each example: sentence plus [CLS] and [SEP].
+        self.lengths = self.tokens.lengths() + 2
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        # Batches are read from the columns of self.dataset and the token cache by index.
+        return idx
 
     def pad_data(self, data):
 
-        sents = [x[0] for x in data]
-        labels = [x[1] for x in data]
-        sent_ids = [x[2] for x in data]
+        sents = self.dataset.sents[0][data]
+        labels = torch.as_tensor(self.dataset.labels[data], dtype=torch.long)
+        sent_ids = self.dataset.ids[data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
-        labels = torch.LongTensor(labels)
+        token_ids, attention_mask, _ = pad_single(self.tokenizer, [self.tokens[i] for i in data])
 
         return token_ids, attention_mask, labels, sents, sent_ids
 
@@ -57,32 +341,35 @@ class SentenceClassificationDataset(Dataset):
                 'attention_mask': attention_mask,
                 'labels': labels,
                 'sents': sents,
-                'sent_ids': sent_ids
+                'sent_ids': sent_ids,
+                'indices': list(all_data)
             }
 
         return batched_data
 
 
 # Unlike SentenceClassificationDataset, we do not load labels in SentenceClassificationTestDataset.
-class SentenceClassificationTestDataset(Dataset):
+class SentenceClassificationTestDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args):
-        self.dataset = dataset
+        self.dataset = as_task_data(dataset, num_sents=1, labeled=False)
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
+        self.tokens = TokenCache.build(self.dataset.sents[0], self.tokenizer,
+                                       getattr(args, 'token_cache_dir', None), getattr(args, 'tokenize_procs', 1))
+        # Padded length of each example: sentence plus [CLS] and [SEP].
+        self.lengths = self.tokens.lengths() + 2
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return idx
 
     def pad_data(self, data):
-        sents = [x[0] for x in data]
-        sent_ids = [x[1] for x in data]
+        sents = self.dataset.sents[0][data]
+        sent_ids = self.dataset.ids[data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        token_ids, attention_mask, _ = pad_single(self.tokenizer, [self.tokens[i] for i in data])
 
         return token_ids, attention_mask, sents, sent_ids
 
@@ -93,55 +380,51 @@ class SentenceClassificationTestDataset(Dataset):
                 'token_ids': token_ids,
                 'attention_mask': attention_mask,
                 'sents': sents,
-                'sent_ids': sent_ids
+                'sent_ids': sent_ids,
+                'indices': list(all_data)
             }
 
         return batched_data
 
 
-class SentencePairDataset(Dataset):
+class SentencePairDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args, isRegression=False):
-        self.dataset = dataset
+        self.dataset = as_task_data(dataset, num_sents=2, labeled=True)
         self.p = args
         self.isRegression = isRegression 
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
+        cache_dir = getattr(args, 'token_cache_dir', None)
+        num_procs = getattr(args, 'tokenize_procs', 1)
+        self.tokens1 = TokenCache.build(self.dataset.sents[0], self.tokenizer, cache_dir, num_procs)
+        self.tokens2 = TokenCache.build(self.dataset.sents[1], self.tokenizer, cache_dir, num_procs)
+        if args.siamese:
+            # Siamese pairs are two [CLS] s [SEP] rows padded to a shared length (see pad_data).
+            self.lengths = 2 * (np.maximum(self.tokens1.lengths(), self.tokens2.lengths()) + 2)
+        else:
+            # Number of tokens of each pair: both sentences plus [CLS] and two [SEP]s.
+            self.lengths = self.tokens1.lengths() + self.tokens2.lengths() + 3
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return idx
 
     def pad_data(self, data):
-        sent1 = [x[0] for x in data]
-        sent2 = [x[1] for x in data]
-        labels = [x[2] for x in data]
-        sent_ids = [x[3] for x in data]
+        labels = self.dataset.labels[data]
+        sent_ids = self.dataset.ids[data]
+        ids1 = [self.tokens1[i] for i in data]
+        ids2 = [self.tokens2[i] for i in data]
         if not self.p.siamese:
-            encoding1 = self.tokenizer(sent1, sent2, return_tensors='pt', padding=True, truncation=True)
-
-            token_ids = torch.LongTensor(encoding1['input_ids'])
-            attention_mask = torch.LongTensor(encoding1['attention_mask'])
-            token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
-
-            token_ids2 = torch.tensor(False)
-            attention_mask2 = torch.tensor(False)
-            token_type_ids2 = torch.tensor(False)
-        else:
-            encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-            encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
-
-            token_ids = torch.LongTensor(encoding1['input_ids'])
-            attention_mask = torch.LongTensor(encoding1['attention_mask'])
-            token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
-
-            token_ids2 = torch.LongTensor(encoding2['input_ids'])
-            attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-            token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
-        if self.isRegression:
-            labels = torch.DoubleTensor(labels)
+            token_ids, attention_mask, token_type_ids = pad_pair(self.tokenizer, ids1, ids2)
         else:
-            labels = torch.LongTensor(labels)
+            # One batch of both sentences padded to a shared length: the first sentences in
+            # rows [:n], the second in rows [n:], so the model encodes them in a single pass.
+            token_ids, attention_mask, token_type_ids = pad_single(self.tokenizer, ids1 + ids2)
+        token_ids2 = torch.tensor(False)
+        attention_mask2 = torch.tensor(False)
+        token_type_ids2 = torch.tensor(False)
+        labels = torch.as_tensor(labels, dtype=torch.float64 if self.isRegression else torch.long)
 
         return (token_ids, token_type_ids, attention_mask,
                 token_ids2, token_type_ids2, attention_mask2,
@@ -160,51 +443,50 @@ class SentencePairDataset(Dataset):
                 'token_type_ids_2': token_type_ids2,
                 'attention_mask_2': attention_mask2,
                 'labels': labels,
-                'sent_ids': sent_ids
+                'sent_ids': sent_ids,
+                'indices': list(all_data)
             }
 
         return batched_data
 
 
 # Unlike SentencePairDataset, we do not load labels in SentencePairTestDataset.
-class SentencePairTestDataset(Dataset):
+class SentencePairTestDataset(SharedTokenizerDataset):
     def __init__(self, dataset, args):
-        self.dataset = dataset
+        self.dataset = as_task_data(dataset, num_sents=2, labeled=False)
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = get_shared_tokenizer('bert-base-uncased')
+        cache_dir = getattr(args, 'token_cache_dir', None)
+        num_procs = getattr(args, 'tokenize_procs', 1)
+        self.tokens1 = TokenCache.build(self.dataset.sents[0], self.tokenizer, cache_dir, num_procs)
+        self.tokens2 = TokenCache.build(self.dataset.sents[1], self.tokenizer, cache_dir, num_procs)
+        if args.siamese:
+            # Siamese pairs are two [CLS] s [SEP] rows padded to a shared length (see pad_data).
+            self.lengths = 2 * (np.maximum(self.tokens1.lengths(), self.tokens2.lengths()) + 2)
+        else:
+            # Number of tokens of each pair: both sentences plus [CLS] and two [SEP]s.
+            self.lengths = self.tokens1.lengths() + self.tokens2.lengths() + 3
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return idx
 
     def pad_data(self, data):
-        sent1 = [x[0] for x in data]
-        sent2 = [x[1] for x in data]
-        sent_ids = [x[2] for x in data]
+        sent_ids = self.dataset.ids[data]
 
+        ids1 = [self.tokens1[i] for i in data]
+        ids2 = [self.tokens2[i] for i in data]
         if not self.p.siamese:
-            encoding1 = self.tokenizer(sent1, sent2, return_tensors='pt', padding=True, truncation=True)
-
-            token_ids = torch.LongTensor(encoding1['input_ids'])
-            attention_mask = torch.LongTensor(encoding1['attention_mask'])
-            token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
-
-            token_ids2 = torch.tensor(False)
-            attention_mask2 = torch.tensor(False)
-            token_type_ids2 = torch.tensor(False)
+            token_ids, attention_mask, token_type_ids = pad_pair(self.tokenizer, ids1, ids2)
         else:
-            encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-            encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
-
-            token_ids = torch.LongTensor(encoding1['input_ids'])
-            attention_mask = torch.LongTensor(encoding1['attention_mask'])
-            token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
-
-            token_ids2 = torch.LongTensor(encoding2['input_ids'])
-            attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-            token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
+            # One batch of both sentences padded to a shared length: the first sentences in
+            # rows [:n], the second in rows [n:], so the model encodes them in a single pass.
+            token_ids, attention_mask, token_type_ids = pad_single(self.tokenizer, ids1 + ids2)
+        token_ids2 = torch.tensor(False)
+        attention_mask2 = torch.tensor(False)
+        token_type_ids2 = torch.tensor(False)
 
 
         return (token_ids, token_type_ids, attention_mask,
@@ -223,71 +505,200 @@ class SentencePairTestDataset(Dataset):
                 'token_ids_2': token_ids2,
                 'token_type_ids_2': token_type_ids2,
                 'attention_mask_2': attention_mask2,
-                'sent_ids': sent_ids
+                'sent_ids': sent_ids,
+                'indices': list(all_data)
             }
 
         return batched_data
 
 
-def load_multitask_data(sentiment_filename,paraphrase_filename,similarity_filename,split='train'):
-    sentiment_data = []
-    num_labels = {}
-    if split == 'test':
-        with open(sentiment_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                sent = record['sentence'].lower().strip()
-                sent_id = record['id'].lower().strip()
-                sentiment_data.append((sent,sent_id))
+def as_task_data(dataset, num_sents, labeled):
+    '''`dataset` as columns.TaskData, converting a list of example tuples if need be.'''
+    if isinstance(dataset, TaskData):
+        return dataset
+    return TaskData.from_examples(dataset, num_sents, labeled)
+
+
+def parse_label(label_type, value):
+    '''label_type(value), or None if the value is missing or does not parse.'''
+    try:
+        return label_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_task_file(filename, sentence_fields, preprocess, label_field=None, label_type=int,
+                   skip_invalid=False, chunk_size=65536):
+    '''
+    Stream a TSV file into a columns.TaskData, chunk_size rows at a time: one StringColumn
+    per field in `sentence_fields` (passed through `preprocess`), the `label_field` parsed
+    with `label_type` into an int64 or (for float) float64 array, and the lowercased ids.
+    Only the current chunk is ever held as Python strings. With skip_invalid, rows that are
+    missing fields or whose label does not parse are dropped.
+    '''
+    sents = [StringColumnBuilder() for _ in sentence_fields]
+    labels = []
+    ids = CategoricalColumnBuilder()
+    label_dtype = np.float64 if label_type is float else np.int64
+    with open(filename, 'r') as fp:
+        reader = csv.reader(fp, delimiter='\t')
+        header = next(reader)
+        sent_positions = [header.index(field) for field in sentence_fields]
+        id_position = header.index('id')
+        label_position = header.index(label_field) if label_field is not None else None
+        n_fields = max(sent_positions + [id_position, label_position or 0]) + 1
+        for rows in iter(lambda: list(itertools.islice(reader, chunk_size)), []):
+            # csv.DictReader skipped blank lines too.
+            rows = [row for row in rows if row]
+            if skip_invalid:
+                rows = [row for row in rows if len(row) >= n_fields]
+            if label_position is not None:
+                chunk_labels = [parse_label(label_type, row[label_position]) for row in rows]
+                if skip_invalid:
+                    rows = [row for row, label in zip(rows, chunk_labels) if label is not None]
+                    chunk_labels = [label for label in chunk_labels if label is not None]
+                labels.append(np.array(chunk_labels, dtype=label_dtype))
+            for column, position in zip(sents, sent_positions):
+                column.extend([preprocess(row[position]) for row in rows])
+            ids.extend([row[id_position].lower().strip() for row in rows])
+
+    if label_position is None:
+        labels = None
     else:
-        with open(sentiment_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                sent = record['sentence'].lower().strip()
-                sent_id = record['id'].lower().strip()
-                label = int(record['sentiment'].strip())
-                if label not in num_labels:
-                    num_labels[label] = len(num_labels)
-                sentiment_data.append((sent, label,sent_id))
-
-    print(f"Loaded {len(sentiment_data)} {split} examples from {sentiment_filename}")
-
-    paraphrase_data = []
-    if split == 'test':
-        with open(paraphrase_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                sent_id = record['id'].lower().strip()
-                paraphrase_data.append((preprocess_string(record['sentence1']),
-                                        preprocess_string(record['sentence2']),
-                                        sent_id))
-
-    else:
-        with open(paraphrase_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                try:
-                    sent_id = record['id'].lower().strip()
-                    paraphrase_data.append((preprocess_string(record['sentence1']),
-                                            preprocess_string(record['sentence2']),
-                                            int(float(record['is_duplicate'])),sent_id))
-                except:
-                    pass
-
-    print(f"Loaded {len(paraphrase_data)} {split} examples from {paraphrase_filename}")
-
-    similarity_data = []
-    if split == 'test':
-        with open(similarity_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                sent_id = record['id'].lower().strip()
-                similarity_data.append((preprocess_string(record['sentence1']),
-                                        preprocess_string(record['sentence2'])
-                                        ,sent_id))
+        labels = np.concatenate(labels) if labels else np.zeros(0, dtype=label_dtype)
+    return TaskData([column.build() for column in sents], labels, ids.build())
+
+
+def task_file_specs(split, sentiment_filename, paraphrase_filename, similarity_filename):
+    '''(filename, read_task_file keyword arguments) of each of the three files of a split.'''
+    labeled = split != 'test'
+    return [
+        (sentiment_filename, dict(sentence_fields=('sentence',), preprocess=preprocess_sentiment,
+                                  label_field='sentiment' if labeled else None, label_type=int)),
+        # Some Quora rows are malformed; they were always skipped.
+        (paraphrase_filename, dict(sentence_fields=('sentence1', 'sentence2'), preprocess=preprocess_string,
+                                   label_field='is_duplicate' if labeled else None,
+                                   label_type=parse_duplicate_label, skip_invalid=labeled)),
+        (similarity_filename, dict(sentence_fields=('sentence1', 'sentence2'), preprocess=preprocess_string,
+                                   label_field='similarity' if labeled else None, label_type=float)),
+    ]
+
+
+# Bump when read_task_file or the preprocessing changes, so older caches are not reused.
+DATA_CACHE_VERSION = 1
+
+
+def task_cache_path(cache_dir, filename, options):
+    '''Cache file prefix of a data file read with the given read_task_file options.'''
+    options = {key: getattr(value, '__name__', value) for key, value in sorted(options.items())}
+    key = f'{DATA_CACHE_VERSION}:{os.path.abspath(filename)}:{options}'
+    return os.path.join(cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+
+def load_cached_task_file(path, filename):
+    '''
+    The TaskData cached under `path`, memory-mapped, if it was parsed from the file as it is
+    now (same mtime and size); None if there is no such cache, or if it is unreadable (e.g.
+    an array file was deleted or truncated), so the caller parses the file again.
+    '''
+    try:
+        with open(path + '.json', 'r') as fp:
+            meta = json.load(fp)
+        stat = os.stat(filename)
+        if meta['mtime_ns'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+            return None
+        arrays = {name: np.load(f'{path}.{name}.npy', mmap_mode='r') for name in meta['arrays']}
+        return TaskData.from_arrays(arrays, meta['num_sents'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def ingest_task_file(filename, options, cache_dir=None):
+    '''
+    read_task_file(filename, **options), run in a pool process by load_task_files. With a
+    cache_dir the result is written to the cache and None is returned, so the parent maps
+    the files instead of receiving a pickled copy.
+    '''
+    stat = os.stat(filename)
+    data = read_task_file(filename, **options)
+    if cache_dir is None:
+        return data
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = task_cache_path(cache_dir, filename, options)
+    # As in TokenCache.build: temporary names first, and the metadata file, which marks the
+    # cache complete, last.
+    pid = os.getpid()
+    arrays = data.arrays()
+    for name, array in arrays.items():
+        np.save(f'{path}.{name}.{pid}.npy', array)
+        os.replace(f'{path}.{name}.{pid}.npy', f'{path}.{name}.npy')
+    meta = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'num_sents': len(data.sents),
+            'arrays': sorted(arrays)}
+    with open(f'{path}.{pid}.json', 'w') as fp:
+        json.dump(meta, fp)
+    os.replace(f'{path}.{pid}.json', path + '.json')
+    return None
+
+
+def load_task_files(specs, cache_dir=None, num_procs=None):
+    '''
+    TaskData of each (filename, read_task_file options) in `specs`. Files with a current
+    cache in cache_dir are memory-mapped from it; the others are parsed concurrently by up to
+    num_procs processes (default: one per file, at most one per CPU) and cached.
+    '''
+    results = [None] * len(specs)
+    if cache_dir is not None:
+        results = [load_cached_task_file(task_cache_path(cache_dir, filename, options), filename)
+                   for filename, options in specs]
+    # Largest files first, so the pool does not end up waiting on one big file.
+    missing = sorted((i for i, data in enumerate(results) if data is None),
+                     key=lambda i: -os.path.getsize(specs[i][0]))
+    if not missing:
+        return results
+
+    jobs = [(specs[i][0], specs[i][1], cache_dir) for i in missing]
+    num_procs = min(len(jobs), num_procs or os.cpu_count() or 1)
+    if num_procs > 1:
+        with multiprocessing.Pool(num_procs) as pool:
+            parsed = pool.starmap(ingest_task_file, jobs, chunksize=1)
     else:
-        with open(similarity_filename, 'r') as fp:
-            for record in csv.DictReader(fp,delimiter = '\t'):
-                sent_id = record['id'].lower().strip()
-                similarity_data.append((preprocess_string(record['sentence1']),
-                                        preprocess_string(record['sentence2']),
-                                        float(record['similarity']),sent_id))
-
-    print(f"Loaded {len(similarity_data)} {split} examples from {similarity_filename}")
-
-    return sentiment_data, len(num_labels), paraphrase_data, similarity_data
+        parsed = [ingest_task_file(*job) for job in jobs]
+    for i, data in zip(missing, parsed):
+        filename, options = specs[i]
+        if cache_dir is not None:
+            data = load_cached_task_file(task_cache_path(cache_dir, filename, options), filename)
+        # The file can change, or its cache be removed, while the pool runs; parse it here then.
+        results[i] = data if data is not None else read_task_file(filename, **options)
+    return results
+
+
+def load_multitask_splits(splits, cache_dir=None, num_procs=None):
+    '''
+    Load several splits at once. `splits` maps a split name ('train', 'dev' or 'test') to its
+    (sentiment, paraphrase, similarity) filenames; the result maps it to the tuple
+    load_multitask_data returns. The files of all splits are ingested together by
+    load_task_files, in parallel and through the cache in cache_dir if given.
+    '''
+    specs = {split: task_file_specs(split, *filenames) for split, filenames in splits.items()}
+    loaded = iter(load_task_files([spec for split_specs in specs.values() for spec in split_specs],
+                                  cache_dir, num_procs))
+    data = {}
+    for split, split_specs in specs.items():
+        sentiment_data, paraphrase_data, similarity_data = [next(loaded) for _ in split_specs]
+        for (filename, _), task_data in zip(split_specs, (sentiment_data, paraphrase_data, similarity_data)):
+            print(f"Loaded {len(task_data)} {split} examples from {filename}")
+        num_labels = len(np.unique(sentiment_data.labels)) if sentiment_data.labels is not None else 0
+        data[split] = (sentiment_data, num_labels, paraphrase_data, similarity_data)
+    return data
+
+
+def load_multitask_data(sentiment_filename,paraphrase_filename,similarity_filename,split='train',
+                        cache_dir=None, num_procs=None):
+    '''
+    Load the SST, Quora and STS files of a split as columns.TaskData (see read_task_file),
+    along with the number of distinct sentiment labels (0 for the test split). The files are
+    parsed concurrently, and with a cache_dir only when their cache is missing or stale.
+    '''
+    return load_multitask_splits({split: (sentiment_filename, paraphrase_filename, similarity_filename)},
+                                 cache_dir, num_procs)[split]
@@ -0,0 +1,216 @@
+'''
+Duplicate-question search with a siamese MultitaskBERT.
+
+Scoring a new question against every stored one with predict_paraphrase takes one BERT pass
+per pair. Here every stored question is encoded once (sentence_cache.encode_sentences), the
+normalized pooler outputs go into an on-disk IVF index, and a query is answered with the k
+stored questions of the highest cosine similarity to it, searched in the n_probe inverted
+lists whose centroids are closest to it. The para_dense_siamese duplicate probability of
+each result is printed next to it, but does not reorder them: the head is a linear layer on
+the concatenated embeddings, so for a fixed query it scores each candidate by the candidate
+alone and cannot rerank the results for the query.
+
+    python duplicate_search.py build --filepath siamese-...-multitask.pt --questions data/quora-train.csv --index_dir quora-index
+    python duplicate_search.py search --filepath siamese-...-multitask.pt --index_dir quora-index --question "How do I learn Python?"
+'''
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import torch
+
+from datasets import TokenCache, preprocess_string
+from multitask_classifier import load_test_model
+from sentence_cache import encode_sentences
+from tokenizer import get_shared_tokenizer
+
+
+class IVFIndex:
+    '''
+    Inverted-file index over unit vectors for maximum inner product (cosine) search.
+
+    The vectors are clustered with spherical k-means into n_lists lists; a query is compared
+    with the centroids and then exhaustively with the vectors of the n_probe closest lists.
+    Vectors are stored as float16 in list order: list l holds rows offsets[l]:offsets[l + 1]
+    of `vectors`, and ids maps those rows back to the positions of the indexed vectors.
+    '''
+    FILES = ('centroids', 'offsets', 'ids', 'vectors')
+
+    def __init__(self, centroids, offsets, ids, vectors):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def normalize(x):
+        x = np.asarray(x, dtype=np.float32)
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+    @staticmethod
+    def assign(vectors, centroids, chunk_size=65536):
+        '''Index of the closest centroid of each vector.'''
+        return np.concatenate([np.argmax(vectors[i:i + chunk_size] @ centroids.T, axis=1)
+                               for i in range(0, len(vectors), chunk_size)])
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_iter=10, max_train=None, seed=0):
+        '''
+        Index the rows of vectors. n_lists defaults to 4 * sqrt(len(vectors)); k-means is
+        trained on a sample of max_train vectors (default 64 per list).
+        '''
+        vectors = cls.normalize(vectors)
+        n = len(vectors)
+        n_lists = min(n_lists or max(1, int(4 * np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, min(n, max_train or 64 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = cls.assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            # An empty list keeps its old centroid.
+            sums[empty] = centroids[empty]
+            centroids = cls.normalize(sums)
+
+        assignment = cls.assign(vectors, centroids)
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+        return cls(centroids, offsets, ids, vectors[ids].astype(np.float16))
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(index_dir, f'{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, index_dir):
+        '''Load a saved index; the vectors are memory-mapped rather than read into memory.'''
+        return cls(*[np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r' if name == 'vectors' else None)
+                     for name in cls.FILES])
+
+    def search(self, queries, k, n_probe=8):
+        '''
+        (ids, scores): the k indexed vectors with the highest cosine similarity to each
+        query among the n_probe closest lists, best first. Rows with fewer than k
+        candidates are padded with id -1 and score -inf.
+        '''
+        queries = self.normalize(queries)
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, (query, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+            top = np.argpartition(-scores, k - 1)[:k] if len(rows) > k else np.arange(len(rows))
+            top = top[np.argsort(-scores[top], kind='stable')]
+            all_ids[q, :len(top)] = self.ids[rows[top]]
+            all_scores[q, :len(top)] = scores[top]
+        return all_ids, all_scores
+
+
+def exact_search(vectors, queries, k):
+    '''The exhaustive counterpart of IVFIndex.search over the rows of vectors.'''
+    scores = IVFIndex.normalize(queries) @ IVFIndex.normalize(vectors).T
+    ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, ids, axis=1), axis=1, kind='stable')
+    ids = np.take_along_axis(ids, order, axis=1)
+    return ids, np.take_along_axis(scores, ids, axis=1)
+
+
+def embed_questions(model, questions, batch_size, device, token_cache_dir=None):
+    '''[len(questions), hidden_size] pooler outputs of raw question strings.'''
+    tokenizer = get_shared_tokenizer('bert-base-uncased')
+    tokens = TokenCache.build([preprocess_string(q) for q in questions], tokenizer, token_cache_dir)
+    return encode_sentences(model, tokenizer, tokens, batch_size, device)
+
+
+def duplicate_probabilities(model, query_embeddings, ids, embeddings, device):
+    '''
+    para_dense_siamese probability that each query and each of its results (rows of
+    embeddings; -1 for none, which gets NaN) are duplicates.
+    '''
+    model.eval()
+    probs = np.full(ids.shape, np.nan, dtype=np.float32)
+    with torch.no_grad():
+        for q, (query, rows) in enumerate(zip(query_embeddings, ids)):
+            valid = rows >= 0
+            candidates = torch.as_tensor(np.asarray(embeddings[rows[valid]], dtype=np.float32)).to(device)
+            query = torch.as_tensor(query, dtype=torch.float32).to(device).expand_as(candidates)
+            probs[q, valid] = model.paraphrase_head(query, candidates).float().sigmoid().cpu().numpy()
+    return probs
+
+
+def read_questions(filename):
+    '''The distinct questions of a Quora csv file, in order of first occurrence.'''
+    questions = {}
+    with open(filename, 'r') as fp:
+        for record in csv.DictReader(fp, delimiter='\t'):
+            for key in ('sentence1', 'sentence2'):
+                if record.get(key):
+                    questions.setdefault(record[key], None)
+    return list(questions)
+
+
+def build(args, model, device):
+    questions = read_questions(args.questions)
+    embeddings = embed_questions(model, questions, args.batch_size, device, args.token_cache_dir).numpy()
+    index = IVFIndex.build(embeddings, n_lists=args.n_lists)
+    index.save(args.index_dir)
+    # The raw pooler outputs are kept for the paraphrase head; the index only holds unit vectors.
+    np.save(os.path.join(args.index_dir, 'embeddings.npy'), embeddings.astype(np.float16))
+    with open(os.path.join(args.index_dir, 'questions.json'), 'w') as fp:
+        json.dump(questions, fp)
+    print(f"indexed {len(questions)} questions in {len(index.centroids)} lists at {args.index_dir}")
+
+
+def search(args, model, device):
+    index = IVFIndex.load(args.index_dir)
+    embeddings = np.load(os.path.join(args.index_dir, 'embeddings.npy'), mmap_mode='r')
+    with open(os.path.join(args.index_dir, 'questions.json'), 'r') as fp:
+        questions = json.load(fp)
+    query = embed_questions(model, [args.question], 1, device).numpy()
+    ids, cosines = index.search(query, args.k, args.n_probe)
+    probs = duplicate_probabilities(model, query, ids, embeddings, device)
+    print("cosine\tP(duplicate)\tquestion")
+    for i, cosine, prob in zip(ids[0], cosines[0], probs[0]):
+        if i >= 0:
+            print(f"{cosine:.3f}\t{prob:.3f}\t{questions[i]}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filepath', type=str, required=True, help='checkpoint of a --siamese multitask_classifier.py run')
+    parser.add_argument('--index_dir', type=str, required=True)
+    parser.add_argument('--use_gpu', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--token_cache_dir', type=str, default='.token_cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='embed the questions of a Quora csv file and index them')
+    build_parser.add_argument('--questions', type=str, default='data/quora-train.csv')
+    build_parser.add_argument('--n_lists', type=int, default=None, help='inverted lists; default 4 * sqrt(questions)')
+
+    search_parser = subparsers.add_parser('search', help='print the likeliest duplicates of a question')
+    search_parser.add_argument('--question', type=str, required=True)
+    search_parser.add_argument('--k', type=int, default=10)
+    search_parser.add_argument('--n_probe', type=int, default=8, help='inverted lists searched per query')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+    model, config = load_test_model(argparse.Namespace(filepath=args.filepath, int8=False), device)
+    if not config.siamese:
+        raise ValueError(f"{args.filepath} is not a siamese model")
+    {'build': build, 'search': search}[args.command](args, model, device)
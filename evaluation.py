@@ -16,6 +16,60 @@ import numpy as np
 TQDM_DISABLE = False
 
 
+def restore_order(indices, *columns):
+    '''
+    Reorder per-example result lists from the order the batches were drawn in (e.g. sorted
+    by length) back to dataset order, using the 'indices' collected from each batch.
+    '''
+    order = np.argsort(indices, kind='stable')
+    return [[column[i] for i in order] for column in columns]
+
+
+def accuracy_interval(accuracy, n, z=1.96):
+    '''Normal-approximation confidence interval (95% by default) of an accuracy measured on n examples.'''
+    half = z * np.sqrt(accuracy * (1 - accuracy) / max(n, 1))
+    return max(accuracy - half, 0.0), min(accuracy + half, 1.0)
+
+
+def correlation_interval(corr, n, z=1.96):
+    '''Confidence interval (95% by default) of a Pearson correlation on n pairs, via the Fisher transform.'''
+    if n <= 3:
+        return -1.0, 1.0
+    center = np.arctanh(np.clip(corr, -1 + 1e-12, 1 - 1e-12))
+    half = z / np.sqrt(n - 3)
+    return float(np.tanh(center - half)), float(np.tanh(center + half))
+
+
+def to_device(device, *tensors):
+    '''Copy batch tensors to device; copies of pinned batches do not block the host.'''
+    return [t.to(device, non_blocking=True) for t in tensors]
+
+
+def sentiment_logits(model, batch, device):
+    '''
+    MultitaskBERT sentiment logits for a batch of token ids from datasets.py, or of cached
+    BERT features from feature_cache.CachedFeatureDataset. Logits are fp32 even when the
+    model runs under bf16 autocast.
+    '''
+    if 'features' in batch:
+        return model.sentiment_head(*to_device(device, *batch['features'])).float()
+    return model.predict_sentiment(*to_device(device, batch['token_ids'], batch['attention_mask'])).float()
+
+
+def paraphrase_logits(model, batch, device):
+    if 'features' in batch:
+        return model.paraphrase_head(*to_device(device, *batch['features'])).float()
+    return model.predict_paraphrase(*to_device(device, batch['token_ids_1'], batch['attention_mask_1'],
+                                               batch['token_ids_2'], batch['attention_mask_2'])).float()
+
+
+def similarity_logits(model, batch, device):
+    if 'features' in batch:
+        return model.similarity_head(*to_device(device, *batch['features'])).float()
+    return model.predict_similarity(*to_device(device, batch['token_ids_1'], batch['attention_mask_1'],
+                                               batch['token_ids_2'], batch['attention_mask_2'])).float()
+
+
 # Evaluate multitask model on SST only.
 def model_eval_sst(dataloader, model, device):
     model.eval()  # Switch to eval model, will turn off randomness like dropout.
@@ -23,14 +77,11 @@ def model_eval_sst(dataloader, model, device):
     y_pred = []
     sents = []
     sent_ids = []
+    indices = []
     for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        b_ids, b_mask, b_labels, b_sents, b_sent_ids = batch['token_ids'],batch['attention_mask'],  \
-                                                        batch['labels'], batch['sents'], batch['sent_ids']
+        b_labels, b_sents, b_sent_ids = batch['labels'], batch['sents'], batch['sent_ids']
 
-        b_ids = b_ids.to(device)
-        b_mask = b_mask.to(device)
-
-        logits = model.predict_sentiment(b_ids, b_mask)
+        logits = sentiment_logits(model, batch, device)
         logits = logits.detach().cpu().numpy()
         preds = np.argmax(logits, axis=1).flatten()
 
@@ -39,7 +90,9 @@ def model_eval_sst(dataloader, model, device):
         y_pred.extend(preds)
         sents.extend(b_sents)
         sent_ids.extend(b_sent_ids)
+        indices.extend(batch['indices'])
 
+    y_true, y_pred, sents, sent_ids = restore_order(indices, y_true, y_pred, sents, sent_ids)
     f1 = f1_score(y_true, y_pred, average='macro')
     acc = accuracy_score(y_true, y_pred)
 
@@ -51,18 +104,9 @@ def model_eval_para(dataloader, model, device):
     para_y_pred = []
     para_sent_ids = []
     for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        (b_ids1, b_mask1,
-         b_ids2, b_mask2,
-         b_labels, b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                                  batch['token_ids_2'], batch['attention_mask_2'],
-                                  batch['labels'], batch['sent_ids'])
-
-        b_ids1 = b_ids1.to(device)
-        b_mask1 = b_mask1.to(device)
-        b_ids2 = b_ids2.to(device)
-        b_mask2 = b_mask2.to(device)
-
-        logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
+        b_labels, b_sent_ids = batch['labels'], batch['sent_ids']
+
+        logits = paraphrase_logits(model, batch, device)
         y_hat = logits.sigmoid().round().flatten().cpu().numpy()
         b_labels = b_labels.flatten().cpu().numpy()
 
@@ -80,18 +124,9 @@ def model_eval_sts(dataloader, model, device):
     sts_y_pred = []
     sts_sent_ids = []
     for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        (b_ids1, b_mask1,
-         b_ids2, b_mask2,
-         b_labels, b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                                  batch['token_ids_2'], batch['attention_mask_2'],
-                                  batch['labels'], batch['sent_ids'])
-
-        b_ids1 = b_ids1.to(device)
-        b_mask1 = b_mask1.to(device)
-        b_ids2 = b_ids2.to(device)
-        b_mask2 = b_mask2.to(device)
-
-        logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
+        b_labels, b_sent_ids = batch['labels'], batch['sent_ids']
+
+        logits = similarity_logits(model, batch, device)
         y_hat = logits.flatten().cpu().numpy()
         b_labels = b_labels.flatten().cpu().numpy()
 
@@ -114,19 +149,20 @@ def model_eval_multitask(sentiment_dataloader,
         sst_y_true = []
         sst_y_pred = []
         sst_sent_ids = []
+        sst_indices = []
         for step, batch in enumerate(tqdm(sentiment_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            b_ids, b_mask, b_labels, b_sent_ids = batch['token_ids'], batch['attention_mask'], batch['labels'], batch['sent_ids']
-
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
+            b_labels, b_sent_ids = batch['labels'], batch['sent_ids']
 
-            logits = model.predict_sentiment(b_ids, b_mask)
+            logits = sentiment_logits(model, batch, device)
             y_hat = logits.argmax(dim=-1).flatten().cpu().numpy()
             b_labels = b_labels.flatten().cpu().numpy()
 
             sst_y_pred.extend(y_hat)
             sst_y_true.extend(b_labels)
             sst_sent_ids.extend(b_sent_ids)
+            sst_indices.extend(batch['indices'])
+
+        sst_y_pred, sst_y_true, sst_sent_ids = restore_order(sst_indices, sst_y_pred, sst_y_true, sst_sent_ids)
 
         sentiment_accuracy = np.mean(np.array(sst_y_pred) == np.array(sst_y_true))
 
@@ -134,51 +170,40 @@ def model_eval_multitask(sentiment_dataloader,
         para_y_true = []
         para_y_pred = []
         para_sent_ids = []
+        para_indices = []
         for step, batch in enumerate(tqdm(paraphrase_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            (b_ids1, b_mask1,
-             b_ids2, b_mask2,
-             b_labels, b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                          batch['token_ids_2'], batch['attention_mask_2'],
-                          batch['labels'], batch['sent_ids'])
-
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
-
-            logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
+            b_labels, b_sent_ids = batch['labels'], batch['sent_ids']
+
+            logits = paraphrase_logits(model, batch, device)
             y_hat = logits.sigmoid().round().flatten().cpu().numpy()
             b_labels = b_labels.flatten().cpu().numpy()
 
             para_y_pred.extend(y_hat)
             para_y_true.extend(b_labels)
             para_sent_ids.extend(b_sent_ids)
+            para_indices.extend(batch['indices'])
 
+        para_y_pred, para_y_true, para_sent_ids = restore_order(para_indices, para_y_pred, para_y_true, para_sent_ids)
         paraphrase_accuracy = np.mean(np.array(para_y_pred) == np.array(para_y_true))
 
         # Evaluate semantic textual similarity.
         sts_y_true = []
         sts_y_pred = []
         sts_sent_ids = []
+        sts_indices = []
         for step, batch in enumerate(tqdm(sts_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            (b_ids1, b_mask1,
-             b_ids2, b_mask2,
-             b_labels, b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                          batch['token_ids_2'], batch['attention_mask_2'],
-                          batch['labels'], batch['sent_ids'])
-
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
-
-            logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
+            b_labels, b_sent_ids = batch['labels'], batch['sent_ids']
+
+            logits = similarity_logits(model, batch, device)
             y_hat = logits.flatten().cpu().numpy()
             b_labels = b_labels.flatten().cpu().numpy()
 
             sts_y_pred.extend(y_hat)
             sts_y_true.extend(b_labels)
             sts_sent_ids.extend(b_sent_ids)
+            sts_indices.extend(batch['indices'])
+
+        sts_y_pred, sts_y_true, sts_sent_ids = restore_order(sts_indices, sts_y_pred, sts_y_true, sts_sent_ids)
         pearson_mat = np.corrcoef(sts_y_pred,sts_y_true)
         sts_corr = pearson_mat[1][0]
 
@@ -202,59 +227,50 @@ def model_eval_test_multitask(sentiment_dataloader,
         # Evaluate sentiment classification.
         sst_y_pred = []
         sst_sent_ids = []
+        sst_indices = []
         for step, batch in enumerate(tqdm(sentiment_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            b_ids, b_mask, b_sent_ids = batch['token_ids'], batch['attention_mask'],  batch['sent_ids']
-
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
+            b_sent_ids = batch['sent_ids']
 
-            logits = model.predict_sentiment(b_ids, b_mask)
+            logits = sentiment_logits(model, batch, device)
             y_hat = logits.argmax(dim=-1).flatten().cpu().numpy()
 
             sst_y_pred.extend(y_hat)
             sst_sent_ids.extend(b_sent_ids)
+            sst_indices.extend(batch['indices'])
+
+        sst_y_pred, sst_sent_ids = restore_order(sst_indices, sst_y_pred, sst_sent_ids)
 
         # Evaluate paraphrase detection.
         para_y_pred = []
         para_sent_ids = []
+        para_indices = []
         for step, batch in enumerate(tqdm(paraphrase_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            (b_ids1, b_mask1,
-             b_ids2, b_mask2,
-             b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                          batch['token_ids_2'], batch['attention_mask_2'],
-                          batch['sent_ids'])
-
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
-
-            logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
+            b_sent_ids = batch['sent_ids']
+
+            logits = paraphrase_logits(model, batch, device)
             y_hat = logits.sigmoid().round().flatten().cpu().numpy()
 
             para_y_pred.extend(y_hat)
             para_sent_ids.extend(b_sent_ids)
+            para_indices.extend(batch['indices'])
+
+        para_y_pred, para_sent_ids = restore_order(para_indices, para_y_pred, para_sent_ids)
 
         # Evaluate semantic textual similarity.
         sts_y_pred = []
         sts_sent_ids = []
+        sts_indices = []
         for step, batch in enumerate(tqdm(sts_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-            (b_ids1, b_mask1,
-             b_ids2, b_mask2,
-             b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                          batch['token_ids_2'], batch['attention_mask_2'],
-                          batch['sent_ids'])
-
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
-
-            logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
+            b_sent_ids = batch['sent_ids']
+
+            logits = similarity_logits(model, batch, device)
             y_hat = logits.flatten().cpu().numpy()
 
             sts_y_pred.extend(y_hat)
             sts_sent_ids.extend(b_sent_ids)
+            sts_indices.extend(batch['indices'])
+
+        sts_y_pred, sts_sent_ids = restore_order(sts_indices, sts_y_pred, sts_sent_ids)
 
         return (sst_y_pred, sst_sent_ids,
                 para_y_pred, para_sent_ids,
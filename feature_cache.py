@@ -0,0 +1,133 @@
+'''
+Cached BERT features for training with a frozen encoder.
+
+With --fine-tune-mode last-linear-layer only the task heads are trained, so the BERT
+`pooler_output` of every example is the same in every epoch. encode_features runs BERT
+once over a dataset and stores the pooled vectors as a float16 .npy file that is
+memory-mapped on later runs; CachedFeatureDataset then serves those vectors so the heads
+can be trained without running BERT at all.
+
+Cache files are keyed by a hash of the BERT weights and of the tokenized sentences, so a
+different checkpoint, vocab or data file never reuses stale features.
+'''
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+
+TQDM_DISABLE = False
+
+
+def checkpoint_hash(model):
+    '''Hash of all tensors in model.state_dict(), identifying the exact weights the features come from.'''
+    h = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def dataset_hash(dataset):
+    '''
+    Hash of the sentences of a dataset: their cached token ids for the datasets in
+    datasets.py, the raw examples otherwise.
+    '''
+    h = hashlib.sha256()
+    token_caches = [getattr(dataset, name) for name in ('tokens', 'tokens1', 'tokens2') if hasattr(dataset, name)]
+    for tokens in token_caches:
+        h.update(np.ascontiguousarray(tokens.ids).tobytes())
+        h.update(np.ascontiguousarray(tokens.offsets).tobytes())
+    if not token_caches:
+        h.update(repr(list(dataset.dataset)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def encode_features(bert, loader, fields, cache_dir, model_hash, device, variant='', stacked=1):
+    '''
+    Return one [len(dataset), hidden_size] float16 array of BERT pooler outputs per
+    (token_ids, attention_mask) pair of batch keys in `fields`, computing them only if
+    they are not cached yet. Rows follow dataset order: batches may come in any order as
+    long as they carry 'indices'; otherwise the loader must be sequential.
+
+    With `stacked` > 1 each field holds that many sentences per example, stacked along the
+    batch dimension as in siamese SentencePairDataset batches, and gets one array per
+    sentence. `variant` tells apart different encodings of the same sentences, such as
+    concatenated and siamese sentence pairs.
+    '''
+    key = hashlib.sha256(f'{model_hash}:{dataset_hash(loader.dataset)}:{variant}:{fields}:{stacked}'.encode('utf-8'))
+    key = key.hexdigest()[:32]
+    paths = [os.path.join(cache_dir, f'{key}.{ids_key}.{part}.npy') for ids_key, _ in fields for part in range(stacked)]
+    if all(os.path.exists(path) for path in paths):
+        return [np.load(path, mmap_mode='r') for path in paths]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    n = len(loader.dataset)
+    hidden_size = bert.config.hidden_size
+    # Write through temporary names so an interrupted run never leaves a partial cache behind.
+    tmp_paths = [f'{path}.{os.getpid()}.npy' for path in paths]
+    features = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(n, hidden_size))
+                for path in tmp_paths]
+
+    was_training = bert.training
+    bert.eval()
+    start = 0
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='cache-features', disable=TQDM_DISABLE):
+            indices = batch.get('indices')
+            if indices is None:
+                indices = list(range(start, start + len(batch[fields[0][0]])))
+            start += len(indices)
+            for i, (ids_key, mask_key) in enumerate(fields):
+                pooled = bert(batch[ids_key].to(device), batch[mask_key].to(device))['pooler_output']
+                for out, part in zip(features[i * stacked:(i + 1) * stacked], pooled.chunk(stacked)):
+                    out[indices] = part.cpu().numpy().astype(np.float16)
+    bert.train(was_training)
+
+    for out in features:
+        out.flush()
+    del features
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+class CachedFeatureDataset(Dataset):
+    '''
+    Serves cached pooler outputs in place of token ids. Batches hold 'features', a list
+    with one [batch, hidden_size] float32 tensor per encoded input (one for single sentences
+    and concatenated pairs, two for siamese pairs), next to the usual 'labels', 'sents',
+    'sent_ids' and 'indices' where available.
+    '''
+    def __init__(self, features, labels, sent_ids, isRegression=False, sents=None):
+        self.features = features
+        self.labels = labels
+        self.sent_ids = sent_ids
+        self.isRegression = isRegression
+        self.sents = sents
+
+    def __len__(self):
+        return len(self.sent_ids)
+
+    def __getitem__(self, idx):
+        return idx
+
+    def collate_fn(self, indices):
+        # Sorting the rows makes the reads from the memory-mapped files sequential.
+        indices = sorted(indices)
+        features = [torch.from_numpy(np.asarray(f[indices], dtype=np.float32)) for f in self.features]
+        batched_data = {
+            'features': features,
+            'sent_ids': [self.sent_ids[i] for i in indices],
+            'indices': indices,
+        }
+        if self.labels is not None:
+            labels = [self.labels[i] for i in indices]
+            batched_data['labels'] = torch.DoubleTensor(labels) if self.isRegression else torch.LongTensor(labels)
+        if self.sents is not None:
+            batched_data['sents'] = [self.sents[i] for i in indices]
+        return batched_data
@@ -12,29 +12,44 @@ Running `python multitask_classifier.py` trains and tests your MultitaskBERT and
 writes all required submission files.
 '''
 
-import random, numpy as np, argparse
+import os, random, time, numpy as np, argparse
 from types import SimpleNamespace
 
 import torch
+import torch.distributed as dist
 from sympy.utilities.iterables import iterable
 from torch import nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler
 from torch.utils.tensorboard import SummaryWriter
 
-from bert import BertModel
+from bert import BertModel, load_int8_model
 from optimizer import AdamW
 from tqdm import tqdm
 
 from datasets import (
+    BucketBatchSampler,
+    CachedBatches,
     SentenceClassificationDataset,
     SentenceClassificationTestDataset,
     SentencePairDataset,
     SentencePairTestDataset,
-    load_multitask_data
+    load_multitask_splits,
+    padding_ratio
 )
 
-from evaluation import model_eval_sst, model_eval_multitask, model_eval_test_multitask
+from evaluation import (
+    accuracy_interval,
+    correlation_interval,
+    model_eval_multitask,
+    model_eval_sst,
+    model_eval_test_multitask,
+    paraphrase_logits,
+    sentiment_logits,
+    similarity_logits
+)
+from feature_cache import CachedFeatureDataset, checkpoint_hash, encode_features
+from sentence_cache import SentenceEmbeddingIndex
 
 
 TQDM_DISABLE=False
@@ -65,7 +80,10 @@ class MultitaskBERT(nn.Module):
     '''
     def __init__(self, config):
         super(MultitaskBERT, self).__init__()
-        self.bert = BertModel.from_pretrained('bert-base-uncased')
+        self.bert = BertModel.from_pretrained('bert-base-uncased',
+                                              unpadded_encoder=getattr(config, 'unpadded_encoder', False),
+                                              fused_qkv=getattr(config, 'fused_qkv', False),
+                                              attention_backend=getattr(config, 'attention_backend', 'eager'))
         # last-linear-layer mode does not require updating BERT paramters.
         assert config.fine_tune_mode in ["last-linear-layer", "full-model"]
         for param in self.bert.parameters():
@@ -103,7 +121,7 @@ class MultitaskBERT(nn.Module):
         '''
         ### TODO
         pooler_output = self.forward(input_ids, attention_mask)['pooler_output']
-        return self.sst_dense(self.dropout(pooler_output))
+        return self.sentiment_head(pooler_output)
 
 
     def predict_paraphrase(self,
@@ -116,14 +134,9 @@ class MultitaskBERT(nn.Module):
         ### TODO
         if not self.siamese:
             pooler_output = self.forward(input_ids_1, attention_mask_1)['pooler_output']
-            return self.para_dense(self.dropout(pooler_output)).squeeze(-1)
+            return self.paraphrase_head(pooler_output)
         else:
-            # Get [CLS] embeddings for both sentences
-            pooler_output_1 = self.forward(input_ids_1, attention_mask_1)['pooler_output']
-            pooler_output_2 = self.forward(input_ids_2, attention_mask_2)['pooler_output']
-            # Concatenate the embeddings
-            concat = torch.cat([pooler_output_1, pooler_output_2], dim=1)
-            return self.para_dense_siamese(self.dropout(concat)).squeeze(-1)
+            return self.paraphrase_head(*self.encode_siamese(input_ids_1, attention_mask_1, input_ids_2, attention_mask_2))
 
 
     def predict_similarity(self,
@@ -135,21 +148,60 @@ class MultitaskBERT(nn.Module):
         ### TODO
         if not self.siamese:
             pooler_output = self.forward(input_ids_1, attention_mask_1)['pooler_output']
-            return self.sts_dense(self.dropout(pooler_output)).squeeze(-1)
+            return self.similarity_head(pooler_output)
         else:
-            # Get [CLS] embeddings for both sentences
-            pooler_output_1 = self.forward(input_ids_1, attention_mask_1)['pooler_output']
-            pooler_output_2 = self.forward(input_ids_2, attention_mask_2)['pooler_output']
-            # Concatenate the embeddings
-            concat = torch.cat([pooler_output_1, pooler_output_2], dim=1)
-            return self.sts_dense_siamese(self.dropout(concat)).squeeze(-1)
+            return self.similarity_head(*self.encode_siamese(input_ids_1, attention_mask_1, input_ids_2, attention_mask_2))
+
+
+    def encode_siamese(self, input_ids_1, attention_mask_1, input_ids_2, attention_mask_2):
+        '''
+        pooler_output of the first and of the second sentences of a batch of pairs, from a
+        single BERT pass. SentencePairDataset batches already stack both sentences in
+        input_ids_1 (the second ones in the bottom half) and leave input_ids_2 empty;
+        separately padded sentences are stacked here.
+        '''
+        if input_ids_2.dim() > 0:
+            max_len = max(input_ids_1.size(1), input_ids_2.size(1))
+            input_ids_1 = torch.cat([F.pad(ids, (0, max_len - ids.size(1))) for ids in (input_ids_1, input_ids_2)])
+            attention_mask_1 = torch.cat([F.pad(mask, (0, max_len - mask.size(1)))
+                                          for mask in (attention_mask_1, attention_mask_2)])
+        return self.forward(input_ids_1, attention_mask_1)['pooler_output'].chunk(2)
+
+
+    # The task heads on top of BERT's pooler_output. They are separate from the predict_*
+    # methods so that heads can also be trained on cached features (see feature_cache.py).
+    def sentiment_head(self, pooler_output):
+        return self.sst_dense(self.dropout(pooler_output))
+
+
+    def paraphrase_head(self, pooler_output_1, pooler_output_2=None):
+        if not self.siamese:
+            return self.para_dense(self.dropout(pooler_output_1)).squeeze(-1)
+        # Concatenate the embeddings
+        concat = torch.cat([pooler_output_1, pooler_output_2], dim=1)
+        return self.para_dense_siamese(self.dropout(concat)).squeeze(-1)
+
+
+    def similarity_head(self, pooler_output_1, pooler_output_2=None):
+        if not self.siamese:
+            return self.sts_dense(self.dropout(pooler_output_1)).squeeze(-1)
+        concat = torch.cat([pooler_output_1, pooler_output_2], dim=1)
+        return self.sts_dense_siamese(self.dropout(concat)).squeeze(-1)
 
 
 
 
+def saved_model_state(model, config):
+    model_state = model.state_dict()
+    if config.fine_tune_mode == 'last-linear-layer':
+        # BERT is frozen at its pretrained weights, which from_pretrained restores when loading.
+        model_state = {k: v for k, v in model_state.items() if not k.startswith('bert.')}
+    return model_state
+
+
 def save_model(model, optimizer, args, config, filepath):
     save_info = {
-        'model': model.state_dict(),
+        'model': saved_model_state(model, config),
         'optim': optimizer.state_dict(),
         'args': args,
         'model_config': config,
@@ -162,6 +214,280 @@ def save_model(model, optimizer, args, config, filepath):
     print(f"save the model to {filepath}")
 
 
+def resume_path(args):
+    return os.path.splitext(args.filepath)[0] + '-resume.pt'
+
+
+def save_checkpoint(model, optimizer, streams, epoch, step, best_avg_dev_acc, args, config):
+    '''
+    Save everything train_multitask needs to continue from micro-batch `step` of `epoch` as
+    if it had never stopped: the model and optimizer, the position of each task's batch
+    stream and the state of every RNG (task sampling uses numpy, dropout torch). The alpha
+    schedule follows from the epoch. Written through a temporary file, so a run killed
+    while saving keeps its previous checkpoint.
+    '''
+    # Called on every rank: dropout draws from a different torch RNG state on each of them.
+    rank, world_size = distributed_info()
+    torch_rngs = [torch.random.get_rng_state()]
+    if world_size > 1:
+        torch_rngs = [None] * world_size
+        dist.all_gather_object(torch_rngs, torch.random.get_rng_state())
+    if rank != 0:
+        return
+    save_info = {
+        'model': saved_model_state(model, config),
+        'optim': optimizer.state_dict(),
+        'streams': {task_id: stream.state_dict() for task_id, stream in streams.items()},
+        'world_size': world_size,
+        'epoch': epoch,
+        'step': step,
+        'best_avg_dev_acc': best_avg_dev_acc,
+        'args': args,
+        'model_config': config,
+        'system_rng': random.getstate(),
+        'numpy_rng': np.random.get_state(),
+        'torch_rngs': torch_rngs,
+        'cuda_rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+    filepath = resume_path(args)
+    torch.save(save_info, f'{filepath}.{os.getpid()}.tmp')
+    os.replace(f'{filepath}.{os.getpid()}.tmp', filepath)
+
+
+def load_checkpoint(model, optimizer, streams, args):
+    '''Restore a save_checkpoint checkpoint; returns its (epoch, step, best_avg_dev_acc).'''
+    saved = torch.load(resume_path(args), weights_only=False)
+    rank, world_size = distributed_info()
+    if saved['world_size'] != world_size:
+        # Each rank's share of the data depends on the number of processes.
+        raise ValueError(f"{resume_path(args)} was written by {saved['world_size']} processes, not {world_size}")
+    model_state = model.state_dict()
+    model_state.update(saved['model'])
+    model.load_state_dict(model_state)
+    optimizer.load_state_dict(saved['optim'])
+    for task_id, stream in streams.items():
+        stream.load_state_dict(saved['streams'][task_id])
+    random.setstate(saved['system_rng'])
+    np.random.set_state(saved['numpy_rng'])
+    torch.random.set_rng_state(saved['torch_rngs'][rank])
+    if saved['cuda_rng'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(saved['cuda_rng'])
+    if rank == 0:
+        print(f"resume from {resume_path(args)} at epoch {saved['epoch']}, step {saved['step']}")
+    return saved['epoch'], saved['step'], saved['best_avg_dev_acc']
+
+
+def distributed_info():
+    '''(rank, world_size) of this process; (0, 1) outside data-parallel training.'''
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def train_sampler(dataset, args, generator):
+    '''Shuffled example order for training; in data-parallel training each rank gets its own shard.'''
+    rank, world_size = distributed_info()
+    if world_size > 1:
+        return DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed)
+    return RandomSampler(dataset, generator=generator)
+
+
+def all_reduce_gradients(model):
+    '''
+    Average the gradients of model over all ranks with one all-reduce of a flat buffer.
+    Every rank trains on the same tasks in the same order, so the same parameters have
+    gradients everywhere.
+    '''
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def autocast(args, device):
+    '''
+    bf16 autocast around the forward pass for --precision bf16. Parameters, gradients and
+    the AdamW state stay fp32, so the optimizer updates fp32 master weights.
+    '''
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+
+def task_workers(args):
+    '''DataLoader worker processes per task id, from --num_workers.'''
+    counts = args.num_workers * 3 if len(args.num_workers) == 1 else args.num_workers
+    return dict(zip(('sst', 'para', 'sts'), counts))
+
+
+def loader_options(args, num_workers):
+    '''
+    DataLoader arguments for the input pipeline: num_workers processes collate batches in the
+    background, each keeping up to --prefetch_factor batches ready, and batches are pinned
+    for asynchronous copies to the GPU.
+    '''
+    return {'num_workers': num_workers, 'pin_memory': args.use_gpu,
+            'prefetch_factor': args.prefetch_factor if num_workers > 0 else None}
+
+
+def build_dataloader(dataset, args, shuffle, generator=None, num_workers=0):
+    '''
+    DataLoader for one of the datasets in datasets.py. With --bucket_multiplier > 0, batches
+    group examples of similar length (see BucketBatchSampler); evaluation loaders
+    (shuffle=False) are then fully sorted by length. With --max_tokens, batch sizes vary so
+    that each padded batch holds at most that many tokens. Shuffling draws from `generator`
+    if given; in data-parallel training, shuffled loaders only serve this rank's shard.
+    '''
+    options = loader_options(args, num_workers)
+    if args.bucket_multiplier > 0 or args.max_tokens is not None:
+        rank, world_size = distributed_info() if shuffle else (0, 1)
+        batch_sampler = BucketBatchSampler(dataset.lengths, args.batch_size, max(args.bucket_multiplier, 1),
+                                           shuffle=shuffle, max_tokens=args.max_tokens, generator=generator,
+                                           num_replicas=world_size, rank=rank)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn, **options)
+    sampler = train_sampler(dataset, args, generator) if shuffle else None
+    return DataLoader(dataset, sampler=sampler, batch_size=args.batch_size, collate_fn=dataset.collate_fn,
+                      **options)
+
+
+def report_padding(task_ids, loaders):
+    '''Print the share of padding tokens per task, for random batches and for the batches of each loader.'''
+    rng = np.random.default_rng(0)
+    with torch.random.fork_rng(devices=[]):
+        for task_id, loader in zip(task_ids, loaders):
+            lengths = loader.dataset.lengths
+            order = rng.permutation(len(lengths))
+            batch_size = loader.batch_size or loader.batch_sampler.batch_size
+            random_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+            print(f"{task_id} padding ratio: random batches {padding_ratio(lengths, random_batches):.1%}, "
+                  f"this run {padding_ratio(lengths, list(loader.batch_sampler)):.1%}")
+
+
+def report_input_wait(streams, elapsed):
+    '''Print how long training waited for batches of each task stream during `elapsed` seconds.'''
+    wait = sum(stream.wait for stream in streams.values())
+    per_task = ', '.join(f"{task_id} {stream.wait:.1f}s" for task_id, stream in streams.items())
+    print(f"input pipeline: waited {wait:.1f}s for batches ({per_task}) in {elapsed:.1f}s of training, "
+          f"{1 - wait / max(elapsed, 1e-9):.1%} of the time computing")
+
+
+def train_metric_loader(loader, args, seed):
+    '''
+    In-memory batches of a fixed random sample of --train_eval_samples examples of a training
+    loader's dataset, for estimating train metrics at the end of each epoch. The sample is
+    drawn from its own RNG seeded with `seed`, so it is the same in every epoch and on
+    resume, and is sorted by length where the dataset knows its lengths.
+    '''
+    dataset = loader.dataset
+    sample = np.random.default_rng(seed).choice(len(dataset), min(args.train_eval_samples, len(dataset)),
+                                                replace=False)
+    if hasattr(dataset, 'lengths'):
+        sample = sample[np.argsort(np.asarray(dataset.lengths)[sample], kind='stable')]
+    batches = [sample[i:i + args.batch_size].tolist() for i in range(0, len(sample), args.batch_size)]
+    return CachedBatches(DataLoader(dataset, batch_sampler=batches, collate_fn=loader.collate_fn,
+                                    **loader_options(args, loader.num_workers)))
+
+
+def report_train_metrics(epoch, train_acc, sizes):
+    '''Print sampled train metrics with 95% confidence intervals.'''
+    intervals = {'sst': accuracy_interval(train_acc['sst'], sizes['sst']),
+                 'para': accuracy_interval(train_acc['para'], sizes['para']),
+                 'sts': correlation_interval(train_acc['sts'], sizes['sts'])}
+    print(f"Epoch {epoch}: train acc on {sizes['sst']}/{sizes['para']}/{sizes['sts']} sampled examples - " +
+          ", ".join(f"{task_id}::{train_acc[task_id]:.3f} [{low:.3f}, {high:.3f}]"
+                    for task_id, (low, high) in intervals.items()))
+
+
+def build_feature_loader(model, dataset, args, device, model_hash, shuffle, generator=None):
+    '''
+    Run the frozen BERT of `model` once over `dataset` (or load the result from
+    --feature_cache_dir) and return a loader over the cached pooler outputs instead.
+    '''
+    variant = ''
+    if isinstance(dataset, (SentencePairDataset, SentencePairTestDataset)):
+        fields = [('token_ids_1', 'attention_mask_1')]
+        variant = 'siamese' if args.siamese else 'concatenated'
+    else:
+        fields = [('token_ids', 'attention_mask')]
+    # Siamese batches stack both sentences of each pair in token_ids_1.
+    stacked = 2 if variant == 'siamese' else 1
+    # Iterating even a sequential loader draws its base seed from the global torch RNG; a
+    # forked RNG keeps the random stream training sees the same with and without a warm cache.
+    loader = build_dataloader(dataset, args, shuffle=False)
+    with torch.random.fork_rng(devices=[]):
+        features = encode_features(model.bert, loader, fields, args.feature_cache_dir, model_hash, device, variant,
+                                   stacked)
+
+    labeled = not isinstance(dataset, (SentenceClassificationTestDataset, SentencePairTestDataset))
+    labels = dataset.dataset.labels if labeled else None
+    feature_dataset = CachedFeatureDataset(features, labels, dataset.dataset.ids, getattr(dataset, 'isRegression', False))
+    sampler = train_sampler(feature_dataset, args, generator) if shuffle else None
+    return DataLoader(feature_dataset, sampler=sampler, batch_size=args.batch_size,
+                      collate_fn=feature_dataset.collate_fn)
+
+
+class TaskStream:
+    '''
+    Endless iterator over the batches of a shuffled training loader that can be saved and
+    restored mid-pass. Pass p over the data draws its batch order from the loader's
+    `generator`, seeded with (seed, p) rather than taken from the global RNG (or, for a
+    DistributedSampler, from its seed and epoch p), so the state is just the pass and the
+    number of batches already taken from it.
+
+    Each pass runs the loader's workers afresh. `wait` adds up the seconds spent waiting for
+    batches, i.e. the input work that did not overlap with training.
+    '''
+    def __init__(self, loader, generator, seed):
+        self.loader = loader
+        self.generator = generator
+        self.seed = seed
+        self.passes = 0
+        self.position = 0
+        self.iterator = None
+        self.wait = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        while True:
+            if self.iterator is None:
+                self.iterator = self.start()
+            try:
+                batch = next(self.iterator)
+            except StopIteration:
+                self.passes += 1
+                self.position = 0
+                self.iterator = None
+                continue
+            self.position += 1
+            self.wait += time.perf_counter() - start
+            return batch
+
+    def start(self):
+        self.generator.manual_seed(int(np.random.SeedSequence([*self.seed, self.passes]).generate_state(1)[0]))
+        if isinstance(self.loader.sampler, DistributedSampler):
+            self.loader.sampler.set_epoch(self.passes)
+        batches = list(self.loader.batch_sampler)[self.position:]
+        # The DataLoader draws its base seed from the generator too, keeping the global RNG intact.
+        return iter(DataLoader(self.loader.dataset, batch_sampler=batches, collate_fn=self.loader.collate_fn,
+                               num_workers=self.loader.num_workers, pin_memory=self.loader.pin_memory,
+                               prefetch_factor=self.loader.prefetch_factor, generator=self.generator))
+
+    def state_dict(self):
+        return {'passes': self.passes, 'position': self.position}
+
+    def load_state_dict(self, state_dict):
+        self.passes = state_dict['passes']
+        self.position = state_dict['position']
+        self.iterator = None
+
+
 def train_multitask(args):
     '''Train MultitaskBERT.
 
@@ -170,11 +496,6 @@ def train_multitask(args):
     look at test_multitask below to see how you can use the custom torch `Dataset`s
     in datasets.py to load in examples from the Quora and SemEval datasets.
     '''
-    def cycle(iterable):
-        while True:
-            for it in iterable:
-                yield it
-
     def compute_alpha(epoch, total_epoch, alpha_start=1.0, alpha_end=0.2, linear_decay=True):
         """Annealing of alpha from alpha_start to alpha_end."""
         assert 0 <= epoch < total_epoch
@@ -190,20 +511,82 @@ def train_multitask(args):
         scaled = sizes ** alpha
         return scaled / scaled.sum()
 
+    def batch_tokens(batch):
+        """Number of non-padding tokens in a batch."""
+        masks = [batch[key] for key in ('attention_mask', 'attention_mask_1', 'attention_mask_2') if key in batch]
+        return sum(int(mask.sum()) for mask in masks if mask.dim() > 0)
+
+    def draw_window(probs, max_batches):
+        """
+        Sample the (task_id, batch) micro-batches of one optimizer step. With
+        --effective_batch_tokens the window ends once all ranks together have seen that many
+        tokens, so every rank ends it after the same micro-batch and they stay in step.
+        """
+        window, tokens = [], 0
+        while len(window) < max_batches:
+            task_id = np.random.choice(task_ids, p=probs)
+            batch = next(loaders[task_id])
+            window.append((task_id, batch))
+            if args.effective_batch_tokens is not None:
+                count = batch_tokens(batch)
+                if world_size > 1:
+                    count = torch.tensor(count, dtype=torch.int64)
+                    dist.all_reduce(count)
+                    count = count.item()
+                tokens += count
+                if tokens >= args.effective_batch_tokens:
+                    break
+            elif len(window) == args.grad_accum_steps:
+                break
+        return window
+
+    def weigh_window(window):
+        """
+        Yield (task_id, batch, weight) for the micro-batches of a window, where weight scales the
+        batch's mean loss. Within a task, batches are weighted by their number of examples, so the
+        task's loss is its mean over all of its examples in the window; across tasks, each task
+        counts with its share of the window's micro-batches, as it would without accumulation.
+        """
+        examples, batches = {}, {}
+        for task_id, batch in window:
+            examples[task_id] = examples.get(task_id, 0) + len(batch['labels'])
+            batches[task_id] = batches.get(task_id, 0) + 1
+        for task_id, batch in window:
+            weight = len(batch['labels']) / examples[task_id] * batches[task_id] / len(window)
+            yield task_id, batch, weight
+
+    def task_loss(task_id, batch):
+        """Mean loss of a batch of the given task."""
+        b_labels = batch['labels'].to(device, non_blocking=True)
+        if task_id == 'sts':
+            logits = similarity_logits(model, batch, device)
+            return F.mse_loss(logits, b_labels.float(), reduction='mean')
+        elif task_id == 'para':
+            logits = paraphrase_logits(model, batch, device)
+            return F.binary_cross_entropy_with_logits(logits, b_labels.float(), reduction='mean')
+        else: # sst
+            logits = sentiment_logits(model, batch, device)
+            # Batches vary in size with --max_tokens and at the end of each pool, so average
+            # over the examples actually in the batch.
+            return F.cross_entropy(logits, b_labels.view(-1), reduction='mean')
+
     device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+    rank, world_size = distributed_info()
     # Create the data and its corresponding datasets and dataloader.
-    sst_train_data, num_labels,para_train_data, sts_train_data = load_multitask_data(args.sst_train,args.para_train,args.sts_train, split ='train')
-    sst_dev_data, num_labels,para_dev_data, sts_dev_data = load_multitask_data(args.sst_dev,args.para_dev,args.sts_dev, split ='dev')
-
+    # All six files are parsed concurrently, or mapped from --data_cache_dir if unchanged.
+    data = load_multitask_splits({'train': (args.sst_train, args.para_train, args.sts_train),
+                                  'dev': (args.sst_dev, args.para_dev, args.sts_dev)},
+                                 args.data_cache_dir, args.ingest_procs)
+    sst_train_data, num_labels,para_train_data, sts_train_data = data['train']
+    sst_dev_data, num_labels,para_dev_data, sts_dev_data = data['dev']
+
+    workers = task_workers(args)
     sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
-    sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                    collate_fn=sst_dev_data.collate_fn)
+    sst_dev_dataloader = build_dataloader(sst_dev_data, args, shuffle=False, num_workers=workers['sst'])
     para_dev_data = SentencePairDataset(para_dev_data, args)
-    para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                     collate_fn=para_dev_data.collate_fn)
+    para_dev_dataloader = build_dataloader(para_dev_data, args, shuffle=False, num_workers=workers['para'])
     sts_dev_data = SentencePairDataset(sts_dev_data, args, isRegression=True)
-    sts_dev_dataloader = DataLoader(sts_dev_data, shuffle=False, batch_size=args.batch_size,
-                                    collate_fn=sts_dev_data.collate_fn)
+    sts_dev_dataloader = build_dataloader(sts_dev_data, args, shuffle=False, num_workers=workers['sts'])
 
     sst_train_dataset = SentenceClassificationDataset(sst_train_data, args)
     para_train_dataset = SentencePairDataset(para_train_data, args, isRegression=False)
@@ -211,10 +594,11 @@ def train_multitask(args):
 
     task_ids = ['sst', 'para', 'sts']
     datasets = [sst_train_dataset, para_train_dataset, sts_train_dataset]
-    loaders_orig = [DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=args.batch_size,
-                          collate_fn=dataset.collate_fn) for dataset in datasets]
-    loaders = [iter(cycle(loader)) for loader in loaders_orig]  # infinitely iterable iterators
-    loaders = dict(zip(task_ids, loaders))
+    generators = [torch.Generator() for _ in datasets]
+    loaders_orig = [build_dataloader(dataset, args, shuffle=True, generator=generator, num_workers=workers[task_id])
+                    for task_id, dataset, generator in zip(task_ids, datasets, generators)]
+    if rank == 0:
+        report_padding(task_ids, loaders_orig)
 
     # Init model.
     config = {'hidden_dropout_prob': args.hidden_dropout_prob,
@@ -222,144 +606,236 @@ def train_multitask(args):
               'hidden_size': 768,
               'data_dir': '.',
               'fine_tune_mode': args.fine_tune_mode,
-              'siamese': args.siamese}
+              'siamese': args.siamese,
+              'unpadded_encoder': args.unpadded_encoder,
+              'fused_qkv': args.fused_qkv,
+              'attention_backend': args.attention_backend}
 
     config = SimpleNamespace(**config)
 
     model = MultitaskBERT(config)
     model = model.to(device)
     model.train()
-    writer = SummaryWriter()
+    writer = SummaryWriter() if rank == 0 else None
+    if world_size > 1:
+        # Start every rank from rank 0's weights, and give each its own dropout masks.
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src=0)
+        torch.manual_seed(args.seed + rank)
+
+    if args.cache_features:
+        # BERT is frozen, so its outputs are computed once and only the heads see each batch.
+        model_hash = checkpoint_hash(model.bert)
+        loaders_orig = [build_feature_loader(model, dataset, args, device, model_hash, shuffle=True, generator=generator)
+                        for dataset, generator in zip(datasets, generators)]
+        sst_dev_dataloader, para_dev_dataloader, sts_dev_dataloader = [
+            build_feature_loader(model, dataset, args, device, model_hash, shuffle=False)
+            for dataset in (sst_dev_data, para_dev_data, sts_dev_data)]
+    elif args.siamese:
+        # Siamese dev pairs are scored from embeddings of their distinct sentences, encoded
+        # once per evaluation.
+        sentence_index = SentenceEmbeddingIndex([para_dev_data, sts_dev_data])
+
+    # Dev batches are collated once, so each epoch's evaluation is only model compute. Siamese
+    # para and sts dev batches come from sentence_index instead.
+    sst_dev_dataloader = CachedBatches(sst_dev_dataloader)
+    if args.cache_features or not args.siamese:
+        para_dev_dataloader, sts_dev_dataloader = CachedBatches(para_dev_dataloader), CachedBatches(sts_dev_dataloader)
+    # Train metrics are estimated on a fixed sample rather than a pass over the training sets,
+    # and only by the rank that reports them.
+    train_eval_loaders = None
+    if args.train_eval_samples > 0 and rank == 0:
+        train_eval_loaders = [train_metric_loader(loader, args, (args.seed, i)) for i, loader in enumerate(loaders_orig)]
+
+    # Infinitely iterable batch streams, one per task.
+    loaders = {task_id: TaskStream(loader, generator, (args.seed, i))
+               for i, (task_id, loader, generator) in enumerate(zip(task_ids, loaders_orig, generators))}
 
     lr = args.lr
-    optimizer = AdamW(model.parameters(), lr=lr)
+    optimizer = AdamW(model.parameters(), lr=lr, state_precision=args.optimizer_state,
+                      foreach=args.optimizer_impl == 'foreach', flat=args.optimizer_impl == 'flat')
     best_avg_dev_acc = 0
+    start_epoch, start_step = 0, 0
+    if args.resume and os.path.exists(resume_path(args)):
+        start_epoch, start_step, best_avg_dev_acc = load_checkpoint(model, optimizer, loaders, args)
 
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         model.train()
         alpha = compute_alpha(epoch, args.epochs, 1.0, 0.2, linear_decay=True)
         probs = get_task_probs(alpha, np.array([len(dataset) for dataset in datasets]))
-        writer.add_scalars("Sampling Prob", dict(zip(task_ids, probs)), epoch)
+        if writer is not None:
+            writer.add_scalars("Sampling Prob", dict(zip(task_ids, probs)), epoch)
 
         num_steps = 300_000//args.batch_size
         num_steps = 10000
-        for step in tqdm(range(num_steps), f'train-{epoch}', disable=TQDM_DISABLE):   # total examples / batch_size
-            task_id = np.random.choice(task_ids, p=probs)
-            batch = next(loaders[task_id])
-            if task_id in ['sts', 'para']:
-                (b_ids1, b_mask1,
-                 b_ids2, b_mask2,
-                 b_labels, b_sent_ids) = (batch['token_ids_1'], batch['attention_mask_1'],
-                                          batch['token_ids_2'], batch['attention_mask_2'],
-                                          batch['labels'], batch['sent_ids'])
-
-                b_ids1 = b_ids1.to(device)
-                b_mask1 = b_mask1.to(device)
-                b_ids2 = b_ids2.to(device)
-                b_mask2 = b_mask2.to(device)
-                b_labels = b_labels.to(device)
-
-                optimizer.zero_grad()
-                if task_id == 'sts':
-                    logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
-                    loss = F.mse_loss(logits, b_labels.float(), reduction='mean')
-
-                else: # para
-                    logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
-                    loss = F.binary_cross_entropy_with_logits(logits, b_labels.float(), reduction='mean')
-
-                loss.backward()
-                optimizer.step()
-            else: # sst
-                b_ids, b_mask, b_labels = (batch['token_ids'],
-                                           batch['attention_mask'], batch['labels'])
-
-                b_ids = b_ids.to(device)
-                b_mask = b_mask.to(device)
-                b_labels = b_labels.to(device)
-
-                optimizer.zero_grad()
-                logits = model.predict_sentiment(b_ids, b_mask)
-                loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
-
-                loss.backward()
-                optimizer.step()
-
-        train_sentiment_accuracy, _, _, \
-            train_paraphrase_accuracy, _, _, \
-            train_sts_corr, _, _ = model_eval_multitask(loaders_orig[0], loaders_orig[1], loaders_orig[2], model, device)
-        dev_sentiment_accuracy, _, _, \
-            dev_paraphrase_accuracy, _, _, \
-            dev_sts_corr, _, _ = model_eval_multitask(sst_dev_dataloader,para_dev_dataloader,sts_dev_dataloader,model,device)
+        # num_steps counts micro-batches; the optimizer steps once per accumulation window.
+        # Data-parallel ranks each take a share, so an epoch covers as many examples.
+        num_steps //= world_size
+        step = start_step if epoch == start_epoch else 0
+        progress = tqdm(total=num_steps, initial=step, desc=f'train-{epoch}', disable=TQDM_DISABLE or rank != 0)
+        for stream in loaders.values():
+            stream.wait = 0.0
+        train_start = time.perf_counter()
+        while step < num_steps:
+            window = draw_window(probs, num_steps - step)
+            optimizer.zero_grad()
+            for task_id, batch, weight in weigh_window(window):
+                with autocast(args, device):
+                    loss = task_loss(task_id, batch)
+                (loss * weight).backward()
+            if world_size > 1:
+                all_reduce_gradients(model)
+            optimizer.step()
+            step += len(window)
+            progress.update(len(window))
+            if args.checkpoint_every > 0 and step // args.checkpoint_every > (step - len(window)) // args.checkpoint_every:
+                save_checkpoint(model, optimizer, loaders, epoch, step, best_avg_dev_acc, args, config)
+        progress.close()
+        if rank == 0:
+            report_input_wait(loaders, time.perf_counter() - train_start)
+
+        with autocast(args, device):
+            if args.siamese and not args.cache_features:
+                sentence_index.encode(model, 2 * args.batch_size, device)
+                para_dev_dataloader, sts_dev_dataloader = [sentence_index.pair_loader(dataset, args.batch_size)
+                                                           for dataset in (para_dev_data, sts_dev_data)]
+            if train_eval_loaders is not None:
+                train_sentiment_accuracy, train_sst_pred, _, \
+                    train_paraphrase_accuracy, train_para_pred, _, \
+                    train_sts_corr, train_sts_pred, _ = model_eval_multitask(*train_eval_loaders, model, device)
+            dev_sentiment_accuracy, _, _, \
+                dev_paraphrase_accuracy, _, _, \
+                dev_sts_corr, _, _ = model_eval_multitask(sst_dev_dataloader,para_dev_dataloader,sts_dev_dataloader,model,device)
 
         avg_dev_acc = (dev_sentiment_accuracy + dev_paraphrase_accuracy + dev_sts_corr) / 3
-        avg_train_acc = (train_sentiment_accuracy + train_paraphrase_accuracy + train_sts_corr) / 3
+        # Every rank evaluates the same model on the full dev sets, so they all agree on the best
+        # epoch.
         if avg_dev_acc > best_avg_dev_acc:
             best_avg_dev_acc = avg_dev_acc
-            save_model(model, optimizer, args, config, args.filepath)
-        train_acc = {'sst':train_sentiment_accuracy, 'para': train_paraphrase_accuracy, 'sts': train_sts_corr, 'avg': avg_train_acc}
+            if rank == 0:
+                save_model(model, optimizer, args, config, args.filepath)
         dev_acc = {'sst':dev_sentiment_accuracy, 'para': dev_paraphrase_accuracy, 'sts': dev_sts_corr, 'avg': avg_dev_acc}
-        writer.add_scalars('train acc', train_acc, epoch)
-        writer.add_scalars('dev acc', dev_acc, epoch)
-        print(f"Epoch {epoch}:  dev acc - "
-              f"sst::{dev_sentiment_accuracy :.3f}, "
-              f"para::{dev_paraphrase_accuracy :.3f}, "
-              f"sts::{dev_sts_corr :.3f}" 
-              f"avg::{avg_dev_acc :.3f}")
+        if train_eval_loaders is not None:
+            avg_train_acc = (train_sentiment_accuracy + train_paraphrase_accuracy + train_sts_corr) / 3
+            train_acc = {'sst':train_sentiment_accuracy, 'para': train_paraphrase_accuracy, 'sts': train_sts_corr, 'avg': avg_train_acc}
+            writer.add_scalars('train acc', train_acc, epoch)
+            report_train_metrics(epoch, train_acc, {'sst': len(train_sst_pred), 'para': len(train_para_pred),
+                                                    'sts': len(train_sts_pred)})
+        if rank == 0:
+            writer.add_scalars('dev acc', dev_acc, epoch)
+            print(f"Epoch {epoch}:  dev acc - "
+                  f"sst::{dev_sentiment_accuracy :.3f}, "
+                  f"para::{dev_paraphrase_accuracy :.3f}, "
+                  f"sts::{dev_sts_corr :.3f}" 
+                  f"avg::{avg_dev_acc :.3f}")
+        # A checkpoint holds the full optimizer state and takes a while to write; only runs that
+        # may be resumed pay for it.
+        if args.resume or args.checkpoint_every > 0:
+            save_checkpoint(model, optimizer, loaders, epoch + 1, 0, best_avg_dev_acc, args, config)
+
+def train_distributed(rank, args):
+    '''
+    One process of data-parallel training: rank `rank` of --nprocs processes started by
+    torch.multiprocessing.spawn, or of the processes started by torchrun, which sets the
+    rendezvous environment itself. Gradients are averaged with the gloo backend.
+    '''
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    os.environ.setdefault('RANK', str(rank))
+    os.environ.setdefault('WORLD_SIZE', str(args.nprocs))
+    dist.init_process_group('gloo')
+    # Share the cores of the machine between the local processes.
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    seed_everything(args.seed)
+    try:
+        train_multitask(args)
+    finally:
+        dist.destroy_process_group()
 
-def test_multitask(args):
-    '''Test and save predictions on the dev and test sets of all three tasks.'''
-    with torch.no_grad():
-        device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+
+def load_test_model(args, device):
+    '''
+    The trained model at args.filepath and its config. With --int8 the model is the
+    dynamically quantized copy (see bert.load_int8_model), cached next to the checkpoint.
+    '''
+    def load_model():
         saved = torch.load(args.filepath, weights_only=False)
         config = saved['model_config']
-
         model = MultitaskBERT(config)
-        model.load_state_dict(saved['model'])
-        model = model.to(device)
+        # Checkpoints of last-linear-layer runs leave out the frozen, pretrained BERT weights.
+        model_state = model.state_dict()
+        model_state.update(saved['model'])
+        model.load_state_dict(model_state)
         print(f"Loaded model to test from {args.filepath}")
+        return model, config
 
-        sst_test_data, num_labels,para_test_data, sts_test_data = \
-            load_multitask_data(args.sst_test,args.para_test, args.sts_test, split='test')
+    if args.int8:
+        return load_int8_model(args.filepath, load_model)
+    model, config = load_model()
+    return model.to(device), config
 
-        sst_dev_data, num_labels,para_dev_data, sts_dev_data = \
-            load_multitask_data(args.sst_dev,args.para_dev,args.sts_dev,split='dev')
+
+def test_multitask(args):
+    '''Test and save predictions on the dev and test sets of all three tasks.'''
+    with torch.no_grad():
+        device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
+        model, config = load_test_model(args, device)
+        workers = task_workers(args)
+
+        data = load_multitask_splits({'test': (args.sst_test, args.para_test, args.sts_test),
+                                      'dev': (args.sst_dev, args.para_dev, args.sts_dev)},
+                                     args.data_cache_dir, args.ingest_procs)
+        sst_test_data, num_labels,para_test_data, sts_test_data = data['test']
+        sst_dev_data, num_labels,para_dev_data, sts_dev_data = data['dev']
 
         sst_test_data = SentenceClassificationTestDataset(sst_test_data, args)
         sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
 
-        sst_test_dataloader = DataLoader(sst_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sst_test_data.collate_fn)
-        sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sst_dev_data.collate_fn)
+        sst_test_dataloader = build_dataloader(sst_test_data, args, shuffle=False, num_workers=workers['sst'])
+        sst_dev_dataloader = build_dataloader(sst_dev_data, args, shuffle=False, num_workers=workers['sst'])
 
         para_test_data = SentencePairTestDataset(para_test_data, args)
         para_dev_data = SentencePairDataset(para_dev_data, args)
 
-        para_test_dataloader = DataLoader(para_test_data, shuffle=True, batch_size=args.batch_size,
-                                          collate_fn=para_test_data.collate_fn)
-        para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                         collate_fn=para_dev_data.collate_fn)
+        para_test_dataloader = build_dataloader(para_test_data, args, shuffle=False, num_workers=workers['para'])
+        para_dev_dataloader = build_dataloader(para_dev_data, args, shuffle=False, num_workers=workers['para'])
 
         sts_test_data = SentencePairTestDataset(sts_test_data, args)
         sts_dev_data = SentencePairDataset(sts_dev_data, args, isRegression=True)
 
-        sts_test_dataloader = DataLoader(sts_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sts_test_data.collate_fn)
-        sts_dev_dataloader = DataLoader(sts_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sts_dev_data.collate_fn)
-
-        dev_sentiment_accuracy,dev_sst_y_pred, dev_sst_sent_ids, \
-            dev_paraphrase_accuracy, dev_para_y_pred, dev_para_sent_ids, \
-            dev_sts_corr, dev_sts_y_pred, dev_sts_sent_ids = model_eval_multitask(sst_dev_dataloader,
-                                                                    para_dev_dataloader,
-                                                                    sts_dev_dataloader, model, device)
-
-        test_sst_y_pred, \
-            test_sst_sent_ids, test_para_y_pred, test_para_sent_ids, test_sts_y_pred, test_sts_sent_ids = \
-                model_eval_test_multitask(sst_test_dataloader,
-                                          para_test_dataloader,
-                                          sts_test_dataloader, model, device)
+        sts_test_dataloader = build_dataloader(sts_test_data, args, shuffle=False, num_workers=workers['sts'])
+        sts_dev_dataloader = build_dataloader(sts_dev_data, args, shuffle=False, num_workers=workers['sts'])
+
+        if args.cache_features and config.fine_tune_mode == 'last-linear-layer':
+            model_hash = checkpoint_hash(model.bert)
+            (sst_dev_dataloader, para_dev_dataloader, sts_dev_dataloader,
+             sst_test_dataloader, para_test_dataloader, sts_test_dataloader) = [
+                build_feature_loader(model, dataset, args, device, model_hash, shuffle=False)
+                for dataset in (sst_dev_data, para_dev_data, sts_dev_data,
+                                sst_test_data, para_test_data, sts_test_data)]
+        elif config.siamese:
+            pair_datasets = (para_dev_data, sts_dev_data, para_test_data, sts_test_data)
+            sentence_index = SentenceEmbeddingIndex(pair_datasets)
+            with autocast(args, device):
+                sentence_index.encode(model, 2 * args.batch_size, device)
+            para_dev_dataloader, sts_dev_dataloader, para_test_dataloader, sts_test_dataloader = [
+                sentence_index.pair_loader(dataset, args.batch_size) for dataset in pair_datasets]
+
+        start = time.perf_counter()
+        with autocast(args, device):
+            dev_sentiment_accuracy,dev_sst_y_pred, dev_sst_sent_ids, \
+                dev_paraphrase_accuracy, dev_para_y_pred, dev_para_sent_ids, \
+                dev_sts_corr, dev_sts_y_pred, dev_sts_sent_ids = model_eval_multitask(sst_dev_dataloader,
+                                                                        para_dev_dataloader,
+                                                                        sts_dev_dataloader, model, device)
+            print(f"dev eval time :: {time.perf_counter() - start :.1f}s")
+
+            test_sst_y_pred, \
+                test_sst_sent_ids, test_para_y_pred, test_para_sent_ids, test_sts_y_pred, test_sts_sent_ids = \
+                    model_eval_test_multitask(sst_test_dataloader,
+                                              para_test_dataloader,
+                                              sts_test_dataloader, model, device)
 
         with open(args.sst_dev_out, "w+") as f:
             print(f"dev sentiment acc :: {dev_sentiment_accuracy :.3f}")
@@ -415,6 +891,8 @@ def get_args():
                         help='last-linear-layer: the BERT parameters are frozen and the task specific head parameters are updated; full-model: BERT parameters are updated as well',
                         choices=('last-linear-layer', 'full-model'), default="last-linear-layer")
     parser.add_argument("--use_gpu", action='store_true')
+    parser.add_argument("--precision", type=str, choices=('fp32', 'bf16'), default='fp32',
+                        help='bf16: run forward passes under bf16 autocast, keeping fp32 weights and optimizer state')
 
     parser.add_argument("--sst_dev_out", type=str, default="predictions/sst-dev-output.csv")
     parser.add_argument("--sst_test_out", type=str, default="predictions/sst-test-output.csv")
@@ -426,13 +904,84 @@ def get_args():
     parser.add_argument("--sts_test_out", type=str, default="predictions/sts-test-output.csv")
 
     parser.add_argument("--batch_size", help='sst: 64, cfimdb: 8 can fit a 12GB GPU', type=int, default=8)
+    parser.add_argument("--bucket_multiplier", type=int, default=0,
+                        help='group training batches by length within pools of batch_size * bucket_multiplier examples (e.g. 100) and sort evaluation batches by length; 0 (default) keeps plain random batches')
+    parser.add_argument("--max_tokens", type=int, default=None,
+                        help='fill each batch up to this many padded tokens (examples x longest length) instead of a fixed batch_size')
+    parser.add_argument("--grad_accum_steps", type=int, default=1,
+                        help='accumulate gradients over this many micro-batches (of any task) per optimizer step')
+    parser.add_argument("--effective_batch_tokens", type=int, default=None,
+                        help='accumulate micro-batches until they hold at least this many non-padding tokens, then step; counted over all ranks in data-parallel training')
     parser.add_argument("--hidden_dropout_prob", type=float, default=0.3)
     parser.add_argument("--lr", type=float, help="learning rate", default=1e-5)
+    parser.add_argument("--optimizer_impl", type=str, choices=('loop', 'foreach', 'flat'), default='loop',
+                        help='loop: per-parameter AdamW updates; foreach: multi-tensor torch._foreach_* ops; flat: one contiguous buffer per dtype updated chunk by chunk (all three give the same results)')
+    parser.add_argument("--optimizer_state", type=str, choices=('fp32', 'bf16', 'int8'), default='fp32',
+                        help='storage of the AdamW moments: bf16 halves their memory, int8 (block-quantized) quarters it')
 
     # new args
     parser.add_argument('--siamese', action='store_true')
     parser.add_argument('--test_only', action='store_true')
+    parser.add_argument('--unpadded_encoder', action='store_true',
+                        help='run the BERT dense and LayerNorm layers on non-padding tokens only')
+    parser.add_argument('--fused_qkv', action='store_true',
+                        help='compute query/key/value with one fused projection; checkpoints keep the unfused layout')
+    parser.add_argument('--attention_backend', type=str, choices=('eager', 'sdpa', 'chunked'), default='eager',
+                        help='eager: reference implementation; sdpa: torch scaled_dot_product_attention; chunked: blocks of queries to bound score memory')
+    parser.add_argument('--token_cache_dir', type=str, default='.token_cache',
+                        help='directory for memory-mapped pre-tokenized splits; rebuilt when the vocab, lowercasing or truncation settings change')
+    parser.add_argument('--data_cache_dir', type=str, default='.data_cache',
+                        help='directory for the parsed, preprocessed data files, reused while each file keeps its mtime and size')
+    parser.add_argument('--ingest_procs', type=int, default=None,
+                        help='processes parsing data files that are not cached yet; default one per file, at most one per CPU')
+    parser.add_argument('--tokenize_procs', type=int, default=1,
+                        help='processes tokenizing sentences that are not in --token_cache_dir yet (inputs of at least 512 sentences)')
+    parser.add_argument('--cache_features', action='store_true',
+                        help='with --fine-tune-mode last-linear-layer, run BERT once per split and train the heads on cached pooler outputs')
+    parser.add_argument('--feature_cache_dir', type=str, default='.feature_cache',
+                        help='directory for the float16 feature caches of --cache_features, keyed by BERT weights and sentences')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0],
+                        help='DataLoader worker processes that collate batches in the background, for all tasks or per task (sst para sts); 0 collates in the training loop')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches each worker keeps ready, bounding the prefetch queue of a task at num_workers * prefetch_factor batches')
+    parser.add_argument('--train_eval_samples', type=int, default=2000,
+                        help='estimate train metrics at the end of each epoch on a fixed random sample of this many examples per task, with 95%% confidence intervals; 0 skips them')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='data-parallel training with this many local processes (gloo); under torchrun, its WORLD_SIZE is used instead. --batch_size is per process')
+    parser.add_argument('--master_port', type=int, default=29500, help='rendezvous port for --nprocs')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue training from the checkpoint written next to the model file, if there is one')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='write the resume checkpoint every this many training steps (micro-batches) and after each epoch; 0 writes none unless --resume is given, which then checkpoints after each epoch')
+    parser.add_argument('--int8', action='store_true',
+                        help='test with dynamically quantized int8 linear layers (CPU only); the quantized model is saved next to the checkpoint')
     args = parser.parse_args()
+    if args.int8 and (args.use_gpu or args.precision != 'fp32' or args.cache_features):
+        parser.error('--int8 runs on CPU in fp32 and cannot be combined with --use_gpu, --precision bf16 or --cache_features')
+    if args.cache_features and args.fine_tune_mode != 'last-linear-layer':
+        parser.error('--cache_features requires --fine-tune-mode last-linear-layer')
+    if len(args.num_workers) not in (1, 3) or min(args.num_workers) < 0:
+        parser.error('--num_workers takes one count for all tasks or three (sst para sts), none negative')
+    if args.optimizer_impl != 'loop' and args.optimizer_state != 'fp32':
+        parser.error('--optimizer_state bf16 and int8 require --optimizer_impl loop')
+    if args.tokenize_procs < 1:
+        parser.error('--tokenize_procs must be at least 1')
+    if args.ingest_procs is not None and args.ingest_procs < 1:
+        parser.error('--ingest_procs must be at least 1')
+    if args.train_eval_samples < 0:
+        parser.error('--train_eval_samples must not be negative')
+    if args.prefetch_factor < 1:
+        parser.error('--prefetch_factor must be at least 1')
+    if args.nprocs < 1:
+        parser.error('--nprocs must be at least 1')
+    if args.use_gpu and (args.nprocs > 1 or int(os.environ.get('WORLD_SIZE', 1)) > 1):
+        parser.error('data-parallel training runs on CPU and cannot be combined with --use_gpu')
+    if args.checkpoint_every < 0:
+        parser.error('--checkpoint_every must not be negative')
+    if args.grad_accum_steps < 1:
+        parser.error('--grad_accum_steps must be at least 1')
+    if args.effective_batch_tokens is not None and (args.grad_accum_steps != 1 or args.cache_features):
+        parser.error('--effective_batch_tokens cannot be combined with --grad_accum_steps or --cache_features')
     return args
 
 
@@ -441,6 +990,16 @@ if __name__ == "__main__":
     siamese = 'siamese'if args.siamese else 'concate'
     args.filepath = f'{siamese}-{args.fine_tune_mode}-{args.epochs}-{args.lr}-multitask.pt' # Save path.
     seed_everything(args.seed)  # Fix the seed for reproducibility.
-    if not args.test_only:
-        train_multitask(args)
-    test_multitask(args)
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        # Started by torchrun: every process trains, rank 0 then tests.
+        if not args.test_only:
+            train_distributed(int(os.environ['RANK']), args)
+        if int(os.environ['RANK']) == 0:
+            test_multitask(args)
+    else:
+        if not args.test_only:
+            if args.nprocs > 1:
+                torch.multiprocessing.spawn(train_distributed, args=(args,), nprocs=args.nprocs)
+            else:
+                train_multitask(args)
+        test_multitask(args)
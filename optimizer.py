@@ -5,6 +5,80 @@ import torch
 from torch.optim import Optimizer
 
 
+# Elements updated at a time by flat AdamW; small enough for the chunk and its scratch space
+# to stay in cache.
+FLAT_CHUNK_SIZE = 1 << 16
+
+
+# Values per scale in 8-bit optimizer state.
+QUANT_BLOCK_SIZE = 256
+# The 8-bit codes are spaced logarithmically: the first moment has 127 levels per sign for
+# magnitudes between 10**-QUANT_DECADES and 1 times the block maximum, the second moment
+# (v ~ grad**2) 255 levels over twice as many decades. Both are stored with a relative error
+# of at most ~3%, which is ~1.5% on the sqrt(v) in the update.
+QUANT_DECADES = 3
+
+
+def _code_spacing(signed):
+    '''The number of positive codes and the log2 ratio between consecutive code magnitudes.'''
+    levels, decades = (127, QUANT_DECADES) if signed else (255, 2 * QUANT_DECADES)
+    return levels, decades * math.log2(10) / (levels - 1)
+
+
+def quantize_blockwise(x, signed):
+    '''
+    Compress x to 8-bit codes with one fp32 scale (the absolute maximum) per block of
+    QUANT_BLOCK_SIZE values. Returns (codes, scales); codes are int8 if signed else uint8.
+    Code 0 is exact zero and code c > 0 stands for the magnitude
+    2 ** ((c - levels) * step) times the block maximum, so small values keep their relative
+    precision next to large ones in the same block.
+    '''
+    levels, step = _code_spacing(signed)
+    flat = x.detach().float().flatten()
+    if flat.numel() % QUANT_BLOCK_SIZE:
+        flat = torch.nn.functional.pad(flat, (0, -flat.numel() % QUANT_BLOCK_SIZE))
+    flat = flat.view(-1, QUANT_BLOCK_SIZE)
+    magnitude = flat.abs()
+    scales = magnitude.amax(dim=1)
+    log_scales = torch.log2(scales.clamp(min=torch.finfo(torch.float32).tiny)).unsqueeze(1)
+
+    # Round to the nearest code in log space; magnitudes below the smallest code become 0.
+    codes = torch.log2(magnitude).sub_(log_scales).div_(step).add_(levels).round_().clamp_(0, levels)
+    if signed:
+        return codes.copysign_(flat).to(torch.int8), scales
+    # Never store a positive second moment as zero: that would turn its update into m / eps.
+    codes.clamp_(min=1).masked_fill_(magnitude == 0, 0)
+    return codes.to(torch.uint8), scales
+
+
+def dequantize_blockwise(codes, scales, shape, signed):
+    levels, step = _code_spacing(signed)
+    codes = codes.float()
+    rel = codes.abs().sub_(levels).mul_(step).exp2_().masked_fill_(codes == 0, 0)
+    if signed:
+        rel.copysign_(codes)
+    numel = math.prod(shape)
+    return rel.mul_(scales.unsqueeze(1)).view(-1)[:numel].view(shape)
+
+
+def to_bfloat16_stochastic(x, generator):
+    '''
+    Round fp32 x to bf16 stochastically. bf16 keeps the top 16 bits of an fp32 value, so
+    adding random low bits before truncating rounds up with probability equal to the
+    dropped fraction.
+    '''
+    bits = x.float().contiguous().view(torch.int32)
+    noise = torch.randint(0, 1 << 16, x.shape, generator=generator, device=x.device, dtype=torch.int32)
+    return ((bits + noise) & -65536).view(torch.float32).to(torch.bfloat16)
+
+
+def _mark_has_grad(buffer, i):
+    '''Gradient hook recording that parameter i of a flat buffer received a gradient.'''
+    def hook(param):
+        buffer['has_grad'][i] = True
+    return hook
+
+
 class AdamW(Optimizer):
     def __init__(
             self,
@@ -14,7 +88,31 @@ class AdamW(Optimizer):
             eps: float = 1e-6,
             weight_decay: float = 0.0,
             correct_bias: bool = True,
+            foreach: bool = False,
+            flat: bool = False,
+            state_precision: str = 'fp32',
     ):
+        '''
+        foreach: update all parameters of a group with a few multi-tensor torch._foreach_*
+            ops instead of a Python loop of per-parameter ops.
+        flat: keep the parameters, gradients and moments of each group in one contiguous
+            buffer per dtype and device, and update each buffer chunk by chunk. The
+            parameters become views into the buffer on the first step, and zero_grad zeroes
+            the gradient buffer in place. A gradient hook records which parameters received
+            a gradient since zero_grad; the others are skipped, as the per-parameter loop
+            skips parameters whose .grad is None, and keep their own step counts.
+
+        Both give the same results as the default per-parameter loop.
+
+        state_precision: how the moments m and v are stored between steps. 'fp32' keeps full
+            copies of the parameters; 'bf16' halves that, and 'int8' stores one byte per value
+            plus one fp32 scale per QUANT_BLOCK_SIZE values (see quantize_blockwise). The
+            moments are decompressed to fp32 for each update. bf16 moments are stored again
+            with stochastic rounding, as rounding to nearest would drop changes below bf16
+            resolution, such as the 0.1% decay of v per step with beta2 = 0.999. 8-bit codes
+            are coarse enough that the noise of stochastic rounding outweighs that bias, so
+            they are rounded to nearest. Only the per-parameter loop supports compressed state.
+        '''
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if not 0.0 <= betas[0] < 1.0:
@@ -23,15 +121,50 @@ class AdamW(Optimizer):
             raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
+        if foreach and flat:
+            raise ValueError("Only one of foreach and flat can be set")
+        if state_precision not in ('fp32', 'bf16', 'int8'):
+            raise ValueError("Invalid state precision: {} - should be fp32, bf16 or int8".format(state_precision))
+        if state_precision != 'fp32' and (foreach or flat):
+            raise ValueError("Compressed optimizer state is only supported without foreach and flat")
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
         super().__init__(params, defaults)
+        self.foreach = foreach
+        self.flat = flat
+        self.state_precision = state_precision
+        # Random bits for stochastic rounding of bf16 state, kept apart from the global
+        # RNG so that the choice of state precision does not change e.g. dropout masks.
+        self._rounding_generators = {}
+        # One list of buffers per param group, built on the first step in flat mode.
+        self._flat_buffers = None
+
+    def add_param_group(self, param_group):
+        # Frozen parameters never get a gradient, so leave them out of the group: step,
+        # zero_grad and state_dict then only see what is trained. Parameters unfrozen later
+        # have to be added with add_param_group again.
+        params = param_group['params']
+        if not isinstance(params, (torch.Tensor, set)):
+            params = [p for p in params if (p[1] if isinstance(p, tuple) else p).requires_grad]
+            param_group = dict(param_group, params=params)
+        super().add_param_group(param_group)
 
     def step(self, closure: Callable = None):
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.flat:
+            if self._flat_buffers is None:
+                self._flat_buffers = [self._build_flat_buffers(group) for group in self.param_groups]
+            for group, buffers in zip(self.param_groups, self._flat_buffers):
+                for buffer in buffers:
+                    self._flat_step(group, buffer)
+            return loss
+
         for group in self.param_groups:
+            if self.foreach:
+                self._foreach_step(group)
+                continue
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -62,16 +195,213 @@ class AdamW(Optimizer):
                 ### TODO
                 if len(state) == 0:
                     state['t'] = 0
-                    state['m'] = torch.zeros_like(grad)
-                    state['v'] = torch.zeros_like(grad)
+                    self._init_moments(state, grad)
+                m, v = self._load_moments(state, grad)
                 beta1, beta2 = group["betas"]
                 state['t'] += 1
-                state['m'].mul_(beta1).add_(grad, alpha=1 - beta1)
-                state['v'].mul_(beta2).add_(grad **2, alpha=1 - beta2)
+                m.mul_(beta1).add_(grad, alpha=1 - beta1)
+                v.mul_(beta2).add_(grad **2, alpha=1 - beta2)
                 alpha_t = alpha * (1 - beta2**state['t'])**0.5 / (1 - beta1**state['t'])
-                p.data -= alpha_t * state['m'] / (state['v'].sqrt() + group['eps'])
+                p.data -= alpha_t * m / (v.sqrt() + group['eps'])
+                self._store_moments(state, m, v)
 
                 # Weight decay
                 p.data -= alpha * group['weight_decay'] * p.data
 
         return loss
+
+    def _init_moments(self, state, grad):
+        if self.state_precision == 'fp32':
+            state['m'] = torch.zeros_like(grad)
+            state['v'] = torch.zeros_like(grad)
+        elif self.state_precision == 'bf16':
+            state['m'] = torch.zeros_like(grad, dtype=torch.bfloat16)
+            state['v'] = torch.zeros_like(grad, dtype=torch.bfloat16)
+        else:
+            state['m'], state['m_scale'] = quantize_blockwise(torch.zeros_like(grad), signed=True)
+            state['v'], state['v_scale'] = quantize_blockwise(torch.zeros_like(grad), signed=False)
+
+    def _load_moments(self, state, grad):
+        '''The moments as fp32 tensors shaped like grad; for fp32 state, the state itself.'''
+        if self.state_precision == 'fp32':
+            return state['m'], state['v']
+        if self.state_precision == 'bf16':
+            return state['m'].float(), state['v'].float()
+        return (dequantize_blockwise(state['m'], state['m_scale'], grad.shape, signed=True),
+                dequantize_blockwise(state['v'], state['v_scale'], grad.shape, signed=False))
+
+    def _store_moments(self, state, m, v):
+        if self.state_precision == 'bf16':
+            if m.device not in self._rounding_generators:
+                self._rounding_generators[m.device] = torch.Generator(m.device).manual_seed(0)
+            generator = self._rounding_generators[m.device]
+            state['m'] = to_bfloat16_stochastic(m, generator)
+            state['v'] = to_bfloat16_stochastic(v, generator)
+        elif self.state_precision == 'int8':
+            state['m'], state['m_scale'] = quantize_blockwise(m, signed=True)
+            state['v'], state['v_scale'] = quantize_blockwise(v, signed=False)
+
+    def _foreach_step(self, group):
+        params, grads, ms, vs, alpha_ts = [], [], [], [], []
+        beta1, beta2 = group["betas"]
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+            state = self.state[p]
+            if len(state) == 0:
+                state['t'] = 0
+                state['m'] = torch.zeros_like(p.grad)
+                state['v'] = torch.zeros_like(p.grad)
+            state['t'] += 1
+            params.append(p.data)
+            grads.append(p.grad.data)
+            ms.append(state['m'])
+            vs.append(state['v'])
+            alpha_ts.append(group["lr"] * (1 - beta2**state['t'])**0.5 / (1 - beta1**state['t']))
+        if not params:
+            return
+
+        # The same sequence of operations as the per-parameter loop, so results match exactly.
+        torch._foreach_mul_(ms, beta1)
+        torch._foreach_add_(ms, grads, alpha=1 - beta1)
+        torch._foreach_mul_(vs, beta2)
+        torch._foreach_add_(vs, torch._foreach_mul(grads, grads), alpha=1 - beta2)
+        denom = torch._foreach_sqrt(vs)
+        torch._foreach_add_(denom, group['eps'])
+        update = torch._foreach_mul(ms, alpha_ts)
+        torch._foreach_div_(update, denom)
+        torch._foreach_sub_(params, update)
+
+        if group['weight_decay'] != 0:
+            torch._foreach_sub_(params, torch._foreach_mul(params, group["lr"] * group['weight_decay']))
+
+    def _build_flat_buffers(self, group):
+        '''
+        Move the trainable parameters of a group into one contiguous buffer per dtype and
+        device, and allocate matching gradient and moment buffers. Existing gradients and
+        state (e.g. from load_state_dict) are copied in.
+        '''
+        by_key = {}
+        for p in group["params"]:
+            if p.requires_grad:
+                by_key.setdefault((p.dtype, p.device), []).append(p)
+
+        buffers = []
+        for (dtype, device), params in by_key.items():
+            numel = sum(p.numel() for p in params)
+            buffer = {name: torch.zeros(numel, dtype=dtype, device=device) for name in ('param', 'grad', 'm', 'v')}
+            # Per parameter: its step count, whether it has a gradient to apply, and its
+            # offset into the buffers.
+            buffer.update(params=params, grads=[], t=[self.state[p].get('t', 0) for p in params],
+                          has_grad=[p.grad is not None for p in params], offsets=[], hooks=[])
+            offset = 0
+            for i, p in enumerate(params):
+                views = {name: buffer[name][offset:offset + p.numel()].view_as(p)
+                         for name in ('param', 'grad', 'm', 'v')}
+                views['param'].copy_(p.data)
+                p.data = views['param']
+                if p.grad is not None:
+                    views['grad'].copy_(p.grad)
+                p.grad = views['grad']
+                buffer['grads'].append(views['grad'])
+                buffer['offsets'].append(offset)
+                buffer['hooks'].append(p.register_post_accumulate_grad_hook(_mark_has_grad(buffer, i)))
+                state = self.state[p]
+                for name in ('m', 'v'):
+                    if name in state:
+                        views[name].copy_(state[name])
+                    state[name] = views[name]
+                state['t'] = buffer['t'][i]
+                offset += p.numel()
+            buffer['offsets'].append(offset)
+            buffers.append(buffer)
+        return buffers
+
+    def _remove_flat_buffers(self):
+        if self._flat_buffers is not None:
+            for buffers in self._flat_buffers:
+                for buffer in buffers:
+                    for hook in buffer['hooks']:
+                        hook.remove()
+        self._flat_buffers = None
+
+    def _flat_step(self, group, buffer):
+        for i, (p, view) in enumerate(zip(buffer['params'], buffer['grads'])):
+            if p.grad is not view:
+                # The gradient was reset outside the optimizer, e.g. by model.zero_grad().
+                if p.grad is None:
+                    view.zero_()
+                else:
+                    view.copy_(p.grad)
+                buffer['has_grad'][i] = p.grad is not None
+                p.grad = view
+
+        # Runs of consecutive parameters that have a gradient and the same step count share
+        # one bias correction and are updated chunk by chunk together.
+        runs = []
+        for i, has_grad in enumerate(buffer['has_grad']):
+            if not has_grad:
+                continue
+            buffer['t'][i] += 1
+            start, end = buffer['offsets'][i], buffer['offsets'][i + 1]
+            if runs and runs[-1][1] == start and runs[-1][2] == buffer['t'][i]:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end, buffer['t'][i]])
+
+        beta1, beta2 = group["betas"]
+        decay = group["lr"] * group['weight_decay']
+        # Work through the buffer in cache-sized chunks with preallocated scratch space, instead
+        # of materializing several parameter-sized temporaries per step.
+        scratch = torch.empty(2 * FLAT_CHUNK_SIZE, dtype=buffer['param'].dtype, device=buffer['param'].device)
+        chunks = [(begin, min(begin + FLAT_CHUNK_SIZE, end), t)
+                  for start, end, t in runs for begin in range(start, end, FLAT_CHUNK_SIZE)]
+        for start, end, t in chunks:
+            alpha_t = group["lr"] * (1 - beta2**t)**0.5 / (1 - beta1**t)
+            param, grad, m, v = (buffer[name][start:end] for name in ('param', 'grad', 'm', 'v'))
+            update, denom = scratch[:param.numel()], scratch[FLAT_CHUNK_SIZE:FLAT_CHUNK_SIZE + param.numel()]
+            m.mul_(beta1).add_(grad, alpha=1 - beta1)
+            torch.mul(grad, grad, out=update)
+            v.mul_(beta2).add_(update, alpha=1 - beta2)
+            torch.sqrt(v, out=denom).add_(group['eps'])
+            torch.mul(m, alpha_t, out=update).div_(denom)
+            param.sub_(update)
+            param.sub_(torch.mul(param, decay, out=update))
+
+    def zero_grad(self, set_to_none: bool = True):
+        if self._flat_buffers is None:
+            return super().zero_grad(set_to_none)
+        # Keep the gradients as views into the flat buffers. With set_to_none, parameters count
+        # as having no gradient until backward reaches them again.
+        for buffers in self._flat_buffers:
+            for buffer in buffers:
+                buffer['grad'].zero_()
+                buffer['has_grad'] = [not set_to_none] * len(buffer['params'])
+                for p, view in zip(buffer['params'], buffer['grads']):
+                    p.grad = view
+
+    def state_dict(self):
+        if self._flat_buffers is not None:
+            for buffers in self._flat_buffers:
+                for buffer in buffers:
+                    for p, t in zip(buffer['params'], buffer['t']):
+                        self.state[p]['t'] = t
+        state_dict = super().state_dict()
+        # Saved so that a resumed run rounds bf16 state exactly as an uninterrupted one.
+        state_dict['rounding_generators'] = {str(device): generator.get_state()
+                                             for device, generator in self._rounding_generators.items()}
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        rounding_generators = state_dict.pop('rounding_generators', {})
+        super().load_state_dict(state_dict)
+        self._rounding_generators = {}
+        for device, generator_state in rounding_generators.items():
+            device = torch.device(device)
+            self._rounding_generators[device] = torch.Generator(device)
+            self._rounding_generators[device].set_state(generator_state)
+        # The loaded moments are separate tensors; copy them into new buffers on the next step.
+        self._remove_flat_buffers()
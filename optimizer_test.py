@@ -5,7 +5,7 @@ from optimizer import AdamW
 seed = 0
 
 
-def test_optimizer(opt_class) -> torch.Tensor:
+def test_optimizer(opt_class, **kwargs) -> torch.Tensor:
     rng = np.random.default_rng(seed)
     torch.manual_seed(seed)
     model = torch.nn.Linear(3, 2, bias=False)
@@ -14,6 +14,7 @@ def test_optimizer(opt_class) -> torch.Tensor:
         lr=1e-3,
         weight_decay=1e-4,
         correct_bias=True,
+        **kwargs,
     )
     for i in range(1000):
         opt.zero_grad()
@@ -32,3 +33,41 @@ print(ref)
 print(actual)
 assert torch.allclose(ref, actual, atol=1e-6, rtol=1e-4)
 print("Optimizer test passed!")
+
+# The multi-tensor and flat-buffer implementations perform the same operations in the same
+# order, so they must match the per-parameter loop exactly.
+for mode in ('foreach', 'flat'):
+    assert torch.equal(test_optimizer(AdamW, **{mode: True}), actual), mode
+    print(f"Optimizer test ({mode}) passed!")
+
+
+def test_partial_gradients(opt_class, **kwargs):
+    '''Two heads of which only one gets a gradient per step, as in multitask training.'''
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    heads = torch.nn.ModuleList([torch.nn.Linear(3, 2, bias=False), torch.nn.Linear(3, 1)])
+    opt = opt_class(heads.parameters(), lr=1e-3, weight_decay=1e-4, correct_bias=True, **kwargs)
+    for i in range(300):
+        opt.zero_grad()
+        x = torch.FloatTensor(rng.uniform(size=[3]))
+        # Head 1 only sees every third step, so its step count falls behind head 0's.
+        head = heads[1] if i % 3 == 0 else heads[0]
+        (head(x) ** 2).sum().backward()
+        opt.step()
+    return [p.detach().clone() for p in heads.parameters()]
+
+
+# Parameters without a gradient are skipped, not updated with a zero gradient.
+partial = test_partial_gradients(AdamW)
+for mode in ('foreach', 'flat'):
+    assert all(torch.equal(a, b) for a, b in zip(test_partial_gradients(AdamW, **{mode: True}), partial)), mode
+    print(f"Optimizer test ({mode}, partial gradients) passed!")
+
+# Compressed moments change every update slightly, so the weights drift from the reference.
+# The tolerances bound the drift after 1000 steps here: bf16 moments (stochastically rounded,
+# ~0.4% error) stay within 1e-2 of the reference, 8-bit block-quantized moments (~3% error)
+# within 2e-2, for weights of magnitude 0.07 to 0.87 that moved by up to ~1 from initialization.
+for state_precision, atol in (('bf16', 1e-2), ('int8', 2e-2)):
+    compressed = test_optimizer(AdamW, state_precision=state_precision)
+    assert torch.allclose(ref, compressed, atol=atol, rtol=0), (state_precision, (ref - compressed).abs().max())
+    print(f"Optimizer test ({state_precision} state, atol={atol}) passed!")
@@ -17,3 +17,11 @@ sanity_data['last_hidden_state'] = sanity_data['last_hidden_state'] * att_mask
 for k in ['last_hidden_state', 'pooler_output']:
     assert torch.allclose(outputs[k], sanity_data[k], atol=1e-5, rtol=1e-3)
 print("Your BERT implementation is correct!")
+
+# The unpadded encoder path must give the same outputs for the non-padding tokens.
+bert.config.unpadded_encoder = True
+outputs = bert(sent_ids, att_mask.squeeze(-1))
+outputs['last_hidden_state'] = outputs['last_hidden_state'] * att_mask
+for k in ['last_hidden_state', 'pooler_output']:
+    assert torch.allclose(outputs[k], sanity_data[k], atol=1e-5, rtol=1e-3)
+print("Unpadded encoder matches!")
@@ -0,0 +1,112 @@
+'''
+Deduplicated sentence embeddings for evaluating siamese MultitaskBERT.
+
+With --siamese each sentence of a pair is encoded on its own, and in Quora and STS many
+sentences occur in several pairs, in both positions and in both dev and test.
+SentenceEmbeddingIndex collects the distinct sentences of a set of pair datasets, encodes
+each of them once in length-sorted batches and keeps the pooled embeddings in one tensor.
+pair_loader then serves the embeddings of each pair as 'features' batches (see
+feature_cache.CachedFeatureDataset), which the evaluation functions in evaluation.py score
+with the task heads alone.
+
+Sentences are identified by their token ids, so the scores are the same as when every pair
+is encoded separately, up to floating-point rounding.
+'''
+
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from datasets import SentencePairTestDataset, pad_single
+from feature_cache import CachedFeatureDataset
+
+
+TQDM_DISABLE = False
+
+
+def encode_sentences(model, tokenizer, sentences, batch_size, device):
+    '''
+    [len(sentences), hidden_size] float32 CPU tensor of the pooler_output of each sentence,
+    given as WordPiece ids without [CLS]/[SEP] (e.g. the entries of a datasets.TokenCache).
+    The sentences are encoded in length-sorted batches to keep padding low.
+    '''
+    lengths = np.array([len(ids) for ids in sentences], dtype=np.int64)
+    order = np.argsort(lengths, kind='stable')
+    embeddings = None
+    model.eval()
+    with torch.no_grad():
+        for begin in tqdm(range(0, len(order), batch_size), desc='encode-sentences', disable=TQDM_DISABLE):
+            rows = order[begin:begin + batch_size]
+            token_ids, attention_mask, _ = pad_single(tokenizer, [sentences[i] for i in rows])
+            pooled = model(token_ids.to(device), attention_mask.to(device))['pooler_output'].float().cpu()
+            if embeddings is None:
+                embeddings = torch.empty(len(order), pooled.size(1))
+            embeddings[torch.from_numpy(rows)] = pooled
+    return embeddings
+
+
+class EmbeddingRows:
+    '''The embeddings of one side of a pair dataset, indexed by pair.'''
+    def __init__(self, embeddings, rows):
+        self.embeddings = embeddings
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, indices):
+        return self.embeddings[self.rows[indices]]
+
+
+class SentenceEmbeddingIndex:
+    def __init__(self, datasets):
+        '''
+        datasets: SentencePairDataset or SentencePairTestDataset objects. Pair i of
+        datasets[d] has its sentences in rows self.rows[d][0][i] and self.rows[d][1][i] of
+        the embedding tensor.
+        '''
+        row_of = {}
+        self.sentences = []
+        self.rows = []
+        for dataset in datasets:
+            sides = []
+            for tokens in (dataset.tokens1, dataset.tokens2):
+                rows = np.empty(len(tokens), dtype=np.int64)
+                for i in range(len(tokens)):
+                    ids = tokens[i]
+                    key = ids.tobytes()
+                    if key not in row_of:
+                        row_of[key] = len(self.sentences)
+                        self.sentences.append(ids)
+                    rows[i] = row_of[key]
+                sides.append(rows)
+            self.rows.append(sides)
+        self.datasets = list(datasets)
+        self.tokenizer = self.datasets[0].tokenizer
+        self.embeddings = None
+
+    def encode(self, model, batch_size, device):
+        '''
+        (Re-)compute the embedding of every distinct sentence with the current model.
+        `python benchmark.py sentence_cache` measures the time this saves over encoding every
+        pair.
+        '''
+        start = time.perf_counter()
+        self.embeddings = encode_sentences(model, self.tokenizer, self.sentences, batch_size, device)
+        occurrences = sum(len(rows) for sides in self.rows for rows in sides)
+        print(f"sentence cache: {len(self.sentences)} distinct of {occurrences} sentences "
+              f"(dedup ratio {occurrences / max(len(self.sentences), 1):.2f}x), "
+              f"encoded in {time.perf_counter() - start:.1f}s")
+
+    def pair_loader(self, dataset, batch_size):
+        '''Sequential loader of 'features' batches for the pairs of dataset.'''
+        rows1, rows2 = self.rows[self.datasets.index(dataset)]
+        features = [EmbeddingRows(self.embeddings, rows1), EmbeddingRows(self.embeddings, rows2)]
+        labeled = not isinstance(dataset, SentencePairTestDataset)
+        labels = dataset.dataset.labels if labeled else None
+        feature_dataset = CachedFeatureDataset(features, labels, dataset.dataset.ids,
+                                               getattr(dataset, 'isRegression', False))
+        return DataLoader(feature_dataset, batch_size=batch_size, collate_fn=feature_dataset.collate_fn)
@@ -3,7 +3,8 @@
 conda create -n cs224n_dfp_bert_39 python=3.9
 conda activate cs224n_dfp_bert_39
 
-pip install torch torchvision torchaudio
+# torch 2.1 or later: scaled_dot_product_attention and the gradient hooks of flat AdamW.
+pip install "torch>=2.1" torchvision torchaudio
 pip install tqdm==4.58.0
 pip install requests==2.25.1
 pip install importlib-metadata==3.7.0
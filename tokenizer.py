@@ -4,6 +4,8 @@ import os
 import re
 import unicodedata
 import itertools
+import multiprocessing
+import threading
 import requests
 import copy
 import json
@@ -18,6 +20,7 @@ from tokenizers import Encoding as EncodingFast
 
 VERY_LARGE_INTEGER = int(1e30)  # This is used to set the max input length for a model with infinite size input
 LARGE_INTEGER = int(1e20)  # This is used when we need something big but slightly smaller than VERY_LARGE_INTEGER
+PARALLEL_ENCODE_MIN_BATCH_SIZE = 512  # Smaller batches are always encoded in-process, even with num_workers > 1
 
 SPECIAL_TOKENS_MAP_FILE = "special_tokens_map.json"
 ADDED_TOKENS_FILE = "added_tokens.json"
@@ -1952,6 +1955,20 @@ class PreTrainedTokenizerBase(SpecialTokensMixin):
     return model_inputs
 
 
+# Tokenizer copy held by each process of a PreTrainedTokenizer encode pool.
+_encode_pool_tokenizer = None
+
+
+def _encode_pool_init(tokenizer):
+  global _encode_pool_tokenizer
+  _encode_pool_tokenizer = tokenizer
+
+
+def _encode_pool_get_input_ids(chunk):
+  batch_text_or_text_pairs, is_split_into_words, kwargs = chunk
+  return _encode_pool_tokenizer._batch_get_input_ids(batch_text_or_text_pairs, is_split_into_words, **kwargs)
+
+
 class PreTrainedTokenizer(PreTrainedTokenizerBase):
   def __init__(self, **kwargs):
     super().__init__(**kwargs)
@@ -1960,6 +1977,8 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     self.added_tokens_encoder: Dict[str, int] = {}
     self.added_tokens_decoder: Dict[int, str] = {}
     self.unique_no_split_tokens: List[str] = []
+    self._encode_pool = None
+    self._encode_pool_signature = None
 
   @property
   def is_fast(self) -> bool:
@@ -2302,8 +2321,62 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     return_offsets_mapping: bool = False,
     return_length: bool = False,
     verbose: bool = True,
+    num_workers: int = 0,
     **kwargs
   ) -> BatchEncoding:
+    """
+    Tokenizes a batch of texts or text pairs and prepares it for the model.
+    Args:
+        num_workers (:obj:`int`, `optional`, defaults to 0):
+            If greater than 1, batches of at least ``PARALLEL_ENCODE_MIN_BATCH_SIZE`` texts are tokenized by a
+            persistent pool of that many processes, each holding its own copy of the vocab. Smaller batches
+            are always tokenized in-process, so short requests do not pay the IPC cost.
+    """
+    if return_offsets_mapping:
+      raise NotImplementedError(
+        "return_offset_mapping is not available when using Python tokenizers."
+        "To use this feature, change your tokenizer to one deriving from "
+        "transformers.PreTrainedTokenizerFast."
+      )
+
+    if num_workers > 1 and len(batch_text_or_text_pairs) >= PARALLEL_ENCODE_MIN_BATCH_SIZE:
+      pool = self._get_encode_pool(num_workers)
+      # A few chunks per worker keeps the pool balanced when text lengths vary;
+      # Pool.map returns the chunks in submission order.
+      n_chunks = num_workers * 4
+      chunk_size = (len(batch_text_or_text_pairs) + n_chunks - 1) // n_chunks
+      chunks = [
+        (batch_text_or_text_pairs[i:i + chunk_size], is_split_into_words, kwargs)
+        for i in range(0, len(batch_text_or_text_pairs), chunk_size)
+      ]
+      input_ids = [ids for chunk in pool.map(_encode_pool_get_input_ids, chunks) for ids in chunk]
+    else:
+      input_ids = self._batch_get_input_ids(batch_text_or_text_pairs, is_split_into_words, **kwargs)
+
+    batch_outputs = self._batch_prepare_for_model(
+      input_ids,
+      add_special_tokens=add_special_tokens,
+      padding_strategy=padding_strategy,
+      truncation_strategy=truncation_strategy,
+      max_length=max_length,
+      stride=stride,
+      pad_to_multiple_of=pad_to_multiple_of,
+      return_attention_mask=return_attention_mask,
+      return_token_type_ids=return_token_type_ids,
+      return_overflowing_tokens=return_overflowing_tokens,
+      return_special_tokens_mask=return_special_tokens_mask,
+      return_length=return_length,
+      return_tensors=return_tensors,
+      verbose=verbose,
+    )
+
+    return BatchEncoding(batch_outputs)
+
+  def _batch_get_input_ids(self, batch_text_or_text_pairs, is_split_into_words: bool = False, **kwargs):
+    """
+    Tokenizes each text (or text pair) of a batch and converts it to ids, returning a list of
+    ``(first_ids, second_ids)`` tuples with ``second_ids`` set to None for single texts.
+    """
     def get_input_ids(text):
       if isinstance(text, str):
         tokens = self.tokenize(text, **kwargs)
@@ -2323,13 +2396,6 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
           "Input is not valid. Should be a string, a list/tuple of strings or a list/tuple of integers."
         )
 
-    if return_offsets_mapping:
-      raise NotImplementedError(
-        "return_offset_mapping is not available when using Python tokenizers."
-        "To use this feature, change your tokenizer to one deriving from "
-        "transformers.PreTrainedTokenizerFast."
-      )
-
     input_ids = []
     for ids_or_pair_ids in batch_text_or_text_pairs:
       if not isinstance(ids_or_pair_ids, (list, tuple)):
@@ -2342,25 +2408,34 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
       first_ids = get_input_ids(ids)
       second_ids = get_input_ids(pair_ids) if pair_ids is not None else None
       input_ids.append((first_ids, second_ids))
+    return input_ids
+
+  def _get_encode_pool(self, num_workers: int):
+    # The pool is rebuilt when the worker count changes, when the vocab grows (the workers would
+    # hold a stale copy) or after a fork, since a pool cannot be shared with a child process.
+    signature = (os.getpid(), num_workers, len(self))
+    if self._encode_pool is None or self._encode_pool_signature != signature:
+      self.close_encode_pool()
+      self._encode_pool = multiprocessing.Pool(
+        num_workers, initializer=_encode_pool_init, initargs=(self,)
+      )
+      self._encode_pool_signature = signature
+    return self._encode_pool
 
-    batch_outputs = self._batch_prepare_for_model(
-      input_ids,
-      add_special_tokens=add_special_tokens,
-      padding_strategy=padding_strategy,
-      truncation_strategy=truncation_strategy,
-      max_length=max_length,
-      stride=stride,
-      pad_to_multiple_of=pad_to_multiple_of,
-      return_attention_mask=return_attention_mask,
-      return_token_type_ids=return_token_type_ids,
-      return_overflowing_tokens=return_overflowing_tokens,
-      return_special_tokens_mask=return_special_tokens_mask,
-      return_length=return_length,
-      return_tensors=return_tensors,
-      verbose=verbose,
-    )
+  def close_encode_pool(self):
+    """Shuts down the worker pool used by ``num_workers``, if one was started by this process."""
+    if self._encode_pool is not None and self._encode_pool_signature[0] == os.getpid():
+      self._encode_pool.terminate()
+      self._encode_pool.join()
+    self._encode_pool = None
+    self._encode_pool_signature = None
 
-    return BatchEncoding(batch_outputs)
+  def __getstate__(self):
+    # Worker pools are process-local and cannot be pickled.
+    state = self.__dict__.copy()
+    state["_encode_pool"] = None
+    state["_encode_pool_signature"] = None
+    return state
 
   def _batch_prepare_for_model(
     self,
@@ -2798,37 +2873,101 @@ class WordpieceTokenizer(object):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    # Prefix tries over the vocab, built once. Word-initial pieces are looked up verbatim, so
+    # every entry goes into the first trie; continuation pieces are looked up as "##" + piece,
+    # so entries with that prefix also go into the second trie with the prefix stripped.
+    # Each node is a dict from character to child node; the "" key holds the vocab entry
+    # that ends at that node.
+    self._trie = {}
+    self._continuation_trie = {}
+    for token in vocab:
+      self._insert(self._trie, token, token)
+      if token.startswith("##"):
+        self._insert(self._continuation_trie, token[2:], token)
+
+  @staticmethod
+  def _insert(root, piece, token):
+    node = root
+    for char in piece:
+      node = node.setdefault(char, {})
+    node[""] = token
 
   def tokenize(self, text):
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
+      if len(token) > self.max_input_chars_per_word:
         output_tokens.append(self.unk_token)
         continue
 
+      # Most words are in the vocab as a whole, and the longest match is then the word itself.
+      if token in self.vocab:
+        output_tokens.append(token)
+        continue
+
+      # Greedy longest-match-first: walk the trie from `start` and remember the last node that
+      # completes a vocab entry. This gives the same pieces as probing the vocab with every
+      # substring token[start:end] for decreasing `end`, without building those substrings.
       is_bad = False
       start = 0
+      n_chars = len(token)
       sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
+      root = self._trie
+      while start < n_chars:
+        node = root
         cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
+        end = start
+        i = start
+        for char in token[start:]:
+          node = node.get(char)
+          if node is None:
             break
-          end -= 1
+          i += 1
+          match = node.get("")
+          if match is not None:
+            cur_substr = match
+            end = i
         if cur_substr is None:
           is_bad = True
           break
         sub_tokens.append(cur_substr)
         start = end
+        root = self._continuation_trie
 
       if is_bad:
         output_tokens.append(self.unk_token)
       else:
         output_tokens.extend(sub_tokens)
     return output_tokens
+
+
+# Process-wide tokenizer registry used by get_shared_tokenizer.
+_shared_tokenizers = {}
+_shared_tokenizers_lock = threading.Lock()
+
+
+def _reset_shared_tokenizers_lock():
+  # A fork can happen while another thread holds the lock; the child gets a fresh one. The
+  # tokenizers themselves are read-only after loading and are safely inherited by the child.
+  global _shared_tokenizers_lock
+  _shared_tokenizers_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_shared_tokenizers_lock)
+
+
+def get_shared_tokenizer(pretrained_model_name_or_path="bert-base-uncased", tokenizer_class=BertTokenizer, **kwargs):
+  """
+  Returns a tokenizer loaded with ``tokenizer_class.from_pretrained(pretrained_model_name_or_path, **kwargs)``,
+  loading each (class, name, options) combination only once per process. Callers share the returned instance,
+  so they must not add tokens to it or otherwise modify it.
+  """
+  key = (tokenizer_class, str(pretrained_model_name_or_path), repr(sorted(kwargs.items())))
+  tokenizer = _shared_tokenizers.get(key)
+  if tokenizer is None:
+    with _shared_tokenizers_lock:
+      tokenizer = _shared_tokenizers.get(key)
+      if tokenizer is None:
+        tokenizer = tokenizer_class.from_pretrained(pretrained_model_name_or_path, **kwargs)
+        _shared_tokenizers[key] = tokenizer
+  return tokenizer
@@ -0,0 +1,40 @@
+import collections
+import csv
+import os
+import tempfile
+
+from datasets import TokenCache, preprocess_string
+from tokenizer import PARALLEL_ENCODE_MIN_BATCH_SIZE, BertTokenizer
+
+
+def build_vocab_file(sents, directory, n_words=5000):
+    '''A small WordPiece vocab of the frequent words and all characters of sents, so the test needs no download.'''
+    words = collections.Counter(w for s in sents for w in s.split())
+    chars = sorted({c for s in sents for c in s if not c.isspace()})
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars + ['##' + c for c in chars]
+    vocab += [w for w, _ in words.most_common(n_words) if w not in set(vocab)]
+    path = os.path.join(directory, 'vocab.txt')
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(vocab) + '\n')
+    return path
+
+
+with open('data/quora-dev.csv', 'r') as fp:
+    sents = [preprocess_string(record['sentence1']) for record in csv.DictReader(fp, delimiter='\t')]
+sents = sents[:2 * PARALLEL_ENCODE_MIN_BATCH_SIZE]
+assert len(sents) >= PARALLEL_ENCODE_MIN_BATCH_SIZE
+
+with tempfile.TemporaryDirectory() as directory:
+    tokenizer = BertTokenizer(vocab_file=build_vocab_file(sents, directory), model_max_length=512)
+
+serial = tokenizer.batch_encode_plus(sents, add_special_tokens=False)['input_ids']
+parallel = tokenizer.batch_encode_plus(sents, add_special_tokens=False, num_workers=2)['input_ids']
+tokenizer.close_encode_pool()
+assert parallel == serial
+print(f"Parallel batch encoding of {len(sents)} sentences matches serial encoding!")
+
+serial_cache = TokenCache.build(sents, tokenizer)
+parallel_cache = TokenCache.build(sents, tokenizer, num_procs=2)
+assert tokenizer._encode_pool is None, 'TokenCache.build must shut the pool down'
+assert (serial_cache.ids == parallel_cache.ids).all() and (serial_cache.offsets == parallel_cache.offsets).all()
+print("TokenCache built in parallel matches the serial build!")
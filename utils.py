@@ -337,11 +337,18 @@ def get_parameter_dtype(parameter: Union[nn.Module]):
     return first_tuple[1].dtype
 
 
+# Added to the attention scores of padding tokens. It must stay a finite, large negative number
+# in the dtype the scores are computed in: exact in fp16, rounded to -9984 in bf16, and in both
+# far enough below any real score that softmax gives padding a weight of exactly 0.
+ATTENTION_MASK_VALUE = -10000.0
+
+
 def get_extended_attention_mask(attention_mask: Tensor, dtype) -> Tensor:
   # attention_mask [batch_size, seq_length]
   assert attention_mask.dim() == 2
+  assert torch.finfo(dtype).min < ATTENTION_MASK_VALUE, f"attention mask value does not fit {dtype}"
   # [batch_size, 1, 1, seq_length] for multi-head attention
   extended_attention_mask = attention_mask[:, None, None, :]
   extended_attention_mask = extended_attention_mask.to(dtype=dtype)  # fp16 compatibility
-  extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+  extended_attention_mask = (1.0 - extended_attention_mask) * ATTENTION_MASK_VALUE
   return extended_attention_mask
\ No newline at end of file